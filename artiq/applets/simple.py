@@ -12,6 +12,7 @@ from sipyco import pyon
 from sipyco.pipe_ipc import AsyncioChildComm
 
 from artiq.language.scan import ScanObject
+from artiq.master.publisher import subscription_name
 
 
 logger = logging.getLogger(__name__)
@@ -349,7 +350,12 @@ class SimpleApplet:
 
     def subscribe(self):
         if self.embed is None:
-            self.subscriber = Subscriber("datasets",
+            # Only the subscribed datasets are sent by the master.
+            notifier_name = subscription_name(
+                "datasets",
+                keys=[key for key in self.datasets if key is not None],
+                prefixes=self.dataset_prefixes)
+            self.subscriber = Subscriber(notifier_name,
                                          self.sub_init, self.sub_mod)
             self.loop.run_until_complete(self.subscriber.connect(
                 self.args.server, self.args.port_notify))
@@ -844,6 +844,23 @@ class StitchingInferencer(Inferencer):
                                     loc=node.loc,
                                     self_loc=node.self_loc)
 
+# Parse trees of embedded functions, shared by all compilations in the process,
+# keyed by code object, location and source code of the function.
+_parsetree_cache = OrderedDict()
+_parsetree_cache_size = 4096
+
+def _copy_parsetree(node):
+    if isinstance(node, ast.AST):
+        copy = node.__class__.__new__(node.__class__)
+        copy.__dict__.update((field, _copy_parsetree(value))
+                             for field, value in node.__dict__.items())
+        return copy
+    elif isinstance(node, list):
+        return [_copy_parsetree(elt) for elt in node]
+    else:
+        # Locations and constants are never modified.
+        return node
+
 class TypedtreeHasher(algorithm.Visitor):
     def generic_visit(self, node):
         def freeze(obj):
@@ -862,6 +879,93 @@ class TypedtreeHasher(algorithm.Visitor):
             fields = fields + node._types
         return hash(tuple(freeze(getattr(node, field_name)) for field_name in fields))
 
+class _TypedtreeWatch:
+    """
+    A snapshot of everything the inferencer observes when visiting a typed
+    tree: the unresolved type variables reachable from its types, the number
+    of quoted host values of its instance, constructor and module types
+    (whose attributes have to be checked on every value), and the number
+    of its nodes.
+
+    Inference only ever resolves type variables, quotes host values and
+    rewrites the tree, so once nothing in the snapshot has changed, visiting
+    the tree again cannot infer anything new.
+    """
+
+    def __init__(self, node, value_map, ground):
+        self.value_map = value_map
+        self.node_count = 0
+        self.tvars = {}
+        self.containers = {}
+
+        seen = set()
+        nodes = [node]
+        while nodes:
+            node = nodes.pop()
+            if isinstance(node, list):
+                nodes.extend(node)
+            elif isinstance(node, ast.AST):
+                self.node_count += 1
+                for field in node._fields:
+                    nodes.append(getattr(node, field))
+                for field in getattr(node, "_types", ()):
+                    typ = getattr(node, field)
+                    if isinstance(typ, types.Type):
+                        self._watch_type(typ, seen, ground)
+
+    def _watch_type(self, typ, seen, ground):
+        # Returns whether the type is ground, i.e. can never change.
+        typ = typ.find()
+        if id(typ) in ground:
+            return True
+        elif id(typ) in seen:
+            return False
+        seen.add(id(typ))
+
+        if isinstance(typ, types.TVar):
+            self.tvars[id(typ)] = typ
+            return False
+        elif isinstance(typ, (types.TInstance, types.TModule, types.TConstructor)):
+            self.containers[id(typ)] = (typ, self._value_count(typ))
+            if isinstance(typ, types.TInstance):
+                self._watch_type(typ.constructor, seen, ground)
+            return False
+        elif isinstance(typ, types.TMono):
+            elts = list(typ.params.values())
+        elif isinstance(typ, types.TTuple):
+            elts = typ.elts
+        elif isinstance(typ, types.TFunction):
+            elts = [*typ.args.values(), *typ.optargs.values(), typ.ret, typ.delay]
+        elif isinstance(typ, types.TRPC):
+            elts = [typ.ret]
+        else:
+            elts = []
+
+        is_ground = True
+        for elt in elts:
+            if not self._watch_type(elt, seen, ground):
+                is_ground = False
+        if is_ground:
+            ground[id(typ)] = typ
+        return is_ground
+
+    def _value_count(self, typ):
+        return len(self.value_map.get(typ, ()))
+
+    def changed(self):
+        for tvar in self.tvars.values():
+            if tvar.parent is not tvar:
+                return True
+        for typ, value_count in self.containers.values():
+            if self._value_count(typ) != value_count:
+                return True
+        return False
+
+    def same_as(self, other):
+        return self.node_count == other.node_count and \
+            self.tvars.keys() == other.tvars.keys() and \
+            self.containers.keys() == other.containers.keys()
+
 class Stitcher:
     def __init__(self, core, dmgr, engine=None, print_as_rpc=True, destination=0, subkernel_arg_types=[], old_embedding_map=None):
         self.core = core
@@ -887,7 +991,6 @@ class Stitcher:
 
         self.embedding_map = EmbeddingMap(old_embedding_map)
         self.value_map = defaultdict(lambda: [])
-        self.definitely_changed = False
 
         self.destination = destination
         self.first_call = True
@@ -909,27 +1012,45 @@ class Stitcher:
         inferencer = StitchingInferencer(engine=self.engine,
                                          value_map=self.value_map,
                                          quote=self._quote)
-        typedtree_hasher = TypedtreeHasher()
-
-        # Iterate inference to fixed point.
-        old_typedtree_hash = None
-        old_attr_count = None
+        # Iterate inference to fixed point. Rather than visiting the entire tree
+        # until it stops changing, only revisit the top-level nodes (functions
+        # and the kernel call) that are new, or that observed a change in any
+        # of their types since they were last visited.
+        watches = {}
+        visited = set()
+        # Types without type variables or host objects, which never change;
+        # shared between all watches to avoid traversing them again and again.
+        ground = {}
+        self.inference_passes = 0
+        self.inference_visits = 0
         while True:
-            inferencer.visit(self.typedtree)
-            if self.definitely_changed:
-                changed = True
-                self.definitely_changed = False
-            else:
-                typedtree_hash = typedtree_hasher.visit(self.typedtree)
-                attr_count = self.embedding_map.attribute_count()
-                changed = old_attr_count != attr_count or \
-                          old_typedtree_hash != typedtree_hash
-                old_typedtree_hash = typedtree_hash
-                old_attr_count = attr_count
-
-            if not changed:
+            worklist = [node for node in self.typedtree
+                        if id(node) not in watches or watches[id(node)].changed()]
+            if not worklist:
                 break
 
+            self.inference_passes += 1
+            for node in worklist:
+                if id(node) in visited:
+                    before = _TypedtreeWatch(node, self.value_map, ground)
+                else:
+                    # The first visit always makes progress.
+                    before = None
+                    visited.add(id(node))
+
+                inferencer.visit(node)
+                self.inference_visits += 1
+
+                after = None
+                if before is not None and not before.changed():
+                    after = _TypedtreeWatch(node, self.value_map, ground)
+                if after is None or not after.same_as(before):
+                    # The node changed itself, which may allow inferring more
+                    # of it; visit it again.
+                    watches.pop(id(node), None)
+                else:
+                    watches[id(node)] = after
+
         # After we've discovered every referenced attribute, check if any kernel_invariant
         # specifications refers to ones we didn't encounter.
         for host_type in self.embedding_map.type_map:
@@ -1067,9 +1188,6 @@ class Stitcher:
         return types.TVar()
 
     def _quote_embedded_function(self, function, flags, remote_fn=False):
-        # we are now parsing new functions... definitely changed the type
-        self.definitely_changed = True
-
         if isinstance(function, SpecializedFunction):
             host_function = function.host_function
         else:
@@ -1134,14 +1252,25 @@ class Stitcher:
         initial_whitespace = re.search(r"^\s*", source_code).group(0)
         initial_indent = len(initial_whitespace.expandtabs())
 
-        # Parse.
-        source_buffer = source.Buffer(source_code, filename, first_line)
-        lexer = source_lexer.Lexer(source_buffer, version=(3, 6), diagnostic_engine=self.engine)
-        lexer.indent = [(initial_indent,
-                         source.Range(source_buffer, 0, len(initial_whitespace)),
-                         initial_whitespace)]
-        parser = source_parser.Parser(lexer, version=(3, 6), diagnostic_engine=self.engine)
-        function_node = parser.file_input().body[0]
+        # Parse, or reuse the parse tree of a previous compilation.
+        parsetree_key = (getattr(embedded_function, "__code__", None),
+                         filename, first_line, source_code)
+        function_node = _parsetree_cache.get(parsetree_key)
+        if function_node is None:
+            source_buffer = source.Buffer(source_code, filename, first_line)
+            lexer = source_lexer.Lexer(source_buffer, version=(3, 6), diagnostic_engine=self.engine)
+            lexer.indent = [(initial_indent,
+                             source.Range(source_buffer, 0, len(initial_whitespace)),
+                             initial_whitespace)]
+            parser = source_parser.Parser(lexer, version=(3, 6), diagnostic_engine=self.engine)
+            function_node = parser.file_input().body[0]
+            _parsetree_cache[parsetree_key] = function_node
+            if len(_parsetree_cache) > _parsetree_cache_size:
+                _parsetree_cache.popitem(last=False)
+        else:
+            _parsetree_cache.move_to_end(parsetree_key)
+        # The typing passes rewrite the tree in place.
+        function_node = _copy_parsetree(function_node)
 
         # Mangle the name, since we put everything into a single module.
         full_function_name = "{}.{}".format(module_name, host_function.__qualname__)
@@ -0,0 +1,447 @@
+"""
+The :class:`KernelCache` class keeps compiled kernels, so that a kernel
+that is stitched again with the same code, types and embedded values
+(e.g. when an experiment is run again) skips the ARTIQ transforms, LLVM
+and the linker.
+
+Kernels are identified by :class:`KernelDigest`, a hash of the stitched
+typed tree that, unlike :class:`.embedding.TypedtreeHasher`, covers every
+field of every node, the source locations (which end up in the debug
+information used for backtraces) and the values of the host objects that
+are quoted into the kernel.
+
+The host objects that the generated code refers to by ID (i.e. that are
+added to the :class:`.embedding.EmbeddingMap` during code generation) are
+recorded by their position in the traversal of the quoted values, so that
+the embedding map of a cached kernel can be rebuilt from the objects of
+the current process.
+
+A single kernel can also be kept in a given file with :class:`KernelFile`,
+e.g. to reuse a precompiled kernel in later runs of an experiment.
+"""
+
+import os
+import json
+import hashlib
+import logging
+import tempfile
+from collections import OrderedDict
+
+import numpy
+from pythonparser import ast, source
+from llvmlite import binding as llvm
+
+from artiq import __version__ as artiq_version
+from . import types, builtins, asttyped, iodelay
+from .embedding import SpecializedFunction
+
+
+__all__ = ["Uncacheable", "KernelDigest", "kernel_key", "CachedKernel",
+           "KernelCache", "KernelFile"]
+
+
+logger = logging.getLogger(__name__)
+
+
+class Uncacheable(Exception):
+    """Raised when a kernel cannot be identified by a digest."""
+
+
+class KernelDigest:
+    """Computes the digest of a stitched kernel.
+
+    :ivar digest: (string) hexadecimal SHA-256 digest
+    :ivar objects: (list) host objects quoted into the kernel that may be
+        assigned an ID, in traversal order
+    """
+
+    def __init__(self, stitcher):
+        self.embedding_map = stitcher.embedding_map
+        self._hash = hashlib.sha256()
+        self._nodes = dict()
+        self._types = dict()
+        self._type_vars = dict()
+        self.objects = []
+        self._object_indices = dict()
+
+        self._emit("module", repr(stitcher.name))
+        self._value(stitcher.typedtree)
+        self.digest = self._hash.hexdigest()
+
+    def object_index(self, obj):
+        """Returns the position of ``obj`` in :attr:`objects`, or ``None``."""
+        return self._object_indices.get(id(obj))
+
+    def _emit(self, *tokens):
+        for token in tokens:
+            self._hash.update(token.encode())
+            self._hash.update(b"\n")
+
+    def _value(self, value):
+        if isinstance(value, ast.AST):
+            self._node(value)
+        elif isinstance(value, types.Type):
+            self._type(value)
+        elif isinstance(value, (list, tuple)):
+            self._emit("list", str(len(value)))
+            for elt in value:
+                self._value(elt)
+        elif isinstance(value, dict):
+            self._emit("dict", str(len(value)))
+            for key, elt in value.items():
+                self._value(key)
+                self._value(elt)
+        elif isinstance(value, (set, frozenset)):
+            if not all(isinstance(elt, str) for elt in value):
+                raise Uncacheable("set of {}".format(value))
+            self._emit("set", repr(sorted(value)))
+        elif value is None or isinstance(value, (bool, int, float, complex, str, bytes)):
+            self._emit(type(value).__name__, repr(value))
+        elif isinstance(value, iodelay.Expr):
+            self._emit("iodelay", str(value))
+        elif isinstance(value, source.Range):
+            self._emit("loc", repr(value.source_buffer.name),
+                       str(value.source_buffer.first_line),
+                       str(value.begin_pos), str(value.end_pos))
+        else:
+            raise Uncacheable("field of type {}".format(type(value).__name__))
+
+    def _node(self, node):
+        index = self._nodes.get(id(node))
+        if index is not None:
+            self._emit("node", str(index))
+            return
+        self._nodes[id(node)] = len(self._nodes)
+
+        self._emit("(", type(node).__name__)
+        for name, value in sorted(vars(node).items()):
+            self._emit(name)
+            if name == "value" and isinstance(node, asttyped.QuoteT):
+                self._constant(value, node.type)
+            else:
+                self._value(value)
+        self._emit(")")
+
+    def _type(self, typ):
+        typ = typ.find()
+        if isinstance(typ, types.TVar):
+            if typ not in self._type_vars:
+                self._type_vars[typ] = len(self._type_vars)
+            self._emit("tvar", str(self._type_vars[typ]))
+            return
+
+        index = self._types.get(id(typ))
+        if index is not None:
+            self._emit("type", str(index))
+            return
+        self._types[id(typ)] = len(self._types)
+
+        self._emit("<", type(typ).__name__)
+        for name, value in sorted(vars(typ).items()):
+            if name == "cause":
+                # Diagnostic explaining an indeterminate delay.
+                continue
+            self._emit(name)
+            self._value(value)
+        self._emit(">")
+
+    def _register_object(self, value):
+        index = self._object_indices.get(id(value))
+        if index is not None:
+            self._emit("object", str(index))
+            return False
+        self._object_indices[id(value)] = len(self.objects)
+        self.objects.append(value)
+        return True
+
+    def _constant(self, value, typ):
+        # Mirrors LLVMIRGenerator._quote.
+        if types.is_constructor(typ) or types.is_instance(typ) or types.is_module(typ):
+            if not self._register_object(value):
+                return
+            if types.is_instance(typ):
+                self._constant(type(value), typ.constructor)
+            self._emit("{")
+            for attr in typ.attributes:
+                self._emit(attr)
+                if attr == "__objectid__":
+                    continue
+                attrvalue = getattr(value, attr)
+                if (types.is_constructor(typ) and
+                        types.is_function(typ.attributes[attr]) and
+                        not types.is_external_function(typ.attributes[attr]) and
+                        not types.is_subkernel(typ.attributes[attr])):
+                    attrvalue = self.embedding_map.specialize_function(typ.instance, attrvalue)
+                self._constant(attrvalue, typ.attributes[attr])
+            self._emit("}")
+        elif builtins.is_none(typ):
+            self._emit("None")
+        elif builtins.is_bool(typ):
+            self._emit(repr(bool(value)))
+        elif builtins.is_int(typ):
+            self._emit(repr(int(value)))
+        elif builtins.is_float(typ):
+            self._emit(type(value).__name__, repr(float(value)))
+        elif builtins.is_str(typ) or builtins.is_bytes(typ) or builtins.is_bytearray(typ):
+            self._emit(repr(value))
+        elif builtins.is_array(typ):
+            self._emit("array", repr(value.shape))
+            self._listish(value.reshape((-1,)), builtins.get_iterable_elt(typ))
+        elif builtins.is_listish(typ):
+            self._listish(value, builtins.get_iterable_elt(typ))
+        elif types.is_tuple(typ):
+            self._emit("tuple", str(len(value)))
+            for elt, elt_type in zip(value, typ.find().elts):
+                self._constant(elt, elt_type)
+        elif types.is_rpc(typ) or types.is_external_function(typ) or \
+                types.is_builtin_function(typ) or types.is_subkernel(typ):
+            pass
+        elif types.is_function(typ):
+            try:
+                function = self.embedding_map.retrieve_function(value)
+            except KeyError:
+                if not isinstance(value, SpecializedFunction):
+                    raise Uncacheable("function {}".format(value))
+                function = self.embedding_map.retrieve_function(value.host_function)
+            self._emit("function", function)
+        elif types.is_method(typ):
+            self._constant(value.__func__, types.get_method_function(typ))
+            self._constant(value.__self__, types.get_method_self(typ))
+        else:
+            raise Uncacheable("value of type {}".format(types.TypePrinter().name(typ)))
+
+    def _listish(self, value, elt_type):
+        self._emit("list", type(value).__name__, str(len(value)))
+        if isinstance(value, numpy.ndarray) and (builtins.is_int(elt_type) or
+                                                 builtins.is_float(elt_type)):
+            self._emit(value.dtype.str)
+            self._hash.update(numpy.ascontiguousarray(value).tobytes())
+        else:
+            for elt in value:
+                self._constant(elt, elt_type)
+
+
+def kernel_key(digest, target, embedding_map, **options):
+    """Returns the cache key of a kernel, from its :class:`KernelDigest`,
+    the target it is compiled for, its :class:`.embedding.EmbeddingMap`
+    after stitching and the compilation ``options``."""
+    return hashlib.sha256(repr((
+        digest.digest, artiq_version, llvm.llvm_version_info,
+        type(target).__qualname__, target.triple, target.data_layout,
+        target.features, target.subkernel_id,
+        sorted(embedding_map.object_forward_map.keys()),
+        embedding_map.object_current_key,
+        list(embedding_map.str_forward_map.keys()),
+        sorted(options.items()))).encode()).hexdigest()
+
+
+class CachedKernel:
+    """A compiled kernel and the additions to its embedding map made
+    during code generation.
+
+    :ivar library: (bytes) linked kernel, with debug information
+    :ivar stripped_library: (bytes) linked kernel, without debug information
+    :ivar objects: (list of (int, int)) ID of each added object, with its
+        position in :attr:`KernelDigest.objects`
+    :ivar strings: (list of string) added strings, in ID order
+    :ivar object_current_key: (int) last object ID
+    """
+
+    def __init__(self, library, stripped_library, objects, strings, object_current_key):
+        self.library = library
+        self.stripped_library = stripped_library
+        self.objects = objects
+        self.strings = strings
+        self.object_current_key = object_current_key
+
+    @staticmethod
+    def snapshot(embedding_map):
+        """Returns the state of an embedding map after stitching, to be
+        passed to :meth:`record`."""
+        return set(embedding_map.object_forward_map.keys()), \
+               len(embedding_map.str_forward_map)
+
+    @classmethod
+    def record(cls, digest, snapshot, embedding_map, library, stripped_library):
+        """Returns a :class:`CachedKernel` for a compiled kernel, or ``None``
+        if its embedding map cannot be rebuilt from ``digest``."""
+        if embedding_map.subkernels() or embedding_map.subkernel_message_map:
+            return None
+
+        stitched_keys, stitched_strings = snapshot
+        objects = []
+        for key, obj in embedding_map.object_forward_map.items():
+            if key in stitched_keys:
+                continue
+            index = digest.object_index(obj)
+            if index is None:
+                return None
+            objects.append((key, index))
+        strings = [embedding_map.str_reverse_map[str_id]
+                   for str_id in range(stitched_strings,
+                                       len(embedding_map.str_reverse_map))]
+        return cls(library, stripped_library, objects, strings,
+                   embedding_map.object_current_key)
+
+    def restore(self, digest, embedding_map):
+        """Adds the recorded objects and strings to the embedding map of a
+        kernel with the same key."""
+        for key, index in self.objects:
+            obj = digest.objects[index]
+            embedding_map.object_forward_map[key] = obj
+            embedding_map.object_reverse_map[id(obj)] = key
+        for s in self.strings:
+            embedding_map.store_str(s)
+        embedding_map.object_current_key = self.object_current_key
+
+    def write(self, filename, key):
+        header = json.dumps({
+            "key": key,
+            "objects": self.objects,
+            "strings": self.strings,
+            "object_current_key": self.object_current_key,
+            "library_size": len(self.library),
+        }).encode()
+        directory = os.path.dirname(filename)
+        with tempfile.NamedTemporaryFile(dir=directory, delete=False) as f:
+            try:
+                f.write(header + b"\n")
+                f.write(self.library)
+                f.write(self.stripped_library)
+            except:
+                os.unlink(f.name)
+                raise
+        os.replace(f.name, filename)
+
+    @classmethod
+    def read(cls, filename):
+        """Returns the key and the :class:`CachedKernel` stored in a file."""
+        with open(filename, "rb") as f:
+            header = json.loads(f.readline())
+            library = f.read(header["library_size"])
+            stripped_library = f.read()
+        return header["key"], cls(library, stripped_library,
+                                  [tuple(obj) for obj in header["objects"]],
+                                  header["strings"], header["object_current_key"])
+
+
+class KernelCache:
+    """Cache of compiled kernels, kept in memory and optionally in a
+    directory.
+
+    :param max_entries: number of kernels kept in memory, least recently
+        used first evicted
+    :param directory: directory where kernels are stored, or ``None``
+    """
+
+    def __init__(self, max_entries=32, directory=None):
+        self.max_entries = max_entries
+        self.directory = directory
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def _filename(self, key):
+        return os.path.join(self.directory, key + ".kernel")
+
+    def get(self, key):
+        """Returns the :class:`CachedKernel` with the given key, or
+        ``None``."""
+        kernel = self.entries.get(key)
+        if kernel is not None:
+            self.entries.move_to_end(key)
+        elif self.directory is not None:
+            try:
+                stored_key, kernel = CachedKernel.read(self._filename(key))
+            except FileNotFoundError:
+                pass
+            except (OSError, ValueError, KeyError):
+                logger.warning("failed to read cached kernel %s", key, exc_info=True)
+            else:
+                if stored_key == key:
+                    self._add(key, kernel)
+                else:
+                    kernel = None
+
+        if kernel is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        logger.debug("kernel cache %s for %s (%d hits, %d misses)",
+                     "hit" if kernel is not None else "miss", key,
+                     self.hits, self.misses)
+        return kernel
+
+    def _add(self, key, kernel):
+        self.entries[key] = kernel
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def put(self, key, kernel):
+        """Stores a :class:`CachedKernel`."""
+        self._add(key, kernel)
+        if self.directory is not None:
+            try:
+                os.makedirs(self.directory, exist_ok=True)
+                kernel.write(self._filename(key), key)
+            except OSError:
+                logger.warning("failed to write cached kernel %s", key, exc_info=True)
+
+    def hit_rate(self):
+        """Returns the fraction of lookups that found a kernel, or ``None``
+        if there was no lookup."""
+        lookups = self.hits + self.misses
+        if not lookups:
+            return None
+        return self.hits/lookups
+
+
+class KernelFile:
+    """A single compiled kernel kept in a file, with the interface of
+    :class:`KernelCache`.
+
+    The stored kernel is only returned for the key it was stored with;
+    any other key means that the kernel, the host objects it embeds or
+    the compiler changed, and the kernel has to be compiled again.
+
+    :param filename: file where the kernel is stored
+    :ivar kernel: the :class:`CachedKernel` that was found or stored,
+        or ``None``
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.kernel = None
+
+    def get(self, key):
+        """Returns the stored :class:`CachedKernel` if it has the given
+        key, or ``None``."""
+        try:
+            stored_key, kernel = CachedKernel.read(self.filename)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError):
+            logger.warning("failed to read kernel from %s", self.filename, exc_info=True)
+            return None
+        if stored_key != key:
+            logger.info("kernel stored in %s is out of date, compiling it again",
+                        self.filename)
+            return None
+        self.kernel = kernel
+        return kernel
+
+    def put(self, key, kernel):
+        """Stores a :class:`CachedKernel`, replacing the previous one."""
+        try:
+            directory = os.path.dirname(os.path.abspath(self.filename))
+            os.makedirs(directory, exist_ok=True)
+            kernel.write(self.filename, key)
+        except OSError:
+            logger.warning("failed to write kernel to %s", self.filename, exc_info=True)
+        else:
+            self.kernel = kernel
+
+
+#: Process-wide kernel cache. Kernels are also stored in the directory
+#: given by the ``ARTIQ_KERNEL_CACHE`` environment variable, if set.
+cache = KernelCache(directory=os.getenv("ARTIQ_KERNEL_CACHE"))
@@ -6,10 +6,14 @@ A :class:`Module` can be created from a typed AST.
 
 The :class:`Source` class parses a single source file or
 string and infers types for it using a trivial :module:`prelude`.
+
+The :class:`PassManager` class runs the passes of the compiler pipeline
+of a :class:`Module`, and records the time they take.
 """
 
 import os
-from pythonparser import source, diagnostic, parse_buffer
+import time
+from pythonparser import ast, source, diagnostic, parse_buffer
 from . import prelude, types, transforms, analyses, validators, embedding
 
 class Source:
@@ -39,13 +43,89 @@ class Source:
         with open(filename) as f:
             return cls(source.Buffer(f.read(), filename, 1), engine=engine)
 
+def _count_typedtree_nodes(typedtree):
+    count = 0
+    stack = list(typedtree) if isinstance(typedtree, list) else [typedtree]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, list):
+            stack.extend(node)
+        elif isinstance(node, ast.AST):
+            count += 1
+            stack.extend(getattr(node, field, None) for field in node._fields)
+    return count
+
+def _count_ir_instructions(functions):
+    return sum(len(block.instructions)
+               for function in functions for block in function.basic_blocks)
+
+class PassManager:
+    """
+    Runs the passes of the compiler pipeline of a :class:`Module`,
+    recording the time each of them takes.
+
+    :param passes: (list of string) names of the passes to run, in order,
+        e.g. to skip or reorder passes; all passes of the pipeline
+        by default
+    :param count_nodes: also record the number of nodes of the typed tree,
+        or of instructions of the ARTIQ IR, after each pass
+    :ivar timings: (list of (string, float, float)) name, start
+        (as given by :func:`time.perf_counter`) and duration of each pass
+    :ivar node_counts: (list of int) number of nodes after each pass,
+        if counted
+    """
+
+    def __init__(self, passes=None, count_nodes=False):
+        self.passes = passes
+        self.count_nodes = count_nodes
+        self.timings = []
+        self.node_counts = []
+
+    def run(self, pipeline):
+        """
+        Runs the passes of ``pipeline``, a list of (name, function, count)
+        tuples where ``count`` returns the number of nodes the pass works on.
+        """
+        pipeline = {name: (function, count) for name, function, count in pipeline}
+        if self.passes is None:
+            passes = pipeline.keys()
+        else:
+            passes = self.passes
+            for name in passes:
+                if name not in pipeline:
+                    raise ValueError("Unknown pass {}".format(name))
+
+        for name in passes:
+            function, count = pipeline[name]
+            start = time.perf_counter()
+            function()
+            self.timings.append((name, start, time.perf_counter() - start))
+            if self.count_nodes:
+                self.node_counts.append(count())
+
+    def report(self):
+        """Returns a table of the time taken by each pass and, if counted,
+        the number of nodes after it."""
+        lines = ["{:<32}{:>10}{:>10}".format("Pass", "Time (ms)",
+                                             "Nodes" if self.count_nodes else "")]
+        for index, (name, _, duration) in enumerate(self.timings):
+            nodes = self.node_counts[index] if self.count_nodes else ""
+            lines.append("{:<32}{:>10.1f}{:>10}".format(name, duration * 1000, nodes))
+        lines.append("{:<32}{:>10.1f}".format(
+            "Total", sum(duration for _, _, duration in self.timings) * 1000))
+        return "\n".join(line.rstrip() for line in lines)
+
 class Module:
-    def __init__(self, src, ref_period=1e-6, attribute_writeback=True, remarks=False):
+    def __init__(self, src, ref_period=1e-6, attribute_writeback=True, remarks=False,
+                 pass_manager=None):
         self.attribute_writeback = attribute_writeback
         self.engine = src.engine
         self.embedding_map = src.embedding_map
         self.name = src.name
         self.globals = src.globals
+        if pass_manager is None:
+            pass_manager = PassManager()
+        self.pass_manager = pass_manager
 
         int_monomorphizer = transforms.IntMonomorphizer(engine=self.engine)
         cast_monomorphizer = transforms.CastMonomorphizer(engine=self.engine)
@@ -67,23 +147,51 @@ class Module:
         interleaver = transforms.Interleaver(engine=self.engine)
         invariant_detection = analyses.InvariantDetection(engine=self.engine)
 
-        int_monomorphizer.visit(src.typedtree)
-        cast_monomorphizer.visit(src.typedtree)
-        inferencer.visit(src.typedtree)
-        monomorphism_validator.visit(src.typedtree)
-        escape_validator.visit(src.typedtree)
-        iodelay_estimator.visit_fixpoint(src.typedtree)
-        constness_validator.visit(src.typedtree)
-        devirtualization.visit(src.typedtree)
-        self.artiq_ir = artiq_ir_generator.visit(src.typedtree)
-        artiq_ir_generator.annotate_calls(devirtualization)
-        dead_code_eliminator.process(self.artiq_ir)
-        interleaver.process(self.artiq_ir)
-        local_access_validator.process(self.artiq_ir)
-        local_demoter.process(self.artiq_ir)
-        constant_hoister.process(self.artiq_ir)
+        def generate_artiq_ir():
+            self.artiq_ir = artiq_ir_generator.visit(src.typedtree)
+            artiq_ir_generator.annotate_calls(devirtualization)
+
+        count_typedtree = lambda: _count_typedtree_nodes(src.typedtree)
+        count_ir = lambda: _count_ir_instructions(self.artiq_ir)
+        pipeline = [
+            ("IntMonomorphizer",
+                lambda: int_monomorphizer.visit(src.typedtree), count_typedtree),
+            ("CastMonomorphizer",
+                lambda: cast_monomorphizer.visit(src.typedtree), count_typedtree),
+            ("Inferencer",
+                lambda: inferencer.visit(src.typedtree), count_typedtree),
+            ("MonomorphismValidator",
+                lambda: monomorphism_validator.visit(src.typedtree), count_typedtree),
+            ("EscapeValidator",
+                lambda: escape_validator.visit(src.typedtree), count_typedtree),
+            ("IODelayEstimator",
+                lambda: iodelay_estimator.visit_fixpoint(src.typedtree), count_typedtree),
+            ("ConstnessValidator",
+                lambda: constness_validator.visit(src.typedtree), count_typedtree),
+            ("Devirtualization",
+                lambda: devirtualization.visit(src.typedtree), count_typedtree),
+            ("ARTIQIRGenerator",
+                generate_artiq_ir, count_ir),
+            ("DeadCodeEliminator",
+                lambda: dead_code_eliminator.process(self.artiq_ir), count_ir),
+            ("Interleaver",
+                lambda: interleaver.process(self.artiq_ir), count_ir),
+            ("LocalAccessValidator",
+                lambda: local_access_validator.process(self.artiq_ir), count_ir),
+            ("LocalDemoter",
+                lambda: local_demoter.process(self.artiq_ir), count_ir),
+            ("ConstantHoister",
+                lambda: constant_hoister.process(self.artiq_ir), count_ir),
+        ]
         if remarks:
-            invariant_detection.process(self.artiq_ir)
+            pipeline.append(("InvariantDetection",
+                lambda: invariant_detection.process(self.artiq_ir), count_ir))
+
+        if pass_manager.passes is not None and "ARTIQIRGenerator" not in pass_manager.passes:
+            raise ValueError("The ARTIQIRGenerator pass cannot be skipped")
+        # Passes on the ARTIQ IR that are moved before its generation have nothing to process.
+        self.artiq_ir = []
+        pass_manager.run(pipeline)
         # for subkernels: main kernel inferencer output, to be passed to further compilations
         self.subkernel_arg_types = inferencer.subkernel_arg_types
 
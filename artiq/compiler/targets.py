@@ -1,4 +1,6 @@
-import os, sys, tempfile, subprocess, io
+import os, sys, tempfile, subprocess, io, struct, time, hashlib
+from collections import OrderedDict
+from contextlib import contextmanager
 from artiq.compiler import types, ir
 from llvmlite import ir as ll, binding as llvm
 
@@ -49,6 +51,137 @@ class RunTool:
         for filename in self._tempnames.values():
             os.unlink(filename)
 
+# Bitcode of optimized LLVM modules, shared by all targets in the process,
+# keyed by the LLVM IR they were parsed from.
+_optimized_ir_cache = OrderedDict()
+_optimized_ir_cache_size = 16
+
+def _strip_debug(library):
+    """
+    Remove the debug information sections from an ELF shared library,
+    like ``llvm-strip --strip-debug``.
+
+    The loadable contents of the library are kept as they are, and the
+    remaining non-loadable sections are moved over the removed ones.
+    Raises :class:`ValueError` if the layout of the library is not one
+    produced by linking a kernel.
+    """
+    if library[:4] != b"\x7fELF":
+        raise ValueError("not an ELF file")
+    if library[4] == 1:
+        ehdr_fmt, phdr_fmt, shdr_fmt, sym_fmt = \
+            "16sHHIIIIIHHHHHH", "IIIIIIII", "IIIIIIIIII", "IIIBBH"
+        phdr_offset, phdr_filesz, sym_shndx = 1, 4, 5
+    elif library[4] == 2:
+        ehdr_fmt, phdr_fmt, shdr_fmt, sym_fmt = \
+            "16sHHIQQQIHHHHHH", "IIQQQQQQ", "IIQQQQIIQQ", "IBBHQQ"
+        phdr_offset, phdr_filesz, sym_shndx = 2, 5, 3
+    else:
+        raise ValueError("unknown ELF class")
+    byteorder = {1: "<", 2: ">"}[library[5]]
+    ehdr_fmt, phdr_fmt, shdr_fmt, sym_fmt = \
+        (struct.Struct(byteorder + fmt) for fmt in (ehdr_fmt, phdr_fmt, shdr_fmt, sym_fmt))
+
+    SHT_SYMTAB, SHT_NOBITS, SHT_REL, SHT_RELA, SHT_DYNSYM = 2, 8, 9, 4, 11
+    SHF_ALLOC, SHF_INFO_LINK = 0x2, 0x40
+    SHN_LORESERVE = 0xff00
+
+    ehdr = list(ehdr_fmt.unpack_from(library))
+    e_phoff, e_shoff, e_phentsize, e_phnum, e_shentsize, e_shnum, e_shstrndx = \
+        ehdr[5], ehdr[6], ehdr[9], ehdr[10], ehdr[11], ehdr[12], ehdr[13]
+    if e_shnum == 0 or e_shentsize != shdr_fmt.size or e_phentsize != phdr_fmt.size:
+        raise ValueError("unsupported ELF headers")
+
+    # Field indices: 0 name, 1 type, 2 flags, 3 addr, 4 offset, 5 size,
+    # 6 link, 7 info, 8 addralign, 9 entsize.
+    sections = [list(shdr_fmt.unpack_from(library, e_shoff + index * e_shentsize))
+                for index in range(e_shnum)]
+    shstrtab = sections[e_shstrndx]
+    def section_name(shdr):
+        start = shstrtab[4] + shdr[0]
+        return library[start:library.index(b"\0", start)]
+
+    removed = set()
+    for index, shdr in enumerate(sections):
+        name = section_name(shdr)
+        if name.startswith((b".debug", b".zdebug")) or name == b".gdb_index":
+            removed.add(index)
+    for index, shdr in enumerate(sections):
+        if shdr[1] in (SHT_REL, SHT_RELA) and not shdr[2] & SHF_ALLOC and shdr[7] in removed:
+            removed.add(index)
+    if not removed:
+        return library
+    if e_shstrndx in removed:
+        raise ValueError("section name table is debug information")
+
+    index_map = {}
+    for index in range(e_shnum):
+        if index not in removed:
+            index_map[index] = len(index_map)
+
+    # Everything that gets loaded stays at its place.
+    loaded_end = max(e_phoff + e_phnum * e_phentsize, ehdr_fmt.size)
+    for index, shdr in enumerate(sections):
+        if shdr[2] & SHF_ALLOC and shdr[1] != SHT_NOBITS:
+            if index in removed:
+                raise ValueError("debug information section is loaded")
+            loaded_end = max(loaded_end, shdr[4] + shdr[5])
+    output = bytearray(library[:loaded_end])
+
+    # Move the remaining sections after the loaded contents.
+    moved = {}
+    for index, shdr in enumerate(sections):
+        if index in removed or shdr[2] & SHF_ALLOC or shdr[1] == SHT_NOBITS or index == 0:
+            continue
+        contents = bytearray(library[shdr[4]:shdr[4] + shdr[5]])
+        if shdr[1] == SHT_SYMTAB:
+            for offset in range(0, len(contents), sym_fmt.size):
+                symbol = list(sym_fmt.unpack_from(contents, offset))
+                if 0 < symbol[sym_shndx] < SHN_LORESERVE:
+                    if symbol[sym_shndx] not in index_map:
+                        raise ValueError("symbol refers to debug information")
+                    symbol[sym_shndx] = index_map[symbol[sym_shndx]]
+                    sym_fmt.pack_into(contents, offset, *symbol)
+
+        output += bytes(-len(output) % max(shdr[8], 1))
+        moved[shdr[4]] = len(output)
+        shdr[4] = len(output)
+        output += contents
+
+    for index, shdr in enumerate(sections):
+        if index in removed:
+            continue
+        if shdr[1] == SHT_DYNSYM:
+            # The dynamic symbol table is loaded; it cannot be rewritten.
+            for offset in range(shdr[4], shdr[4] + shdr[5], sym_fmt.size):
+                shndx = sym_fmt.unpack_from(library, offset)[sym_shndx]
+                if 0 < shndx < SHN_LORESERVE and index_map.get(shndx) != shndx:
+                    raise ValueError("dynamic symbol refers to a renumbered section")
+        if shdr[6] != 0:
+            if shdr[6] not in index_map:
+                raise ValueError("section links to debug information")
+            shdr[6] = index_map[shdr[6]]
+        if shdr[1] in (SHT_REL, SHT_RELA) or shdr[2] & SHF_INFO_LINK:
+            shdr[7] = index_map.get(shdr[7], 0)
+
+    # Program headers may also refer to a non-loaded section, such as
+    # the RISC-V attributes.
+    for index in range(e_phnum):
+        phdr = list(phdr_fmt.unpack_from(output, e_phoff + index * e_phentsize))
+        if phdr[phdr_filesz] != 0 and phdr[phdr_offset] >= loaded_end:
+            if phdr[phdr_offset] not in moved:
+                raise ValueError("segment refers to debug information")
+            phdr[phdr_offset] = moved[phdr[phdr_offset]]
+            phdr_fmt.pack_into(output, e_phoff + index * e_phentsize, *phdr)
+
+    output += bytes(-len(output) % (4 if library[4] == 1 else 8))
+    ehdr[6], ehdr[12], ehdr[13] = len(output), len(index_map), index_map[e_shstrndx]
+    ehdr_fmt.pack_into(output, 0, *ehdr)
+    for index, shdr in enumerate(sections):
+        if index not in removed:
+            output += shdr_fmt.pack(*shdr)
+    return bytes(output)
+
 def _dump(target, kind, suffix, content):
     if target is not None:
         print("====== {} DUMP ======".format(kind.upper()), file=sys.stderr)
@@ -97,6 +230,16 @@ class Target:
     def __init__(self, subkernel_id=None):
         self.llcontext = ll.Context()
         self.subkernel_id = subkernel_id
+        self.timings = None
+
+    @contextmanager
+    def _timed(self, stage):
+        if self.timings is None:
+            yield
+        else:
+            start = time.perf_counter()
+            yield
+            self.timings.append((stage, start, time.perf_counter() - start))
 
     def target_machine(self):
         lltarget = llvm.Target.from_triple(self.triple)
@@ -140,6 +283,10 @@ class Target:
 
     def compile(self, module):
         """Compile the module to a relocatable object for this target."""
+        return self.compile_llvm_ir(self.generate_llvm_ir(module))
+
+    def generate_llvm_ir(self, module):
+        """Generate the textual LLVM IR of the module for this target."""
 
         if os.getenv("ARTIQ_DUMP_SIG"):
             print("====== MODULE_SIGNATURE DUMP ======", file=sys.stderr)
@@ -153,19 +300,48 @@ class Target:
         _dump(os.getenv("ARTIQ_DUMP_IR"), "ARTIQ IR", suffix + ".txt",
               lambda: "\n".join(fn.as_entity(type_printer) for fn in module.artiq_ir))
 
-        llmod = module.build_llvm_ir(self)
+        with self._timed("LLVM IR generation"):
+            llmod = module.build_llvm_ir(self)
+        with self._timed("LLVM IR printing"):
+            return str(llmod)
 
-        try:
-            llparsedmod = llvm.parse_assembly(str(llmod))
-            llparsedmod.verify()
-        except RuntimeError:
-            _dump("", "LLVM IR (broken)", ".ll", lambda: str(llmod))
-            raise
+    def compile_llvm_ir(self, llmod_text):
+        """Parse, verify and optimize textual LLVM IR generated for this target."""
+        suffix = "_subkernel_{}".format(self.subkernel_id) if self.subkernel_id is not None else ""
 
-        _dump(os.getenv("ARTIQ_DUMP_UNOPT_LLVM"), "LLVM IR (generated)", suffix + "_unopt.ll",
-              lambda: str(llparsedmod))
+        # llvmlite can only hand a module over to LLVM as text, which then has
+        # to be parsed, verified and optimized again. Reuse the result if the same
+        # IR was already optimized.
+        cache_key = (self.__class__, hashlib.sha256(llmod_text.encode("utf-8")).digest())
+        cached = _optimized_ir_cache.get(cache_key)
+        if cached is None:
+            with self._timed("LLVM IR parsing"):
+                try:
+                    llparsedmod = llvm.parse_assembly(llmod_text)
+                    llparsedmod.verify()
+                except RuntimeError:
+                    _dump("", "LLVM IR (broken)", ".ll", lambda: llmod_text)
+                    raise
+
+            _dump(os.getenv("ARTIQ_DUMP_UNOPT_LLVM"), "LLVM IR (generated)", suffix + "_unopt.ll",
+                  lambda: str(llparsedmod))
+
+            with self._timed("LLVM optimizations"):
+                self.optimize(llparsedmod)
+
+            _optimized_ir_cache[cache_key] = llparsedmod.name, llparsedmod.as_bitcode()
+            while len(_optimized_ir_cache) > _optimized_ir_cache_size:
+                _optimized_ir_cache.popitem(last=False)
+        else:
+            _optimized_ir_cache.move_to_end(cache_key)
 
-        self.optimize(llparsedmod)
+            _dump(os.getenv("ARTIQ_DUMP_UNOPT_LLVM"), "LLVM IR (generated)", suffix + "_unopt.ll",
+                  lambda: str(llvm.parse_assembly(llmod_text)))
+
+            with self._timed("LLVM bitcode parsing (cached)"):
+                name, bitcode = cached
+                llparsedmod = llvm.parse_bitcode(bitcode)
+                llparsedmod.name = name
 
         _dump(os.getenv("ARTIQ_DUMP_LLVM"), "LLVM IR (optimized)", suffix + ".ll",
               lambda: str(llparsedmod))
@@ -181,11 +357,12 @@ class Target:
         _dump(os.getenv("ARTIQ_DUMP_OBJ"), "Object file", ".o",
               lambda: llmachine.emit_object(llmodule))
 
-        return llmachine.emit_object(llmodule)
+        with self._timed("LLVM machine code emission"):
+            return llmachine.emit_object(llmodule)
 
     def link(self, objects):
         """Link the relocatable objects into a shared library for this target."""
-        with RunTool([self.tool_ld, "-shared", "--eh-frame-hdr"] +
+        with self._timed("Linking"), RunTool([self.tool_ld, "-shared", "--eh-frame-hdr"] +
                      self.additional_linker_options +
                      ["-T" + os.path.join(os.path.dirname(__file__), "kernel.ld")] +
                      ["{{obj{}}}".format(index) for index in range(len(objects))] +
@@ -201,14 +378,41 @@ class Target:
 
             return library
 
+    def build_library(self, llmod_text):
+        """Compile, link and strip textual LLVM IR generated for this target."""
+        return self.strip(self.link([self.assemble(self.compile_llvm_ir(llmod_text))]))
+
     def compile_and_link(self, modules):
-        return self.link([self.assemble(self.compile(module)) for module in modules])
+        if os.getenv("ARTIQ_DUMP_TIMINGS") is None:
+            return self.link([self.assemble(self.compile(module)) for module in modules])
+
+        # Timings may also be recorded by the caller.
+        outer_timings, self.timings = self.timings, []
+        try:
+            library = self.link([self.assemble(self.compile(module)) for module in modules])
+        finally:
+            timings, self.timings = self.timings, outer_timings
+        if outer_timings is not None:
+            outer_timings.extend(timings)
+
+        print("====== COMPILATION TIMINGS DUMP ======", file=sys.stderr)
+        for stage, _, duration in timings:
+            print("{:<32}{:>10.1f} ms".format(stage, duration * 1000), file=sys.stderr)
+        print("{:<32}{:>10.1f} ms".format("Total", sum(duration for _, _, duration in timings) * 1000),
+              file=sys.stderr)
+        return library
 
     def strip(self, library):
-        with RunTool([self.tool_strip, "--strip-debug", "{library}", "-o", "{output}"],
-                     library=library, output=None) \
-                as results:
-            return results["output"].read()
+        with self._timed("Stripping"):
+            try:
+                return _strip_debug(library)
+            except ValueError:
+                pass
+
+            with RunTool([self.tool_strip, "--strip-debug", "{library}", "-o", "{output}"],
+                         library=library, output=None) \
+                    as results:
+                return results["output"].read()
 
     def symbolize(self, library, addresses):
         if addresses == []:
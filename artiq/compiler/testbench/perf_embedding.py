@@ -32,12 +32,12 @@ def main():
 
     dataset_db_path = os.path.join(os.path.dirname(sys.argv[1]), "dataset_db.mdb")
     dataset_db = DatasetDB(dataset_db_path)
-    dataset_mgr = DatasetManager()
+    dataset_mgr = DatasetManager(dataset_db)
 
     argument_mgr = ProcessArgumentManager({})
 
     def embed():
-        experiment = testcase_vars["Benchmark"]((device_mgr, dataset_mgr, argument_mgr))
+        experiment = testcase_vars["Benchmark"]((device_mgr, dataset_mgr, argument_mgr, {}))
 
         stitcher = Stitcher(core=experiment.core, dmgr=device_mgr)
         stitcher.stitch_call(experiment.run, (), {})
@@ -45,6 +45,10 @@ def main():
         return stitcher
 
     stitcher = embed()
+    print("ARTIQ embedding: {} inference passes, {} visits of {} top-level nodes".format(
+            stitcher.inference_passes, stitcher.inference_visits,
+            len(stitcher.typedtree.body)))
+
     module = Module(stitcher)
     target = RV32GTarget()
     llvm_ir = target.compile(module)
@@ -176,6 +176,7 @@ class LLVMIRGenerator:
         self.debug_info_emitter = DebugInfoEmitter(self.llmodule)
         self.empty_metadata = self.llmodule.add_metadata([])
         self.quote_fail_msg = None
+        self.stored_attributes = set()
 
         # Maximum alignment required according to the target platform ABI. As this is
         # not directly exposed by LLVM, just take the maximum across all the "big"
@@ -556,6 +557,10 @@ class LLVMIRGenerator:
         return self.llmodule
 
     def emit_attribute_writeback(self):
+        # All attributes to write back are sent at once, as the arguments of a single
+        # asynchronous RPC to service 0, with (object, name, value) triples of arguments.
+        # The "writeback" global holds the tag of that RPC and the pointers to its
+        # arguments; the runtime sends it when the kernel completes.
         llobjects = defaultdict(lambda: [])
 
         for obj_id, obj_ref, obj_typ in self.embedding_map.iter_objects():
@@ -563,52 +568,25 @@ class LLVMIRGenerator:
             if llobject is not None:
                 llobjects[obj_typ].append(llobject.bitcast(llptr))
 
-        llrpcattrty = self.llcontext.get_identified_type("A")
-        llrpcattrty.elements = [lli32, llslice, llslice]
-
-        lldescty = self.llcontext.get_identified_type("D")
-        lldescty.elements = [llrpcattrty.as_pointer().as_pointer(), llptr.as_pointer()]
+        def is_mutable(typ):
+            typ = typ.find()
+            if types.is_tuple(typ):
+                return any(is_mutable(elt) for elt in typ.elts)
+            return builtins.is_list(typ) or builtins.is_array(typ) or \
+                builtins.is_bytearray(typ)
 
-        lldescs = []
+        rpctag = b""
+        llargs = []
         for typ in llobjects:
-            if "__objectid__" not in typ.attributes:
+            if "__objectid__" not in typ.attributes or not types.is_instance(typ):
                 continue
 
-            if types.is_constructor(typ):
-                type_name = "C.{}".format(typ.name)
-            else:
-                type_name = "I.{}".format(typ.name)
-
-            def llrpcattr_of_attr(offset, name, typ):
-                def rpc_tag_error(typ):
-                    print(typ)
-                    assert False
-
-                if name == "__objectid__":
-                    rpctag = b""
-                else:
-                    rpctag = b"Os" + ir.rpc_tag(typ, error_handler=rpc_tag_error) + b":n"
-
-                llrpcattrinit = ll.Constant(llrpcattrty, [
-                    ll.Constant(lli32, offset),
-                    self.llconst_of_const(ir.Constant(rpctag, builtins.TStr())),
-                    self.llconst_of_const(ir.Constant(name, builtins.TStr()))
-                ])
-
-                if name == "__objectid__":
-                    return self.get_or_define_global(name, llrpcattrty, llrpcattrinit)
-
-                llrpcattr = ll.GlobalVariable(self.llmodule, llrpcattrty,
-                                              name="A.{}.{}".format(type_name, name))
-                llrpcattr.initializer = llrpcattrinit
-                llrpcattr.global_constant = True
-                llrpcattr.unnamed_addr = True
-                llrpcattr.linkage = 'private'
-
-                return llrpcattr
+            def rpc_tag_error(typ):
+                print(typ)
+                assert False
 
             offset = 0
-            llrpcattrs = []
+            llattrs = []
             for attr in typ.attributes:
                 attrtyp = typ.attributes[attr]
                 size, alignment = self.abi_layout_info.get_size_align_for_type(attrtyp)
@@ -616,50 +594,59 @@ class LLVMIRGenerator:
                 if offset % alignment != 0:
                     offset += alignment - (offset % alignment)
 
-                if types.is_instance(typ) and attr not in typ.constant_attributes:
+                # Only attributes stored to by the kernel are written back, along with
+                # those that may have been modified in place.
+                if attr != "__objectid__" and attr not in typ.constant_attributes and \
+                        ((typ, attr) in self.stored_attributes or is_mutable(attrtyp)):
                     try:
-                        llrpcattrs.append(llrpcattr_of_attr(offset, attr, attrtyp))
+                        attrtag = ir.rpc_tag(attrtyp, error_handler=rpc_tag_error)
                     except ValueError:
                         pass
+                    else:
+                        llname = ll.GlobalVariable(self.llmodule, llslice,
+                                                   name="N.{}.{}".format(typ.name, attr))
+                        llname.initializer = self.llconst_of_const(
+                            ir.Constant(attr, builtins.TStr()))
+                        llname.global_constant = True
+                        llname.unnamed_addr = True
+                        llname.linkage = 'private'
+                        llattrs.append((offset, attrtag, llname.bitcast(llptr)))
 
                 offset += size
 
-            if len(llrpcattrs) == 1:
-                # Don't bother serializing objects that only have __objectid__
-                # since there's nothing to writeback anyway.
+            if not llattrs:
                 continue
 
-            llrpcattraryty = ll.ArrayType(llrpcattrty.as_pointer(), len(llrpcattrs) + 1)
-            llrpcattrary = ll.GlobalVariable(self.llmodule, llrpcattraryty,
-                                             name="Ax.{}".format(type_name))
-            llrpcattrary.initializer = ll.Constant(llrpcattraryty,
-                llrpcattrs + [ll.Constant(llrpcattrty.as_pointer(), None)])
-            llrpcattrary.global_constant = True
-            llrpcattrary.unnamed_addr = True
-            llrpcattrary.linkage = 'private'
-
-            llobjectaryty = ll.ArrayType(llptr, len(llobjects[typ]) + 1)
+            llobjectaryty = ll.ArrayType(llptr, len(llobjects[typ]))
             llobjectary = ll.GlobalVariable(self.llmodule, llobjectaryty,
-                                            name="Ox.{}".format(type_name))
-            llobjectary.initializer = ll.Constant(llobjectaryty,
-                llobjects[typ] + [ll.Constant(llptr, None)])
+                                            name="Ox.I.{}".format(typ.name))
+            llobjectary.initializer = ll.Constant(llobjectaryty, llobjects[typ])
+            llobjectary.global_constant = True
             llobjectary.linkage = 'private'
 
-            lldesc = ll.GlobalVariable(self.llmodule, lldescty,
-                                       name="D.{}".format(type_name))
-            lldesc.initializer = ll.Constant(lldescty, [
-                llrpcattrary.bitcast(llrpcattrty.as_pointer().as_pointer()),
-                llobjectary.bitcast(llptr.as_pointer())
-            ])
-            lldesc.global_constant = True
-            lldesc.linkage = 'private'
-            lldescs.append(lldesc)
-
-        llglobaldescty = ll.ArrayType(lldescty.as_pointer(), len(lldescs) + 1)
-        llglobaldesc = ll.GlobalVariable(self.llmodule, llglobaldescty,
-                                         name="typeinfo")
-        llglobaldesc.initializer = ll.Constant(llglobaldescty,
-            lldescs + [ll.Constant(lldescty.as_pointer(), None)])
+            for index, llobject in enumerate(llobjects[typ]):
+                llobjectref = llobjectary.gep([self.llindex(0), self.llindex(index)])
+                for offset, attrtag, llname in llattrs:
+                    rpctag += b"Os" + attrtag
+                    llargs += [llobjectref.bitcast(llptr), llname,
+                               llobject.gep([self.llindex(offset)])]
+
+        if not llargs:
+            return
+
+        llargaryty = ll.ArrayType(llptr, len(llargs))
+        llargary = ll.GlobalVariable(self.llmodule, llargaryty, name="Wx")
+        llargary.initializer = ll.Constant(llargaryty, llargs)
+        llargary.global_constant = True
+        llargary.linkage = 'private'
+
+        llwritebackty = ll.LiteralStructType([llslice, llptrptr])
+        llwriteback = ll.GlobalVariable(self.llmodule, llwritebackty, name="writeback")
+        llwriteback.initializer = ll.Constant(llwritebackty, [
+            self.llconst_of_const(ir.Constant(rpctag + b":n", builtins.TStr())),
+            llargary.bitcast(llptrptr)
+        ])
+        llwriteback.global_constant = True
 
     def process_function(self, func):
         try:
@@ -1048,6 +1035,8 @@ class LLVMIRGenerator:
 
         if attr in typ.attributes:
             obj = self.map(insn.object())
+            if types.is_instance(typ):
+                self.stored_attributes.add((typ, attr))
         elif attr in typ.constructor.attributes:
             typ = typ.constructor
             obj = self.get_class(typ)
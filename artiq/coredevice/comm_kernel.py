@@ -4,9 +4,14 @@ import traceback
 import numpy
 import socket
 import builtins
+import queue
+import threading
+from contextlib import nullcontext
 from enum import Enum
 from fractions import Fraction
 from collections import namedtuple
+from operator import itemgetter
+from time import monotonic
 
 from artiq.coredevice import exceptions
 from artiq import __version__ as software_version
@@ -63,22 +68,82 @@ def _receive_fraction(kernel, embedding_map):
     return Fraction(numerator, denominator)
 
 
+# Sizes and NumPy types of the scalars in lists of tuples decoded at once.
+_tuple_element_types = {
+    "b": (1, "u1"),
+    "i": (4, "i4"),
+    "I": (8, "i8"),
+    "f": (8, "f8"),
+}
+
+
+def _tuple_list_dtype(kernel):
+    # Returns the structured dtype of the elements of a list of tuples of
+    # scalars, from the first element, or None for other tuples.
+    header = kernel._peek(2)
+    if header[0] != ord("t") or header[1] == 0:
+        return None
+    fields = [("tag", "u1"), ("length", "u1")]
+    offset = 2
+    for index in range(header[1]):
+        tag = chr(kernel._peek(offset + 1)[offset])
+        if tag not in _tuple_element_types:
+            return None
+        size, dtype = _tuple_element_types[tag]
+        fields.append(("tag{}".format(index), "u1"))
+        fields.append((tag + str(index), kernel.endian + dtype))
+        offset += 1 + size
+    return numpy.dtype(fields)
+
+
+def _receive_tuple_list(kernel, length, dtype):
+    elems = numpy.frombuffer(kernel._read(length * dtype.itemsize), dtype)
+    columns = []
+    for index, name in enumerate(dtype.names[3::2]):
+        tag = name[0]
+        if not (elems["tag{}".format(index)] == ord(tag)).all():
+            raise IOError("Inconsistent RPC list elements")
+        column = elems[name]
+        # Same types as the receivers of the individual values.
+        if tag == "b":
+            columns.append((column != 0).tolist())
+        elif tag == "i":
+            columns.append(list(column.astype(numpy.int32)))
+        elif tag == "I":
+            columns.append(list(column.astype(numpy.int64)))
+        else:
+            columns.append(column.astype(float).tolist())
+    if not (elems["length"] == len(columns)).all():
+        raise IOError("Inconsistent RPC list elements")
+    return list(zip(*columns))
+
+
 def _receive_list(kernel, embedding_map):
     length = kernel._read_int32()
     tag = chr(kernel._read_int8())
     if tag == "b":
         buffer = kernel._read(length)
-        return list(struct.unpack(kernel.endian + "%s?" % length, buffer))
+        return numpy.frombuffer(buffer, "?").tolist()
     elif tag == "i":
         buffer = kernel._read(4 * length)
         return list(struct.unpack(kernel.endian + "%sl" % length, buffer))
     elif tag == "I":
         buffer = kernel._read(8 * length)
-        return list(numpy.ndarray((length, ), kernel.endian + 'i8', buffer))
+        return numpy.frombuffer(buffer, kernel.endian + "i8").tolist()
     elif tag == "f":
         buffer = kernel._read(8 * length)
         return list(struct.unpack(kernel.endian + "%sd" % length, buffer))
+    elif tag == "s":
+        elems = []
+        for _ in range(length):
+            kernel._read_int8()
+            elems.append(kernel._read_string())
+        return elems
     else:
+        if tag == "t" and length > 0:
+            dtype = _tuple_list_dtype(kernel)
+            if dtype is not None:
+                return _receive_tuple_list(kernel, length, dtype)
         fn = receivers[tag]
         elems = []
         for _ in range(length):
@@ -94,20 +159,14 @@ def _receive_array(kernel, embedding_map):
     num_dims = kernel._read_int8()
     shape = tuple(kernel._read_int32() for _ in range(num_dims))
     tag = chr(kernel._read_int8())
-    fn = receivers[tag]
-    length = numpy.prod(shape)
     if tag == "b":
-        buffer = kernel._read(length)
-        elems = numpy.ndarray((length, ), '?', buffer)
+        dtype = numpy.dtype('?')
     elif tag == "i":
-        buffer = kernel._read(4 * length)
-        elems = numpy.ndarray((length, ), kernel.endian + 'i4', buffer)
+        dtype = numpy.dtype(kernel.endian + 'i4')
     elif tag == "I":
-        buffer = kernel._read(8 * length)
-        elems = numpy.ndarray((length, ), kernel.endian + 'i8', buffer)
+        dtype = numpy.dtype(kernel.endian + 'i8')
     elif tag == "f":
-        buffer = kernel._read(8 * length)
-        elems = numpy.ndarray((length, ), kernel.endian + 'd', buffer)
+        dtype = numpy.dtype(kernel.endian + 'd')
     else:
         fn = receivers[tag]
         elems = []
@@ -117,7 +176,11 @@ def _receive_array(kernel, embedding_map):
             item = fn(kernel, embedding_map)
             elems.append(item)
         elems = numpy.array(elems)
-    return elems.reshape(shape)
+        return elems.reshape(shape)
+    # receive the elements directly into the memory of the array
+    buffer = numpy.empty(int(numpy.prod(shape)) * dtype.itemsize, numpy.uint8)
+    kernel._read_into(memoryview(buffer))
+    return buffer.view(dtype).reshape(shape)
 
 
 def _receive_range(kernel, embedding_map):
@@ -156,6 +219,288 @@ receivers = {
 }
 
 
+def _type_mismatch(value, expected, root, function):
+    raise RPCReturnValueError(
+        "type mismatch: cannot serialize {value} as {type}"
+        " ({function} has returned {root})".format(
+            value=repr(value), type=expected,
+            function=function, root=root))
+
+
+# Types of the elements of lists of tuples that are serialized at once,
+# with the NumPy types they are converted to and serialized as. Other values
+# (e.g. subclasses) are serialized one by one.
+_packed_tuple_elements = {
+    "b": ({bool}, numpy.bool_, "?"),
+    "i": ({int, numpy.int32}, numpy.int64, "i4"),
+    "I": ({int, numpy.int32, numpy.int64}, numpy.int64, "i8"),
+    "f": ({float, numpy.float64}, numpy.float64, "f8"),
+}
+
+
+def _pack_tuple_list(value, tags, dtype):
+    # Returns the serialized elements of a list of tuples, or None if an
+    # element needs the checks of the general encoder.
+    if not value:
+        return b""
+    if set(map(type, value)) != {tuple} or set(map(len, value)) != {len(tags)}:
+        return None
+    packed = numpy.empty(len(value), dtype)
+    for index, tag in enumerate(tags):
+        types, column_type, _ = _packed_tuple_elements[tag]
+        if not set(map(type, map(itemgetter(index), value))) <= types:
+            return None
+        try:
+            column = numpy.fromiter(map(itemgetter(index), value), column_type, len(value))
+        except OverflowError:
+            return None
+        if tag == "i" and not (-2**31 <= column.min() and column.max() <= 2**31-1):
+            return None
+        packed[dtype.names[index]] = column
+    return packed.tobytes()
+
+
+def _compile_rpc_encoder(tags, endian):
+    """Returns a function serializing values of the type described by the
+    RPC tags (consumed from the ``tags`` bytearray), with the same checks
+    as the device would expect."""
+    tag = chr(tags.pop(0))
+    if tag == "t":
+        length = tags.pop(0)
+        encoders = [_compile_rpc_encoder(tags, endian) for _ in range(length)]
+        def encode(kernel, value, root, function):
+            if not (isinstance(value, tuple) and length == len(value)):
+                _type_mismatch(value, "tuple of {}".format(length), root, function)
+            for encoder, elt in zip(encoders, value):
+                encoder(kernel, elt, root, function)
+    elif tag == "n":
+        def encode(kernel, value, root, function):
+            if value is not None:
+                _type_mismatch(value, "None", root, function)
+    elif tag == "b":
+        def encode(kernel, value, root, function):
+            if not isinstance(value, bool):
+                _type_mismatch(value, "bool", root, function)
+            kernel._write_bool(value)
+    elif tag == "i":
+        def encode(kernel, value, root, function):
+            if not (isinstance(value, (int, numpy.int32)) and
+                    (-2**31 <= value <= 2**31-1)):
+                _type_mismatch(value, "32-bit int", root, function)
+            kernel._write_int32(value)
+    elif tag == "I":
+        def encode(kernel, value, root, function):
+            if not (isinstance(value, (int, numpy.int32, numpy.int64)) and
+                    (-2**63 <= value <= 2**63-1)):
+                _type_mismatch(value, "64-bit int", root, function)
+            kernel._write_int64(value)
+    elif tag == "f":
+        def encode(kernel, value, root, function):
+            if not isinstance(value, float):
+                _type_mismatch(value, "float", root, function)
+            kernel._write_float64(value)
+    elif tag == "F":
+        def encode(kernel, value, root, function):
+            if not (isinstance(value, Fraction) and
+                    (-2**63 <= value.numerator <= 2**63-1) and
+                    (-2**63 <= value.denominator <= 2**63-1)):
+                _type_mismatch(value, "64-bit Fraction", root, function)
+            kernel._write_int64(value.numerator)
+            kernel._write_int64(value.denominator)
+    elif tag == "s":
+        def encode(kernel, value, root, function):
+            if not (isinstance(value, str) and "\x00" not in value):
+                _type_mismatch(value, "str", root, function)
+            kernel._write_string(value)
+    elif tag == "B":
+        def encode(kernel, value, root, function):
+            if not isinstance(value, bytes):
+                _type_mismatch(value, "bytes", root, function)
+            kernel._write_bytes(value)
+    elif tag == "A":
+        def encode(kernel, value, root, function):
+            if not isinstance(value, bytearray):
+                _type_mismatch(value, "bytearray", root, function)
+            kernel._write_bytes(value)
+    elif tag == "l":
+        tag_element = chr(tags[0])
+        tuple_tags = bytes(tags[2:2 + tags[1]]) if tag_element == "t" else b""
+        encode_element = _compile_rpc_encoder(tags, endian)
+        if tag_element == "b":
+            def encode_elements(kernel, value, root, function):
+                kernel._write(bytes(value))
+        elif tag_element == "i":
+            def encode_elements(kernel, value, root, function):
+                try:
+                    kernel._write(struct.pack(endian + "%sl" % len(value), *value))
+                except struct.error:
+                    raise RPCReturnValueError(
+                        "type mismatch: cannot serialize {value} as {type}".format(
+                            value=repr(value), type="32-bit integer list"))
+        elif tag_element == "I":
+            def encode_elements(kernel, value, root, function):
+                try:
+                    kernel._write(struct.pack(endian + "%sq" % len(value), *value))
+                except struct.error:
+                    raise RPCReturnValueError(
+                        "type mismatch: cannot serialize {value} as {type}".format(
+                            value=repr(value), type="64-bit integer list"))
+        elif tag_element == "f":
+            def encode_elements(kernel, value, root, function):
+                kernel._write(struct.pack(endian + "%sd" % len(value), *value))
+        elif tuple_tags and all(chr(t) in _packed_tuple_elements for t in tuple_tags):
+            tuple_tags = tuple_tags.decode()
+            dtype = numpy.dtype([(str(index), endian + _packed_tuple_elements[tag][2])
+                                 for index, tag in enumerate(tuple_tags)])
+            def encode_elements(kernel, value, root, function):
+                data = _pack_tuple_list(value, tuple_tags, dtype)
+                if data is None:
+                    for elt in value:
+                        encode_element(kernel, elt, root, function)
+                else:
+                    kernel._write(data)
+        else:
+            def encode_elements(kernel, value, root, function):
+                for elt in value:
+                    encode_element(kernel, elt, root, function)
+        def encode(kernel, value, root, function):
+            if not isinstance(value, list):
+                _type_mismatch(value, "list", root, function)
+            kernel._write_int32(len(value))
+            encode_elements(kernel, value, root, function)
+    elif tag == "a":
+        num_dims = tags.pop(0)
+        tag_element = chr(tags[0])
+        encode_element = _compile_rpc_encoder(tags, endian)
+        dtype = {
+            "i": endian + "i4",
+            "I": endian + "i8",
+            "f": endian + "d",
+        }.get(tag_element)
+        def encode(kernel, value, root, function):
+            if not isinstance(value, numpy.ndarray):
+                _type_mismatch(value, "numpy.ndarray", root, function)
+            if num_dims != len(value.shape):
+                _type_mismatch(value, "{}-dimensional numpy.ndarray".format(num_dims),
+                               root, function)
+            for s in value.shape:
+                kernel._write_int32(s)
+            if tag_element == "b":
+                kernel._write(value.reshape((-1,), order="C").tobytes())
+            elif dtype is not None:
+                array = value.reshape((-1,), order="C").astype(dtype)
+                kernel._write(array.tobytes())
+            else:
+                for elt in value.reshape((-1,), order="C"):
+                    encode_element(kernel, elt, root, function)
+    elif tag == "r":
+        encode_element = _compile_rpc_encoder(tags, endian)
+        def encode(kernel, value, root, function):
+            if not isinstance(value, range):
+                _type_mismatch(value, "range", root, function)
+            encode_element(kernel, value.start, root, function)
+            encode_element(kernel, value.stop, root, function)
+            encode_element(kernel, value.step, root, function)
+    else:
+        raise IOError("Unknown RPC value tag: {}".format(repr(tag)))
+    return encode
+
+
+# Encoders of RPC return values, by return tags and endianness.
+_rpc_encoders = {}
+
+
+def _write_back_attributes(*args):
+    # attribute writeback: (object, name, value) triples of arguments
+    for index in range(0, len(args), 3):
+        setattr(args[index], args[index + 1], args[index + 2])
+
+
+class AsyncRPCQueue:
+    """Serves asynchronous RPCs in order on a separate thread, so that slow
+    services do not stall reading from the core device.
+
+    Synchronous RPCs, exceptions and the end of the kernel wait for all
+    queued RPCs to be served. If an RPC raises an exception, the following
+    ones are dropped and the exception is raised by :meth:`join`.
+
+    :param size: maximum number of queued RPCs. When the queue is full,
+        reading from the core device waits for the oldest RPC to be served.
+
+    The metrics below are accumulated over all kernels.
+
+    :ivar count: number of RPCs queued.
+    :ivar max_depth: maximum number of RPCs waiting in the queue.
+    :ivar full_time: total time spent waiting for room in the full queue,
+        in seconds.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.count = 0
+        self.max_depth = 0
+        self.full_time = 0.0
+        self._queue = None
+        self._thread = None
+        self._error = None
+        self._dropping = False
+
+    def depth(self):
+        """Returns the number of RPCs waiting in the queue."""
+        return 0 if self._queue is None else self._queue.qsize()
+
+    def start(self):
+        self._queue = queue.Queue(self.size)
+        self._error = None
+        self._dropping = False
+        self._thread = threading.Thread(target=self._serve, name="async RPCs",
+                                        daemon=True)
+        self._thread.start()
+
+    def _serve(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                if self._error is None and not self._dropping:
+                    service, args, kwargs = item
+                    try:
+                        service(*args, **kwargs)
+                    except Exception as exn:
+                        self._error = exn
+            finally:
+                self._queue.task_done()
+
+    def put(self, service, args, kwargs):
+        if self._error is not None:
+            self.join()
+        item = (service, args, kwargs)
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            t0 = monotonic()
+            self._queue.put(item)
+            self.full_time += monotonic() - t0
+        self.count += 1
+        self.max_depth = max(self.max_depth, self._queue.qsize())
+
+    def join(self):
+        """Waits for all queued RPCs to be served, and raises the exception
+        of the RPC that failed, if any."""
+        self._queue.join()
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def stop(self):
+        """Drops the RPCs still queued and stops the thread."""
+        self._dropping = True
+        self._queue.put(None)
+        self._thread.join()
+        self._queue = None
+        self._thread = None
+
+
 class CommKernelDummy:
     def __init__(self):
         pass
@@ -163,6 +508,9 @@ class CommKernelDummy:
     def load(self, kernel_library):
         pass
 
+    def upload_subkernel(self, kernel_library, id, destination):
+        pass
+
     def run(self):
         pass
 
@@ -186,11 +534,24 @@ def incompatible_versions(v1, v2):
 class CommKernel:
     warned_of_mismatch = False
 
-    def __init__(self, host, port=1381):
+    # Reads that do not fit in the read buffer are received directly into
+    # a buffer of their own.
+    read_buffer_size = 65536
+
+    def __init__(self, host, port=1381, async_rpc_queue=0):
         self._read_type = None
         self.host = host
         self.port = port
-        self.read_buffer = bytearray()
+        # Asynchronous RPCs are served inline unless a queue size is given.
+        self.async_rpcs = AsyncRPCQueue(async_rpc_queue) if async_rpc_queue > 0 else None
+        # Records the time spent in RPCs if set, see artiq.coredevice.profiler.
+        self.profiler = None
+        # Data between read_start and read_end has been received but not
+        # consumed yet.
+        self.read_buffer = bytearray(self.read_buffer_size)
+        self.read_view = memoryview(self.read_buffer)
+        self.read_start = 0
+        self.read_end = 0
         self.write_buffer = bytearray()
 
 
@@ -206,9 +567,9 @@ class CommKernel:
             self.endian = ">"
         else:
             raise IOError("Incorrect reply from device: expected e/E.")
-        self.unpack_int32 = struct.Struct(self.endian + "l").unpack
-        self.unpack_int64 = struct.Struct(self.endian + "q").unpack
-        self.unpack_float64 = struct.Struct(self.endian + "d").unpack
+        self.unpack_int32_from = struct.Struct(self.endian + "l").unpack_from
+        self.unpack_int64_from = struct.Struct(self.endian + "q").unpack_from
+        self.unpack_float64_from = struct.Struct(self.endian + "d").unpack_from
 
         self.pack_header = struct.Struct(self.endian + "lB").pack
         self.pack_int8 = struct.Struct(self.endian + "B").pack
@@ -221,27 +582,58 @@ class CommKernel:
             return
         self.socket.close()
         del self.socket
+        self.read_start = self.read_end = 0
         logger.debug("disconnected")
 
     #
     # Reader interface
     #
 
+    def _recv_into(self, view, flags=0):
+        received = self.socket.recv_into(view, 0, flags)
+        if not received:
+            raise ConnectionResetError("Core device connection closed unexpectedly")
+        return received
+
+    def _fill(self, length):
+        # make the next `length` bytes available in the read buffer
+        if self.read_end - self.read_start >= length:
+            return
+        if self.read_start + length > len(self.read_buffer):
+            available = self.read_end - self.read_start
+            self.read_view[:available] = self.read_view[self.read_start:self.read_end]
+            self.read_start, self.read_end = 0, available
+        while self.read_end - self.read_start < length:
+            missing = self.read_start + length - self.read_end
+            if missing > 8192:
+                self.read_end += self._recv_into(
+                    self.read_view[self.read_end:self.read_start + length],
+                    socket.MSG_WAITALL)
+            else:
+                # when there is not much data, this returns early
+                self.read_end += self._recv_into(self.read_view[self.read_end:])
+
+    def _read_into(self, view):
+        length = len(view)
+        received = min(length, self.read_end - self.read_start)
+        view[:received] = self.read_view[self.read_start:self.read_start + received]
+        self.read_start += received
+        while received < length:
+            received += self._recv_into(view[received:], socket.MSG_WAITALL)
+
+    def _peek(self, length):
+        self._fill(length)
+        return self.read_buffer[self.read_start:self.read_start + length]
+
     def _read(self, length):
-        # cache the reads to avoid frequent call to recv
-        while len(self.read_buffer) < length:
-            # the number is just the maximum amount
-            # when there is not much data, it would return earlier
-            diff = length - len(self.read_buffer)
-            flag = 0
-            if diff > 8192:
-                flag |= socket.MSG_WAITALL
-            new_buffer = self.socket.recv(8192, flag)
-            if not new_buffer:
-                raise ConnectionResetError("Core device connection closed unexpectedly")
-            self.read_buffer += new_buffer
-        result = self.read_buffer[:length]
-        self.read_buffer = self.read_buffer[length:]
+        if length > len(self.read_buffer):
+            result = bytearray(length)
+            self._read_into(memoryview(result))
+            return result
+
+        self._fill(length)
+        result = self.read_buffer[self.read_start:self.read_start + length]
+        self.read_start += length
         return result
 
     def _read_header(self):
@@ -250,14 +642,14 @@ class CommKernel:
         # Wait for a synchronization sequence, 5a 5a 5a 5a.
         sync_count = 0
         while sync_count < 4:
-            sync_byte = self._read(1)[0]
+            sync_byte = self._read_int8()
             if sync_byte == 0x5a:
                 sync_count += 1
             else:
                 sync_count = 0
 
         # Read message header.
-        raw_type = self._read(1)[0]
+        raw_type = self._read_int8()
         self._read_type = Reply(raw_type)
 
         logger.debug("receiving message: type=%r",
@@ -273,18 +665,31 @@ class CommKernel:
         self._read_expect(ty)
 
     def _read_int8(self):
-        return self._read(1)[0]
+        if self.read_end - self.read_start < 1:
+            self._fill(1)
+        value = self.read_buffer[self.read_start]
+        self.read_start += 1
+        return value
 
     def _read_int32(self):
-        (value, ) = self.unpack_int32(self._read(4))
+        if self.read_end - self.read_start < 4:
+            self._fill(4)
+        (value, ) = self.unpack_int32_from(self.read_buffer, self.read_start)
+        self.read_start += 4
         return value
 
     def _read_int64(self):
-        (value, ) = self.unpack_int64(self._read(8))
+        if self.read_end - self.read_start < 8:
+            self._fill(8)
+        (value, ) = self.unpack_int64_from(self.read_buffer, self.read_start)
+        self.read_start += 8
         return value
 
     def _read_float64(self):
-        (value, ) = self.unpack_float64(self._read(8))
+        if self.read_end - self.read_start < 8:
+            self._fill(8)
+        (value, ) = self.unpack_float64_from(self.read_buffer, self.read_start)
+        self.read_start += 8
         return value
 
     def _read_bool(self):
@@ -425,147 +830,13 @@ class CommKernel:
             else:
                 args.append(value)
 
-    def _skip_rpc_value(self, tags):
-        tag = chr(tags.pop(0))
-        if tag == "t":
-            length = tags.pop(0)
-            for _ in range(length):
-                self._skip_rpc_value(tags)
-        elif tag == "l":
-            self._skip_rpc_value(tags)
-        elif tag == "r":
-            self._skip_rpc_value(tags)
-        elif tag == "a":
-            _ndims = tags.pop(0)
-            self._skip_rpc_value(tags)
-        else:
-            pass
-
     def _send_rpc_value(self, tags, value, root, function):
-        def check(cond, expected):
-            if not cond:
-                raise RPCReturnValueError(
-                    "type mismatch: cannot serialize {value} as {type}"
-                    " ({function} has returned {root})".format(
-                        value=repr(value), type=expected(),
-                        function=function, root=root))
-
-        tag = chr(tags.pop(0))
-        if tag == "t":
-            length = tags.pop(0)
-            check(isinstance(value, tuple) and length == len(value),
-                  lambda: "tuple of {}".format(length))
-            for elt in value:
-                self._send_rpc_value(tags, elt, root, function)
-        elif tag == "n":
-            check(value is None,
-                  lambda: "None")
-        elif tag == "b":
-            check(isinstance(value, bool),
-                  lambda: "bool")
-            self._write_bool(value)
-        elif tag == "i":
-            check(isinstance(value, (int, numpy.int32)) and
-                  (-2**31 <= value <= 2**31-1),
-                  lambda: "32-bit int")
-            self._write_int32(value)
-        elif tag == "I":
-            check(isinstance(value, (int, numpy.int32, numpy.int64)) and
-                  (-2**63 <= value <= 2**63-1),
-                  lambda: "64-bit int")
-            self._write_int64(value)
-        elif tag == "f":
-            check(isinstance(value, float),
-                  lambda: "float")
-            self._write_float64(value)
-        elif tag == "F":
-            check(isinstance(value, Fraction) and
-                  (-2**63 <= value.numerator <= 2**63-1) and
-                  (-2**63 <= value.denominator <= 2**63-1),
-                  lambda: "64-bit Fraction")
-            self._write_int64(value.numerator)
-            self._write_int64(value.denominator)
-        elif tag == "s":
-            check(isinstance(value, str) and "\x00" not in value,
-                  lambda: "str")
-            self._write_string(value)
-        elif tag == "B":
-            check(isinstance(value, bytes),
-                  lambda: "bytes")
-            self._write_bytes(value)
-        elif tag == "A":
-            check(isinstance(value, bytearray),
-                  lambda: "bytearray")
-            self._write_bytes(value)
-        elif tag == "l":
-            check(isinstance(value, list),
-                  lambda: "list")
-            self._write_int32(len(value))
-            tag_element = chr(tags[0])
-            if tag_element == "b":
-                self._write(bytes(value))
-            elif tag_element == "i":
-                try:
-                    self._write(struct.pack(self.endian + "%sl" % len(value), *value))
-                except struct.error:
-                    raise RPCReturnValueError(
-                        "type mismatch: cannot serialize {value} as {type}".format(
-                            value=repr(value), type="32-bit integer list"))
-            elif tag_element == "I":
-                try:
-                    self._write(struct.pack(self.endian + "%sq" % len(value), *value))
-                except struct.error:
-                    raise RPCReturnValueError(
-                        "type mismatch: cannot serialize {value} as {type}".format(
-                            value=repr(value), type="64-bit integer list"))
-            elif tag_element == "f":
-                self._write(struct.pack(self.endian + "%sd" %
-                                        len(value), *value))
-            else:
-                for elt in value:
-                    tags_copy = bytearray(tags)
-                    self._send_rpc_value(tags_copy, elt, root, function)
-            self._skip_rpc_value(tags)
-        elif tag == "a":
-            check(isinstance(value, numpy.ndarray),
-                  lambda: "numpy.ndarray")
-            num_dims = tags.pop(0)
-            check(num_dims == len(value.shape),
-                  lambda: "{}-dimensional numpy.ndarray".format(num_dims))
-            for s in value.shape:
-                self._write_int32(s)
-            tag_element = chr(tags[0])
-            if tag_element == "b":
-                self._write(value.reshape((-1,), order="C").tobytes())
-            elif tag_element == "i":
-                array = value.reshape(
-                    (-1,), order="C").astype(self.endian + 'i4')
-                self._write(array.tobytes())
-            elif tag_element == "I":
-                array = value.reshape(
-                    (-1,), order="C").astype(self.endian + 'i8')
-                self._write(array.tobytes())
-            elif tag_element == "f":
-                array = value.reshape(
-                    (-1,), order="C").astype(self.endian + 'd')
-                self._write(array.tobytes())
-            else:
-                for elt in value.reshape((-1,), order="C"):
-                    tags_copy = bytearray(tags)
-                    self._send_rpc_value(tags_copy, elt, root, function)
-            self._skip_rpc_value(tags)
-        elif tag == "r":
-            check(isinstance(value, range),
-                  lambda: "range")
-            tags_copy = bytearray(tags)
-            self._send_rpc_value(tags_copy, value.start, root, function)
-            tags_copy = bytearray(tags)
-            self._send_rpc_value(tags_copy, value.stop, root, function)
-            tags_copy = bytearray(tags)
-            self._send_rpc_value(tags_copy, value.step, root, function)
-            tags = tags_copy
-        else:
-            raise IOError("Unknown RPC value tag: {}".format(repr(tag)))
+        key = (bytes(tags), self.endian)
+        encoder = _rpc_encoders.get(key)
+        if encoder is None:
+            encoder = _compile_rpc_encoder(bytearray(tags), self.endian)
+            _rpc_encoders[key] = encoder
+        encoder(self, value, root, function)
 
     def _truncate_message(self, msg, limit=4096):
         if len(msg) > limit:
@@ -573,6 +844,11 @@ class CommKernel:
         else:
             return msg
 
+    def _rpc_span(self, service_id, service):
+        if self.profiler is None:
+            return nullcontext()
+        return self.profiler.rpc_span(service_id, service)
+
     def _serve_rpc(self, embedding_map):
         is_async = self._read_bool()
         service_id = self._read_int32()
@@ -580,18 +856,26 @@ class CommKernel:
         return_tags = self._read_bytes()
 
         if service_id == 0:
-            def service(obj, attr, value): return setattr(obj, attr, value)
+            service = _write_back_attributes
         else:
             service = embedding_map.retrieve_object(service_id)
         logger.debug("rpc service: [%d]%r%s %r %r -> %s", service_id, service,
                      (" (async)" if is_async else ""), args, kwargs, return_tags)
 
         if is_async:
-            service(*args, **kwargs)
+            if self.async_rpcs is not None:
+                if self.profiler is not None:
+                    service = self.profiler.wrap_rpc(service_id, service)
+                self.async_rpcs.put(service, args, kwargs)
+            else:
+                with self._rpc_span(service_id, service):
+                    service(*args, **kwargs)
             return
 
+        self._join_async_rpcs()
         try:
-            result = service(*args, **kwargs)
+            with self._rpc_span(service_id, service):
+                result = service(*args, **kwargs)
         except RPCReturnValueError as exn:
             raise
         except Exception as exn:
@@ -648,8 +932,7 @@ class CommKernel:
                          service_id, args, kwargs, result)
             self._write_header(Request.RPCReply)
             self._write_bytes(return_tags)
-            self._send_rpc_value(bytearray(return_tags),
-                                 result, result, service)
+            self._send_rpc_value(return_tags, result, result, service)
             self._flush()
 
     def _serve_exception(self, embedding_map, symbolizer, demangler):
@@ -725,16 +1008,29 @@ class CommKernel:
             logger.warning(f"{(', '.join(errors[:-1]) + ' and ') if len(errors) > 1 else ''}{errors[-1]} "
                            f"reported during kernel execution")
 
+    def _join_async_rpcs(self):
+        if self.async_rpcs is not None:
+            self.async_rpcs.join()
+
     def serve(self, embedding_map, symbolizer, demangler):
-        while True:
-            self._read_header()
-            if self._read_type == Reply.RPCRequest:
-                self._serve_rpc(embedding_map)
-            elif self._read_type == Reply.KernelException:
-                self._serve_exception(embedding_map, symbolizer, demangler)
-            elif self._read_type == Reply.ClockFailure:
-                raise exceptions.ClockFailure
-            else:
-                self._read_expect(Reply.KernelFinished)
-                self._process_async_error()
-                return
+        if self.async_rpcs is not None:
+            self.async_rpcs.start()
+        try:
+            while True:
+                self._read_header()
+                if self._read_type == Reply.RPCRequest:
+                    self._serve_rpc(embedding_map)
+                elif self._read_type == Reply.KernelException:
+                    self._join_async_rpcs()
+                    self._serve_exception(embedding_map, symbolizer, demangler)
+                elif self._read_type == Reply.ClockFailure:
+                    self._join_async_rpcs()
+                    raise exceptions.ClockFailure
+                else:
+                    self._read_expect(Reply.KernelFinished)
+                    self._join_async_rpcs()
+                    self._process_async_error()
+                    return
+        finally:
+            if self.async_rpcs is not None:
+                self.async_rpcs.stop()
@@ -1,5 +1,10 @@
 import os, sys
+import logging
+import multiprocessing
 import numpy
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import nullcontext
 from inspect import getfullargspec
 from functools import wraps
 
@@ -13,13 +18,17 @@ from artiq.language.units import *
 
 from artiq.compiler.module import Module
 from artiq.compiler.embedding import Stitcher
+from artiq.compiler import kernel_cache
 from artiq.compiler.targets import RV32IMATarget, RV32GTarget, CortexA9Target
 
 from artiq.coredevice.comm_kernel import CommKernel, CommKernelDummy
+from artiq.coredevice.profiler import KernelProfiler
 # Import for side effects (creating the exception classes).
 from artiq.coredevice import exceptions
 
 
+logger = logging.getLogger(__name__)
+
 def _render_diagnostic(diagnostic, colored):
     def shorten_path(path):
         return path.replace(artiq_dir, "<artiq>")
@@ -28,7 +37,12 @@ def _render_diagnostic(diagnostic, colored):
 
 colors_supported = os.name == "posix"
 class _DiagnosticEngine(diagnostic.Engine):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.rendered = 0
+
     def render_diagnostic(self, diagnostic):
+        self.rendered += 1
         sys.stderr.write(_render_diagnostic(diagnostic, colored=colors_supported) + "\n")
 
 class CompileError(Exception):
@@ -67,6 +81,36 @@ def get_target_cls(target):
     else:
         raise ValueError("Unsupported target")
 
+def _build_subkernel(target_cls, subkernel_id, llmodule):
+    return target_cls(subkernel_id=subkernel_id).build_library(llmodule)
+
+# Worker processes generating the machine code of subkernels, started on demand
+# and kept until the core device is closed.
+_subkernel_executor = None
+_subkernel_max_workers = 4
+
+def _can_spawn():
+    # Spawned processes import the main module again, which would run the code
+    # of a script that is not guarded by ``if __name__ == "__main__":``. Only
+    # modules run by name (e.g. the master worker) or interactive sessions are
+    # known to be safe.
+    main_module = sys.modules["__main__"]
+    return (getattr(main_module, "__spec__", None) is not None
+            or getattr(main_module, "__file__", None) is None)
+
+def _get_subkernel_executor():
+    global _subkernel_executor
+    if _subkernel_executor is None and _can_spawn():
+        _subkernel_executor = ProcessPoolExecutor(
+            max_workers=min(_subkernel_max_workers, os.cpu_count() or 1),
+            mp_context=multiprocessing.get_context("spawn"))
+    return _subkernel_executor
+
+def _shutdown_subkernel_executor():
+    global _subkernel_executor
+    if _subkernel_executor is not None:
+        _subkernel_executor.shutdown(cancel_futures=True)
+        _subkernel_executor = None
 
 class Core:
     """Core device driver.
@@ -87,6 +131,17 @@ class Core:
         proxy after the Experiment's run stage finishes.
     :param report_invariants: report variables which are not changed inside
         kernels and are thus candidates for inclusion in kernel_invariants
+    :param kernel_cache: reuse the compiled kernel when a kernel is compiled
+        again with the same code, types and embedded values. Compiled kernels
+        are kept in memory, and in the directory given by the
+        ``ARTIQ_KERNEL_CACHE`` environment variable if it is set.
+    :param async_rpc_queue: if nonzero, serve asynchronous RPCs in order on a
+        separate thread, with at most this many RPCs queued, so that slow RPCs
+        do not stall the kernel. Metrics of the queue are available as
+        ``core.comm.async_rpcs``.
+    :param profile: record the time spent launching and running kernels in
+        ``core.profiler`` (a :class:`~artiq.coredevice.profiler.KernelProfiler`),
+        which is saved in the ``kernel_profile`` group of the results file.
     """
 
     kernel_invariants = {
@@ -98,7 +153,8 @@ class Core:
                  analyzer_proxy=None, analyze_at_run_end=False,
                  ref_multiplier=8,
                  target="rv32g", satellite_cpu_targets={},
-                 report_invariants=False):
+                 report_invariants=False, kernel_cache=True,
+                 async_rpc_queue=0, profile=False):
         self.ref_period = ref_period
         self.ref_multiplier = ref_multiplier
         self.satellite_cpu_targets = satellite_cpu_targets
@@ -107,48 +163,127 @@ class Core:
         if host is None:
             self.comm = CommKernelDummy()
         else:
-            self.comm = CommKernel(host)
+            self.comm = CommKernel(host, async_rpc_queue=async_rpc_queue)
         self.analyzer_proxy_name = analyzer_proxy
         self.analyze_at_run_end = analyze_at_run_end
         self.report_invariants = report_invariants
+        self.kernel_cache = kernel_cache
 
         self.first_run = True
         self.dmgr = dmgr
         self.core = self
         self.comm.core = self
+        self.profiler = KernelProfiler() if profile else None
+        self.comm.profiler = self.profiler
         self.analyzer_proxy = None
 
     def notify_run_end(self):
         if self.analyze_at_run_end:
             self.trigger_analyzer_proxy()
 
+    def write_results(self, f):
+        if self.profiler is not None:
+            self.profiler.write_hdf5(f.create_group("kernel_profile"))
+
     def close(self):
         """Disconnect core device and close sockets. 
         """
         self.comm.close()
+        _shutdown_subkernel_executor()
+        hit_rate = kernel_cache.cache.hit_rate()
+        if hit_rate is not None:
+            logger.debug("kernel cache hit rate: %.0f%% (%d hits, %d misses)",
+                         100*hit_rate, kernel_cache.cache.hits,
+                         kernel_cache.cache.misses)
+
+    def _kernel_cache_key(self, stitcher, target, old_embedding_map, **options):
+        if (self.report_invariants or old_embedding_map is not None
+                or any(var.startswith("ARTIQ_DUMP_") for var in os.environ)):
+            return None, None
+        try:
+            digest = kernel_cache.KernelDigest(stitcher)
+        except kernel_cache.Uncacheable as error:
+            logger.debug("kernel not cacheable: %s", error)
+            return None, None
+        key = kernel_cache.kernel_key(digest, target, stitcher.embedding_map,
+                                      ref_period=self.ref_period, **options)
+        return digest, key
+
+    def _stitch(self, engine, function, args, kwargs, set_result,
+                print_as_rpc, destination, subkernel_arg_types, old_embedding_map):
+        stitcher = Stitcher(engine=engine, core=self, dmgr=self.dmgr,
+                            print_as_rpc=print_as_rpc,
+                            destination=destination, subkernel_arg_types=subkernel_arg_types,
+                            old_embedding_map=old_embedding_map)
+        with self._span("Stitching", "compile"):
+            stitcher.stitch_call(function, args, kwargs, set_result)
+        with self._span("Inference", "compile"):
+            stitcher.finalize()
+        return stitcher
+
+    def _span(self, name, category):
+        if self.profiler is None:
+            return nullcontext()
+        return self.profiler.span(name, category)
 
     def compile(self, function, args, kwargs, set_result=None,
                 attribute_writeback=True, print_as_rpc=True,
                 target=None, destination=0, subkernel_arg_types=[],
-                old_embedding_map=None):
+                old_embedding_map=None, cache=None, pass_manager=None):
+        # Kernels are not taken from the cache when the passes are to be run.
+        if cache is None and self.kernel_cache and pass_manager is None:
+            cache = kernel_cache.cache
         try:
             engine = _DiagnosticEngine(all_errors_are_fatal=True)
 
-            stitcher = Stitcher(engine=engine, core=self, dmgr=self.dmgr,
-                                print_as_rpc=print_as_rpc,
-                                destination=destination, subkernel_arg_types=subkernel_arg_types,
-                                old_embedding_map=old_embedding_map)
-            stitcher.stitch_call(function, args, kwargs, set_result)
-            stitcher.finalize()
+            stitcher = self._stitch(engine, function, args, kwargs, set_result,
+                                    print_as_rpc, destination, subkernel_arg_types,
+                                    old_embedding_map)
+            target = target if target is not None else self.target_cls()
+
+            digest, cache_key = None, None
+            if cache is not None:
+                digest, cache_key = self._kernel_cache_key(
+                    stitcher, target, old_embedding_map,
+                    attribute_writeback=attribute_writeback,
+                    print_as_rpc=print_as_rpc, destination=destination)
+            if cache_key is not None:
+                with self._span("Kernel cache lookup", "compile"):
+                    cached = cache.get(cache_key)
+                if cached is not None:
+                    cached.restore(digest, stitcher.embedding_map)
+                    return stitcher.embedding_map, cached.stripped_library, \
+                           lambda addresses: target.symbolize(cached.library, addresses), \
+                           lambda symbols: target.demangle(symbols), \
+                           {}
+                snapshot = kernel_cache.CachedKernel.snapshot(stitcher.embedding_map)
+                rendered = engine.rendered
 
             module = Module(stitcher,
                 ref_period=self.ref_period,
                 attribute_writeback=attribute_writeback,
-                remarks=self.report_invariants)
-            target = target if target is not None else self.target_cls()
-
-            library = target.compile_and_link([module])
-            stripped_library = target.strip(library)
+                remarks=self.report_invariants,
+                pass_manager=pass_manager)
+
+            timings = [] if self.profiler is not None else None
+            target.timings = timings
+            try:
+                library = target.compile_and_link([module])
+                stripped_library = target.strip(library)
+            finally:
+                target.timings = None
+            if timings is not None:
+                self.profiler.add_timings(module.pass_manager.timings, "compile")
+                self.profiler.add_timings(timings, "compile")
+
+            # Kernels whose compilation printed diagnostics are not cached,
+            # so that they are printed again.
+            if cache_key is not None and engine.rendered == rendered:
+                cached = kernel_cache.CachedKernel.record(
+                    digest, snapshot, stitcher.embedding_map,
+                    library, stripped_library)
+                if cached is not None:
+                    cache.put(cache_key, cached)
 
             return stitcher.embedding_map, stripped_library, \
                    lambda addresses: target.symbolize(library, addresses), \
@@ -161,9 +296,12 @@ class Core:
         if self.first_run:
             self.comm.check_system_info()
             self.first_run = False
-        self.comm.load(kernel_library)
-        self.comm.run()
-        self.comm.serve(embedding_map, symbolizer, demangler)
+        with self._span("Upload", "comm"):
+            self.comm.load(kernel_library)
+        with self._span("Start", "comm"):
+            self.comm.run()
+        with self._span("Execution", "comm"):
+            self.comm.serve(embedding_map, symbolizer, demangler)
 
     def run(self, function, args, kwargs):
         result = None
@@ -171,13 +309,16 @@ class Core:
         def set_result(new_result):
             nonlocal result
             result = new_result
-        embedding_map, kernel_library, symbolizer, demangler, subkernel_arg_types = \
-            self.compile(function, args, kwargs, set_result)
-        self.compile_and_upload_subkernels(embedding_map, args, subkernel_arg_types)
-        self._run_compiled(kernel_library, embedding_map, symbolizer, demangler)
+        with self._span("Kernel " + getattr(function, "__qualname__", repr(function)),
+                        "kernel"):
+            embedding_map, kernel_library, symbolizer, demangler, subkernel_arg_types = \
+                self.compile(function, args, kwargs, set_result)
+            with self._span("Subkernels", "compile"):
+                self.compile_and_upload_subkernels(embedding_map, args, subkernel_arg_types)
+            self._run_compiled(kernel_library, embedding_map, symbolizer, demangler)
         return result
 
-    def compile_subkernel(self, sid, subkernel_fn, embedding_map, args, subkernel_arg_types, subkernels):
+    def _generate_subkernel(self, sid, subkernel_fn, embedding_map, args, subkernel_arg_types):
         # pass self to subkernels (if applicable)
         # assuming the first argument is self
         subkernel_args = getfullargspec(subkernel_fn.artiq_embedded.function)
@@ -188,32 +329,102 @@ class Core:
         destination = subkernel_fn.artiq_embedded.destination
         destination_tgt = self.satellite_cpu_targets[destination]
         target = get_target_cls(destination_tgt)(subkernel_id=sid)
-        object_map, kernel_library, _, _, _ = \
-            self.compile(subkernel_fn, self_arg, {}, attribute_writeback=False,
-                        print_as_rpc=False, target=target, destination=destination, 
-                        subkernel_arg_types=subkernel_arg_types.get(sid, []),
-                        old_embedding_map=embedding_map)
-        if object_map.has_rpc():
+        try:
+            engine = _DiagnosticEngine(all_errors_are_fatal=True)
+            stitcher = self._stitch(engine, subkernel_fn, self_arg, {}, None,
+                                    print_as_rpc=False, destination=destination,
+                                    subkernel_arg_types=subkernel_arg_types.get(sid, []),
+                                    old_embedding_map=embedding_map)
+            module = Module(stitcher,
+                ref_period=self.ref_period,
+                attribute_writeback=False,
+                remarks=self.report_invariants)
+            llmodule = target.generate_llvm_ir(module)
+        except diagnostic.Error as error:
+            raise CompileError(error.diagnostic) from error
+        if stitcher.embedding_map.has_rpc():
             raise ValueError("Subkernel must not use RPC")
-        return destination, kernel_library, object_map
+        return destination, target, stitcher.embedding_map, llmodule
 
-    def compile_and_upload_subkernels(self, embedding_map, args, subkernel_arg_types):
+    def compile_subkernel(self, sid, subkernel_fn, embedding_map, args, subkernel_arg_types, subkernels):
+        destination, target, object_map, llmodule = \
+            self._generate_subkernel(sid, subkernel_fn, embedding_map, args, subkernel_arg_types)
+        return destination, target.build_library(llmodule), object_map
+
+    def compile_subkernels(self, embedding_map, args, subkernel_arg_types):
+        """Compile all subkernels used by a kernel.
+
+        The subkernels are stitched one after another, in a deterministic order
+        that also determines the IDs of the objects they embed. Their machine code
+        is then generated concurrently in worker processes when possible, and
+        in the calling process otherwise.
+
+        Returns the embedding map of the last stitched subkernel and an iterator
+        over ``(sid, destination, library)`` tuples, which yields each subkernel
+        in order as soon as its library is ready.
+        """
+        generated = []
         subkernels = embedding_map.subkernels()
-        subkernels_compiled = []
+        subkernels_compiled = set()
         while True:
             new_subkernels = {}
             for sid, subkernel_fn in subkernels.items():
                 if sid in subkernels_compiled:
                     continue
-                destination, kernel_library, embedding_map = \
-                    self.compile_subkernel(sid, subkernel_fn, embedding_map,
-                                        args, subkernel_arg_types, subkernels)
-                self.comm.upload_subkernel(kernel_library, sid, destination)
+                destination, target, embedding_map, llmodule = \
+                    self._generate_subkernel(sid, subkernel_fn, embedding_map,
+                                             args, subkernel_arg_types)
+                generated.append((sid, destination, target, llmodule))
                 new_subkernels.update(embedding_map.subkernels())
-                subkernels_compiled.append(sid)
+                subkernels_compiled.add(sid)
             if new_subkernels == subkernels:
                 break
             subkernels.update(new_subkernels)
+        return embedding_map, self._build_subkernels(generated)
+
+    def _build_subkernels(self, generated):
+        executor = None
+        # Worker processes would interleave the dumps of different subkernels.
+        if (len(generated) > 1 and (os.cpu_count() or 1) > 1 and
+                not any(var.startswith("ARTIQ_DUMP_") for var in os.environ)):
+            executor = _get_subkernel_executor()
+
+        futures = []
+        if executor is not None:
+            try:
+                for sid, destination, target, llmodule in generated:
+                    futures.append(executor.submit(_build_subkernel, type(target),
+                                                   sid, llmodule))
+            except (BrokenProcessPool, OSError) as error:
+                logger.warning("cannot start subkernel compilation workers (%s), "
+                               "compiling in-process", error)
+                _shutdown_subkernel_executor()
+                futures = []
+
+        try:
+            for i, (sid, destination, target, llmodule) in enumerate(generated):
+                library = None
+                if i < len(futures):
+                    try:
+                        library = futures[i].result()
+                    except BrokenProcessPool as error:
+                        logger.warning("subkernel compilation workers terminated (%s), "
+                                       "compiling in-process", error)
+                        _shutdown_subkernel_executor()
+                        futures = []
+                if library is None:
+                    library = target.build_library(llmodule)
+                yield sid, destination, library
+        finally:
+            for future in futures:
+                future.cancel()
+
+    def compile_and_upload_subkernels(self, embedding_map, args, subkernel_arg_types):
+        embedding_map, subkernels = \
+            self.compile_subkernels(embedding_map, args, subkernel_arg_types)
+        # Each library is uploaded while the following ones are still being compiled.
+        for sid, destination, kernel_library in subkernels:
+            self.comm.upload_subkernel(kernel_library, sid, destination)
         # check for messages without a send/recv pair
         unpaired_messages = embedding_map.subkernel_messages_unpaired()
         if unpaired_messages:
@@ -259,6 +470,29 @@ class Core:
 
         The callable may be called several times.
         """
+        return self._precompile(function, args, kwargs)
+
+    def precompile_cached(self, filename, function, *args, **kwargs):
+        """Precompile a kernel like :meth:`precompile`, and store the compiled
+        kernel in ``filename`` so that later runs (e.g. in other worker
+        processes) can reuse it.
+
+        If ``filename`` holds a kernel, the kernel is stitched with the current
+        host objects and arguments, and the stored kernel is only used if its code,
+        types and embedded values, as well as the compiler and the target, are
+        unchanged. Otherwise, the kernel is compiled again and ``filename`` is
+        replaced.
+
+        Kernels that use subkernels are compiled every time.
+        """
+        kernel_file = kernel_cache.KernelFile(filename)
+        run_precompiled = self._precompile(function, args, kwargs, cache=kernel_file)
+        if kernel_file.kernel is None:
+            logger.warning("precompiled kernel %s could not be stored in %s",
+                           function.__qualname__, filename)
+        return run_precompiled
+
+    def _precompile(self, function, args, kwargs, cache=None):
         if not hasattr(function, "artiq_embedded"):
             raise ValueError("Argument is not a kernel")
 
@@ -269,7 +503,8 @@ class Core:
             result = new_result
 
         embedding_map, kernel_library, symbolizer, demangler, subkernel_arg_types = \
-            self.compile(function, args, kwargs, set_result, attribute_writeback=False)
+            self.compile(function, args, kwargs, set_result, attribute_writeback=False,
+                         cache=cache)
         self.compile_and_upload_subkernels(embedding_map, args, subkernel_arg_types)
 
         @wraps(function)
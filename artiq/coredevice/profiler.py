@@ -0,0 +1,111 @@
+"""
+The :class:`KernelProfiler` class records a timeline of kernel launches:
+stitching, type inference, ARTIQ IR transforms, LLVM, linking, upload,
+execution on the core device and the RPCs served during execution.
+
+The timeline can be exported as a Chrome trace (to be viewed with
+``chrome://tracing`` or Perfetto), and is saved in the results file of
+the run when the ``profile`` argument of the core device is set.
+"""
+
+import json
+import threading
+from time import perf_counter
+from contextlib import contextmanager
+from functools import wraps
+
+import numpy
+
+
+__all__ = ["KernelProfiler"]
+
+
+class KernelProfiler:
+    """Records spans of time spent launching kernels.
+
+    :ivar events: list of ``(name, category, start, duration, thread, args)``
+        tuples, with times in seconds relative to the creation of the
+        profiler.
+    """
+    def __init__(self):
+        self.origin = perf_counter()
+        self.events = []
+        self._threads = {}
+
+    def _thread(self):
+        return self._threads.setdefault(threading.get_ident(), len(self._threads))
+
+    def add(self, name, category, start, duration, args=None):
+        """Adds a span that started at the given :func:`time.perf_counter`
+        value and lasted ``duration`` seconds."""
+        self.events.append((name, category, start - self.origin, duration,
+                            self._thread(), args))
+
+    def add_timings(self, timings, category):
+        """Adds the ``(stage, start, duration)`` spans recorded by the
+        ``timings`` of a compiler target or module."""
+        for stage, start, duration in timings:
+            self.add(stage, category, start, duration)
+
+    @contextmanager
+    def span(self, name, category, args=None):
+        """Records the time spent in the body of the ``with`` statement."""
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, category, start, perf_counter() - start, args)
+
+    def rpc_span(self, service_id, service):
+        """Records the time spent in the body of the ``with`` statement as
+        a call of the given RPC service."""
+        if service_id == 0:
+            name = "attribute writeback"
+        else:
+            name = getattr(service, "__qualname__", repr(service))
+        return self.span("RPC " + name, "rpc", {"service": service_id})
+
+    def wrap_rpc(self, service_id, service):
+        """Returns a function calling an RPC service and recording the time
+        it takes."""
+        @wraps(service)
+        def profiled(*args, **kwargs):
+            with self.rpc_span(service_id, service):
+                return service(*args, **kwargs)
+        return profiled
+
+    def chrome_trace(self):
+        """Returns the recorded spans in the Chrome trace event format."""
+        events = []
+        for name, category, start, duration, thread, args in self.events:
+            event = {
+                "name": name,
+                "cat": category,
+                "ph": "X",
+                "ts": start * 1e6,
+                "dur": duration * 1e6,
+                "pid": 0,
+                "tid": thread,
+            }
+            if args is not None:
+                event["args"] = args
+            events.append(event)
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def write_chrome_trace(self, filename):
+        """Writes the recorded spans to a JSON file in the Chrome trace event
+        format."""
+        with open(filename, "w") as f:
+            json.dump(self.chrome_trace(), f)
+
+    def write_hdf5(self, group):
+        """Writes the recorded spans to datasets of the given HDF5 group, one
+        per field, times in seconds."""
+        names, categories, starts, durations, threads, _ = \
+            zip(*self.events) if self.events else ([],) * 6
+        group["name"] = numpy.array([name.encode() for name in names], dtype="S")
+        group["category"] = numpy.array([category.encode() for category in categories],
+                                        dtype="S")
+        group["start"] = numpy.array(starts, dtype=numpy.float64)
+        group["duration"] = numpy.array(durations, dtype=numpy.float64)
+        group["thread"] = numpy.array(threads, dtype=numpy.int32)
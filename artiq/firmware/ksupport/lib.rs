@@ -561,43 +561,16 @@ extern "C-unwind" fn subkernel_await_message(id: i32, timeout: i64, tags: &CSlic
     // RpcRecvRequest should be called `count` times after this to receive message data
 }
 
-unsafe fn attribute_writeback(typeinfo: *const ()) {
-    struct Attr {
-        offset: usize,
-        tag:    CSlice<'static, u8>,
-        name:   CSlice<'static, u8>
+unsafe fn attribute_writeback(writeback: *const ()) {
+    // All modified attributes are sent at once, as (object, name, value) triples
+    // of arguments to service 0.
+    struct Writeback {
+        tag:  CSlice<'static, u8>,
+        data: *const *const ()
     }
 
-    struct Type {
-        attributes: *const *const Attr,
-        objects:    *const *const ()
-    }
-
-    let mut tys = typeinfo as *const *const Type;
-    while !(*tys).is_null() {
-        let ty = *tys;
-        tys = tys.offset(1);
-
-        let mut objects = (*ty).objects;
-        while !(*objects).is_null() {
-            let object = *objects;
-            objects = objects.offset(1);
-
-            let mut attributes = (*ty).attributes;
-            while !(*attributes).is_null() {
-                let attribute = *attributes;
-                attributes = attributes.offset(1);
-
-                if (*attribute).tag.len() > 0 {
-                    rpc_send_async(0, &(*attribute).tag, [
-                        &object as *const _ as *const (),
-                        &(*attribute).name as *const _ as *const (),
-                        (object as usize + (*attribute).offset) as *const ()
-                    ].as_ptr());
-                }
-            }
-        }
-    }
+    let writeback = writeback as *const Writeback;
+    rpc_send_async(0, &(*writeback).tag, (*writeback).data);
 }
 
 static mut STACK_GUARD_BASE: usize = 0x0;
@@ -634,7 +607,7 @@ pub unsafe fn main() {
     let __bss_start = library.lookup(b"__bss_start").unwrap();
     let _end = library.lookup(b"_end").unwrap();
     let __modinit__ = library.lookup(b"__modinit__").unwrap();
-    let typeinfo = library.lookup(b"typeinfo");
+    let writeback = library.lookup(b"writeback");
     let _sstack_guard = library.lookup(b"_sstack_guard").unwrap();
 
     LIBRARY = Some(library);
@@ -648,8 +621,8 @@ pub unsafe fn main() {
 
     (mem::transmute::<u32, fn()>(__modinit__))();
 
-    if let Some(typeinfo) = typeinfo {
-        attribute_writeback(typeinfo as *const ());
+    if let Some(writeback) = writeback {
+        attribute_writeback(writeback as *const ());
     }
 
     // Make sure all async RPCs are processed before exiting.
@@ -9,6 +9,7 @@ from artiq.master.databases import DeviceDB, DatasetDB
 from artiq.master.worker_db import DeviceManager, DatasetManager
 from artiq.language.environment import ProcessArgumentManager
 from artiq.coredevice.core import CompileError
+from artiq.compiler.module import PassManager
 from artiq.tools import *
 
 
@@ -32,6 +33,9 @@ def get_argparser():
 
     parser.add_argument("-o", "--output", default=None,
                         help="output file")
+    parser.add_argument("--time-passes", default=False, action="store_true",
+                        help="print the time taken by each compiler pass "
+                             "and the size of the code after it")
     parser.add_argument("file", metavar="FILE",
                         help="file containing the experiment to compile")
     parser.add_argument("arguments", metavar="ARGUMENTS",
@@ -63,25 +67,18 @@ def main():
             core_name = exp.run.artiq_embedded.core_name
             core = getattr(exp_inst, core_name)
 
+            pass_manager = PassManager(count_nodes=True) if args.time_passes else None
             object_map, main_kernel_library, _, _, subkernel_arg_types = \
                 core.compile(exp.run, [exp_inst], {},
-                             attribute_writeback=False, print_as_rpc=False)
-
-            subkernels = object_map.subkernels()
-            compiled_subkernels = {}
-            while True:
-                new_subkernels = {}
-                for sid, subkernel_fn in subkernels.items():
-                    if sid in compiled_subkernels.keys():
-                        continue
-                    destination, subkernel_library, embedding_map = core.compile_subkernel(
-                        sid, subkernel_fn, object_map, 
-                        [exp_inst], subkernel_arg_types, subkernels)
-                    compiled_subkernels[sid] = (destination, subkernel_library)
-                    new_subkernels.update(embedding_map.subkernels())
-                if new_subkernels == subkernels:
-                    break
-                subkernels.update(new_subkernels)
+                             attribute_writeback=False, print_as_rpc=False,
+                             pass_manager=pass_manager)
+            if pass_manager is not None:
+                print(pass_manager.report())
+
+            _, subkernels = core.compile_subkernels(
+                object_map, [exp_inst], subkernel_arg_types)
+            compiled_subkernels = {sid: (destination, subkernel_library)
+                                   for sid, destination, subkernel_library in subkernels}
         except CompileError as error:
             return
         finally:
@@ -94,7 +91,7 @@ def main():
 
     output = args.output
 
-    if not subkernels:
+    if not compiled_subkernels:
         # just write the ELF file
         if output is None:
             basename, ext = os.path.splitext(args.file)
@@ -4,10 +4,10 @@ import asyncio
 import argparse
 import atexit
 import logging
+import os
 from types import SimpleNamespace
 
 from sipyco.pc_rpc import Server as RPCServer
-from sipyco.sync_struct import Publisher
 from sipyco.logging_tools import Server as LoggingServer
 from sipyco.broadcast import Broadcaster
 from sipyco import common_args
@@ -15,9 +15,11 @@ from sipyco.asyncio_tools import atexit_register_coroutine, SignalHandler
 
 from artiq import __version__ as artiq_version
 from artiq.master.log import log_args, init_log
+from artiq.master.publisher import Publisher
 from artiq.master.databases import (DeviceDB, DatasetDB,
                                     InteractiveArgDB)
 from artiq.master.scheduler import Scheduler
+from artiq.master.worker import WorkerPool
 from artiq.master.rid_counter import RIDCounter
 from artiq.master.experiments import (FilesystemBackend, GitBackend,
                                       ExperimentDB)
@@ -43,6 +45,24 @@ def get_argparser():
                        help="device database file (default: %(default)s)")
     group.add_argument("--dataset-db", default="dataset_db.mdb",
                        help="dataset file (default: %(default)s)")
+    group.add_argument("--dataset-db-storage", default="pyon",
+                       choices=["pyon", "incremental"],
+                       help=("storage mode of persisted datasets: whole PYON "
+                             "values, or binary values with a log of "
+                             "modifications (default: %(default)s)"))
+    group.add_argument("--dataset-db-lazy", default=False,
+                       action="store_true",
+                       help=("only read dataset keys and metadata at startup "
+                             "and load values on first access"))
+    group.add_argument("--dataset-cache-size", default=1024, type=int,
+                       help=("with --dataset-db-lazy, size in MiB above which "
+                             "unmodified dataset values are dropped from "
+                             "memory (default: %(default)s)"))
+    group.add_argument("--dataset-publish-rate", default=0, type=float,
+                       help=("maximum rate in Hz at which dataset "
+                             "modifications are sent to each client that "
+                             "did not request lossless delivery, coalescing "
+                             "modifications in between (default: no limit)"))
 
     group = parser.add_argument_group("repository")
     group.add_argument(
@@ -51,10 +71,42 @@ def get_argparser():
     group.add_argument(
         "-r", "--repository", default="repository",
         help="path to the repository (default: %(default)s)")
+    group.add_argument(
+        "--git-max-checkouts", default=4, type=int,
+        help=("number of Git checkouts above which unused checkouts are "
+              "deleted (default: %(default)s)"))
+    group.add_argument(
+        "--git-eviction-delay", default=600.0, type=float,
+        help=("time in seconds after which unused Git checkouts are deleted "
+              "(default: %(default)s)"))
+    group.add_argument(
+        "--scan-jobs", default=None, type=int,
+        help=("number of worker processes examining experiment files in "
+              "parallel during a repository scan "
+              "(default: number of CPUs, at most 4)"))
     group.add_argument(
         "--experiment-subdir", default="",
         help=("path to the experiment folder from the repository root "
               "(default: %(default)s)"))
+
+    group = parser.add_argument_group("workers")
+    group.add_argument(
+        "--worker-pool-size", default=0, type=int,
+        help=("number of worker processes to start ahead of time, "
+              "0 to start workers on demand (default: %(default)s)"))
+    group.add_argument(
+        "--worker-max-runs", default=1, type=int,
+        help=("number of runs a pooled worker process serves before "
+              "being terminated (default: %(default)s)"))
+    group.add_argument(
+        "--dataset-mod-interval", default=0.1, type=float,
+        help=("maximum time in seconds for which workers batch broadcast "
+              "dataset modifications before sending them, "
+              "0 to send them immediately (default: %(default)s)"))
+    group.add_argument(
+        "--dataset-mod-batch", default=1000, type=int,
+        help=("maximum number of dataset modifications in a batch "
+              "(default: %(default)s)"))
     log_args(parser)
 
     parser.add_argument("--name",
@@ -92,7 +144,9 @@ def main():
         server_broadcast.broadcast("ccb", msg)
 
     device_db = DeviceDB(args.device_db)
-    dataset_db = DatasetDB(args.dataset_db)
+    dataset_db = DatasetDB(args.dataset_db, storage=args.dataset_db_storage,
+                           lazy=args.dataset_db_lazy,
+                           cache_size=args.dataset_cache_size << 20)
     atexit.register(dataset_db.close_db)
     dataset_db.start(loop=loop)
     atexit_register_coroutine(dataset_db.stop, loop=loop)
@@ -100,15 +154,30 @@ def main():
     worker_handlers = dict()
 
     if args.git:
-        repo_backend = GitBackend(args.repository)
+        repo_backend = GitBackend(args.repository, args.git_max_checkouts,
+                                  args.git_eviction_delay)
     else:
         repo_backend = FilesystemBackend(args.repository)
     experiment_db = ExperimentDB(
-        repo_backend, worker_handlers, args.experiment_subdir)
+        repo_backend, worker_handlers, args.experiment_subdir,
+        args.scan_jobs,
+        os.path.join(os.path.dirname(os.path.abspath(args.dataset_db)),
+                     "examine_cache.pyon"))
     atexit.register(experiment_db.close)
 
+    worker_options = {
+        "dataset_mod_window": (args.dataset_mod_interval,
+                               args.dataset_mod_batch)
+    }
+    if args.worker_pool_size > 0:
+        worker_pool = WorkerPool(args.worker_pool_size, args.worker_max_runs,
+                                 lambda: experiment_db.cur_rev)
+        worker_pool.start(loop=loop)
+        atexit_register_coroutine(worker_pool.stop, loop=loop)
+        worker_options["worker_pool"] = worker_pool
+
     scheduler = Scheduler(RIDCounter(), worker_handlers, experiment_db,
-                          args.log_submissions)
+                          args.log_submissions, worker_options)
     scheduler.start(loop=loop)
     atexit_register_coroutine(scheduler.stop, loop=loop)
 
@@ -158,7 +227,7 @@ def main():
         "interactive_args": interactive_arg_db.pending,
         "explist": experiment_db.explist,
         "explist_status": experiment_db.status,
-    })
+    }, max_rates={"datasets": args.dataset_publish_rate})
     loop.run_until_complete(server_notify.start(
         bind, args.port_notify))
     atexit_register_coroutine(server_notify.stop, loop=loop)
@@ -1,4 +1,8 @@
 import asyncio
+import logging
+import struct
+import time
+from collections import OrderedDict
 
 import lmdb
 
@@ -8,6 +12,10 @@ from sipyco import pyon
 from sipyco.asyncio_tools import TaskObject
 
 from artiq.tools import file_import
+from artiq.master import worker_framing
+
+
+logger = logging.getLogger(__name__)
 
 
 def device_db_from_file(filename):
@@ -41,78 +49,404 @@ class DeviceDB:
         return self.data.raw_view["satellite_cpu_targets"][destination]
 
 
+# Records written in the incremental storage mode start with a null byte,
+# which cannot start a PYON record, followed by a frame with the metadata
+# and a frame with the value, so that the metadata can be read on its own.
+# Mod log records are stored under keys made of a null byte, the dataset
+# key, a null byte and a big endian sequence number, so that they sort
+# before the datasets and by key and sequence number.
+_binary_record_prefix = b"\x00"
+_log_key_prefix = b"\x00"
+
+
+def _log_key(key, seq):
+    return _log_key_prefix + key.encode() + b"\x00" + struct.pack(">Q", seq)
+
+
+def _log_key_range(key):
+    return _log_key_prefix + key.encode() + b"\x00"
+
+
+def _parse_log_key(log_key):
+    return log_key[1:-9].decode(), struct.unpack(">Q", log_key[-8:])[0]
+
+
+def _encode_record(value, metadata, binary):
+    if binary:
+        return (_binary_record_prefix
+                + worker_framing.encode_bytes(metadata)
+                + worker_framing.encode_bytes(value))
+    else:
+        return pyon.encode((value, metadata)).encode()
+
+
+def _decode_record(record):
+    if record[:1] == _binary_record_prefix:
+        metadata, end = worker_framing.decode_bytes(record, 1)
+        value, _ = worker_framing.decode_bytes(record, end)
+        return value, metadata
+    else:
+        return pyon.decode(bytes(record).decode())
+
+
+# Size of the end of PYON records searched for their metadata.
+_pyon_metadata_search = 1 << 16
+
+
+def _decode_record_metadata(record):
+    """Returns the metadata of a record without decoding its value, or
+    ``None`` if it cannot be found and the record must be decoded
+    entirely."""
+    if record[:1] == _binary_record_prefix:
+        metadata, _ = worker_framing.decode_bytes(record, 1)
+        return metadata
+    # A PYON record is a ``(value, metadata)`` tuple ending with the
+    # metadata dictionary. A suffix starting inside it does not decode to
+    # a dictionary, so the shortest suffix that does is the metadata.
+    tail = bytes(record[-_pyon_metadata_search:])
+    if not tail.endswith(b"})"):
+        return None
+    start = len(tail)
+    while True:
+        start = tail.rfind(b", {", 0, start)
+        if start < 0:
+            return None
+        try:
+            metadata = pyon.decode(tail[start + 2:-1].decode())
+        except Exception:
+            continue
+        if isinstance(metadata, dict):
+            return metadata
+
+
+def _encode_mod(mod):
+    return _binary_record_prefix + worker_framing.encode_bytes(mod)
+
+
+def _decode_mod(record):
+    mod, _ = worker_framing.decode_bytes(record, 1)
+    return mod
+
+
+class _DatasetNotifier(Notifier):
+    # Loads all values before giving access to the whole structure, e.g.
+    # to initialize a subscriber. The values loaded for a view are then
+    # dropped from the cache if it is full: the view keeps them in memory
+    # only as long as it is used.
+    def __init__(self, backing_struct, load, evict):
+        self._load = load
+        self._evict = evict
+        Notifier.__init__(self, backing_struct)
+
+    @property
+    def raw_view(self):
+        if not self._load():
+            return self._raw_view
+        view = dict(self._raw_view)
+        self._evict()
+        return view
+
+    @raw_view.setter
+    def raw_view(self, value):
+        self._raw_view = value
+
+    def item_view(self, key):
+        """Returns the entry of a dataset, loading its value if needed."""
+        loaded = self._load([key])
+        item = self._raw_view[key]
+        if loaded:
+            self._evict()
+        return item
+
+    def filtered_view(self, key_filter):
+        """Returns a dictionary with the datasets whose key satisfies
+        ``key_filter``, to initialize a filtered subscriber (see
+        :class:`artiq.master.publisher.Publisher`). Only the values of
+        those datasets are loaded."""
+        keys = [key for key in self._raw_view.keys() if key_filter(key)]
+        loaded = self._load(keys)
+        view = {key: self._raw_view[key] for key in keys}
+        if loaded:
+            self._evict()
+        return view
+
+
 class DatasetDB(TaskObject):
-    def __init__(self, persist_file, autosave_period=30):
+    """Dataset database, with persisted datasets stored in a LMDB file.
+
+    In the default ``pyon`` storage mode, each persisted dataset is stored
+    as a PYON record that is rewritten entirely whenever the dataset is
+    modified.
+
+    In the ``incremental`` storage mode, values are stored in binary
+    records in which NumPy arrays are raw buffers (see
+    :mod:`artiq.master.worker_framing`). Modifications of a dataset that
+    do not replace it (e.g. ``mutate_dataset`` and ``append_to_dataset``)
+    are appended to a per-key log instead, so that the cost of an autosave
+    scales with the size of the changes. The log of a key is compacted into
+    its record by the autosave task once it has more than
+    ``max_log_entries`` entries or is larger than the record.
+
+    Both storage modes can read files written by the other.
+
+    With ``lazy``, only the keys and metadata of the records are read at
+    startup. Values are decoded when first accessed (by :meth:`get`,
+    a modification, or the initialization of a subscriber to :attr:`data`),
+    and unmodified values are dropped from memory in least recently used
+    order when the values loaded from the file exceed ``cache_size``
+    bytes, as estimated from their size in the file.
+
+    The time taken to open the database is logged at the ``INFO`` level,
+    which the master shows when started with ``-v``.
+    """
+    def __init__(self, persist_file, autosave_period=30, storage="pyon",
+                 max_log_entries=1000, lazy=False, cache_size=2**30):
+        if storage not in ("pyon", "incremental"):
+            raise ValueError("Unknown dataset storage mode: " + storage)
         self.persist_file = persist_file
         self.autosave_period = autosave_period
+        self.incremental = storage == "incremental"
+        self.max_log_entries = max_log_entries
+        self.lazy = lazy
+        self.cache_size = cache_size
 
+        t0 = time.monotonic()
         self.lmdb = lmdb.open(persist_file, subdir=False, map_size=2**30)
         data = dict()
-        with self.lmdb.begin() as txn:
-            for key, value_and_metadata in txn.cursor():
-                value, metadata = pyon.decode(value_and_metadata.decode())
-                data[key.decode()] = (True, value, metadata)
-        self.data = Notifier(data)
+        # key -> [next sequence number, number of entries, size in bytes]
+        self._logs = dict()
+        self._record_sizes = dict()
+        # keys of the datasets the value of which has not been loaded
+        self._unloaded = set()
+        # key -> estimated size, for values loaded from the file
+        self._cache = OrderedDict()
+        self._cache_total = 0
+        with self.lmdb.begin(buffers=True) as txn:
+            logs = dict()
+            for key, record in txn.cursor():
+                key = bytes(key)
+                if key.startswith(_log_key_prefix):
+                    key, seq = _parse_log_key(key)
+                    logs.setdefault(key, []).append((seq, record))
+                    continue
+                key = key.decode()
+                self._record_sizes[key] = len(record)
+                metadata = None
+                if lazy:
+                    metadata = _decode_record_metadata(record)
+                if metadata is not None:
+                    data[key] = (True, None, metadata)
+                    self._unloaded.add(key)
+                else:
+                    value, metadata = _decode_record(record)
+                    data[key] = (True, value, metadata)
+            # Log records are sorted by sequence number.
+            for key, records in logs.items():
+                self._logs[key] = [records[-1][0] + 1, len(records),
+                                   sum(len(record) for _, record in records)]
+                if key in data and key not in self._unloaded:
+                    for _, record in records:
+                        process_mod(data, _decode_mod(record))
+        if lazy:
+            for key in data.keys() - self._unloaded:
+                self._add_to_cache(key)
+        self.data = _DatasetNotifier(data, self._load_all, self._evict)
+        self._data = data
         self.pending_keys = set()
+        # key -> list of encoded mods to append to the log
+        self.pending_mods = dict()
+        if not self.incremental:
+            # Logs are only written in incremental mode; fold them back.
+            self.pending_keys.update(self._logs.keys())
+        logger.info("dataset database opened in %.3fs "
+                    "(%d datasets, %d values not loaded)",
+                    time.monotonic() - t0, len(data), len(self._unloaded))
 
     def close_db(self):
         self.lmdb.close()
 
+    def _read_value(self, txn, key):
+        record = txn.get(key.encode())
+        value, metadata = _decode_record(record)
+        data = {key: (True, value, metadata)}
+        prefix = _log_key_range(key)
+        cursor = txn.cursor()
+        if cursor.set_range(prefix):
+            for log_key, log_record in cursor:
+                if not bytes(log_key).startswith(prefix):
+                    break
+                process_mod(data, _decode_mod(log_record))
+        return data[key][1]
+
+    def _add_to_cache(self, key):
+        size = self._record_sizes[key]
+        if key in self._logs:
+            size += self._logs[key][2]
+        self._cache[key] = size
+        self._cache_total += size
+
+    def _remove_from_cache(self, key):
+        self._unloaded.discard(key)
+        size = self._cache.pop(key, None)
+        if size is not None:
+            self._cache_total -= size
+
+    def _load(self, key):
+        if key in self._unloaded:
+            with self.lmdb.begin(buffers=True) as txn:
+                value = self._read_value(txn, key)
+            persist, _, metadata = self._data[key]
+            self._data[key] = (persist, value, metadata)
+            self._unloaded.remove(key)
+            self._add_to_cache(key)
+            self._evict()
+        elif key in self._cache:
+            self._cache.move_to_end(key)
+
+    def _load_all(self, keys=None):
+        """Loads the values of the given datasets (all by default) and
+        returns whether any was loaded. Call :meth:`_evict` once done
+        with the values."""
+        if keys is None:
+            keys = list(self._unloaded)
+        else:
+            keys = [key for key in keys if key in self._unloaded]
+        if not keys:
+            return False
+        with self.lmdb.begin(buffers=True) as txn:
+            for key in keys:
+                persist, _, metadata = self._data[key]
+                self._data[key] = (persist, self._read_value(txn, key),
+                                   metadata)
+                self._unloaded.remove(key)
+                self._add_to_cache(key)
+        return True
+
+    def _evict(self):
+        # Values with unsaved changes are kept, as well as the most
+        # recently used one.
+        for key in list(self._cache.keys())[:-1]:
+            if self._cache_total <= self.cache_size:
+                break
+            if key in self.pending_keys or key in self.pending_mods:
+                continue
+            persist, _, metadata = self._data[key]
+            self._data[key] = (persist, None, metadata)
+            self._remove_from_cache(key)
+            self._unloaded.add(key)
+
+    def _delete_log(self, txn, key):
+        if key not in self._logs:
+            return
+        del self._logs[key]
+        cursor = txn.cursor()
+        prefix = _log_key_range(key)
+        if cursor.set_range(prefix):
+            while bytes(cursor.key()).startswith(prefix):
+                if not cursor.delete():
+                    break
+
+    def _write_record(self, txn, key):
+        if key not in self._data or not self._data[key][0]:
+            self._delete_log(txn, key)
+            txn.delete(key.encode())
+            self._record_sizes.pop(key, None)
+        else:
+            _, value, metadata = self._data[key]
+            if key in self._unloaded:
+                value = self._read_value(txn, key)
+            self._delete_log(txn, key)
+            record = _encode_record(value, metadata, self.incremental)
+            txn.put(key.encode(), record)
+            self._record_sizes[key] = len(record)
+
     def save(self):
         with self.lmdb.begin(write=True) as txn:
             for key in self.pending_keys:
-                if (key not in self.data.raw_view
-                        or not self.data.raw_view[key][0]):
-                    txn.delete(key.encode())
-                else:
-                    value_and_metadata = (self.data.raw_view[key][1],
-                                          self.data.raw_view[key][2])
-                    txn.put(key.encode(),
-                            pyon.encode(value_and_metadata).encode())
+                self._write_record(txn, key)
+            for key, records in self.pending_mods.items():
+                log = self._logs.setdefault(key, [0, 0, 0])
+                for record in records:
+                    txn.put(_log_key(key, log[0]), record)
+                    log[0] += 1
+                    log[1] += 1
+                    log[2] += len(record)
         self.pending_keys.clear()
+        self.pending_mods.clear()
+
+    def compact(self):
+        """Rewrites the records of the keys with long mod logs."""
+        keys = [key for key, (_, entries, size) in self._logs.items()
+                if entries > self.max_log_entries
+                or size > self._record_sizes.get(key, 0)]
+        if keys:
+            with self.lmdb.begin(write=True) as txn:
+                for key in keys:
+                    # Pending mods are already reflected in the record.
+                    self.pending_mods.pop(key, None)
+                    self._write_record(txn, key)
 
     async def _do(self):
         try:
             while True:
                 await asyncio.sleep(self.autosave_period)
                 self.save()
+                self.compact()
+                if self.lazy:
+                    self._evict()
         finally:
             self.save()
 
     def get(self, key):
-        return self.data.raw_view[key][1]
+        self._load(key)
+        return self._data[key][1]
 
     def get_metadata(self, key):
-        return self.data.raw_view[key][2]
+        return self._data[key][2]
 
     def update(self, mod):
         if mod["path"]:
             key = mod["path"][0]
+            self._load(key)
         else:
             assert (mod["action"] == ModAction.setitem.value
                     or mod["action"] == ModAction.delitem.value)
             key = mod["key"]
-        self.pending_keys.add(key)
+            self._remove_from_cache(key)
+        if (self.incremental and mod["path"]
+                and key not in self.pending_keys
+                and key in self._record_sizes
+                and self._data[key][0]):
+            # Encode now, as objects referenced by the mod may be modified
+            # by later mods.
+            self.pending_mods.setdefault(key, []).append(_encode_mod(mod))
+        else:
+            self.pending_keys.add(key)
+            self.pending_mods.pop(key, None)
         process_mod(self.data, mod)
 
     # convenience functions (update() can be used instead)
     def set(self, key, value, persist=None, metadata=None):
         if persist is None:
-            if key in self.data.raw_view:
-                persist = self.data.raw_view[key][0]
+            if key in self._data:
+                persist = self._data[key][0]
             else:
                 persist = False
         if metadata is None:
-            if key in self.data.raw_view:
-                metadata = self.data.raw_view[key][2]
+            if key in self._data:
+                metadata = self._data[key][2]
             else:
                 metadata = {}
+        self._remove_from_cache(key)
         self.data[key] = (persist, value, metadata)
         self.pending_keys.add(key)
+        self.pending_mods.pop(key, None)
 
     def delete(self, key):
+        self._remove_from_cache(key)
         del self.data[key]
         self.pending_keys.add(key)
+        self.pending_mods.pop(key, None)
     #
 
 
@@ -1,4 +1,5 @@
 import asyncio
+import hashlib
 import os
 import tempfile
 import shutil
@@ -6,7 +7,9 @@ import time
 import logging
 
 from sipyco.sync_struct import Notifier, update_from_dict
+from sipyco import pyon
 
+from artiq import __version__ as artiq_version
 from artiq.master.worker import (Worker, WorkerInternalException,
                                  log_worker_exception)
 from artiq.tools import get_windows_drives, exc_to_warning
@@ -15,19 +18,190 @@ from artiq.tools import get_windows_drives, exc_to_warning
 logger = logging.getLogger(__name__)
 
 
-class _RepoScanner:
-    def __init__(self, worker_handlers):
-        self.worker_handlers = worker_handlers
-        self.worker = None
+class ExamineCache:
+    """Persistent cache of the descriptions of the experiments in the
+    repository files.
 
-    async def process_file(self, entry_dict, root, filename):
-        logger.debug("processing file %s %s", root, filename)
+    An entry is reused when the examined file and all the repository files
+    imported while examining it have the same content (as identified by
+    their SHA-256 hash) as when the entry was created, with the same
+    version of ARTIQ. Files in which experiments read the device or dataset
+    database while being examined are not cached.
+
+    The cache is stored in ``filename``, as PYON.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        # repository file -> (hash, description, {dependency: hash})
+        self.entries = dict()
         try:
-            description = await self.worker.examine(
-                "scan", os.path.join(root, filename))
+            contents = pyon.load_file(filename)
+        except FileNotFoundError:
+            pass
         except:
-            log_worker_exception()
-            raise
+            logger.warning("failed to load examine cache from %s, ignoring",
+                           filename, exc_info=True)
+        else:
+            if contents["artiq_version"] == artiq_version:
+                self.entries = contents["entries"]
+
+    def get(self, filename, file_hash):
+        """Returns the cached description of ``filename``, or ``None``.
+
+        ``file_hash`` is called with a repository file name and returns the
+        hash of its current content, or ``None`` if it does not exist."""
+        try:
+            entry_hash, description, dependencies = self.entries[filename]
+        except KeyError:
+            return None
+        if entry_hash != file_hash(filename):
+            return None
+        for dependency, dependency_hash in dependencies.items():
+            if file_hash(dependency) != dependency_hash:
+                return None
+        return description
+
+    def set(self, filename, file_hash, description, dependencies):
+        self.entries[filename] = (
+            file_hash(filename), description,
+            {dependency: file_hash(dependency)
+             for dependency in dependencies})
+
+    def discard(self, filename):
+        self.entries.pop(filename, None)
+
+    def prune(self, filenames):
+        """Removes the entries of the files not in ``filenames``."""
+        self.entries = {k: v for k, v in self.entries.items()
+                        if k in filenames}
+
+    def save(self):
+        pyon.store_file(self.filename, {
+            "artiq_version": artiq_version,
+            "entries": self.entries
+        })
+
+
+class _RepoScanner:
+    """Examines the experiment files of a repository.
+
+    The files are examined by up to ``jobs`` workers in parallel, and the
+    results are then assembled in the order of a sequential scan, so that
+    duplicate experiment names are renamed identically."""
+    def __init__(self, worker_handlers, jobs=1, cache=None):
+        self.worker_handlers = worker_handlers
+        self.jobs = jobs
+        self.cache = cache
+        self.examined = 0
+
+    def _walk(self, root, subdir=""):
+        # Returns the experiment files and the subdirectories of
+        # root/subdir, in the order in which their entries are added.
+        tree = []
+        for de in os.scandir(os.path.join(root, subdir)):
+            if de.name.startswith("."):
+                continue
+            if de.is_file() and de.name.endswith(".py"):
+                tree.append((de.name, os.path.join(subdir, de.name)))
+            if de.is_dir():
+                tree.append((de.name,
+                             self._walk(root, os.path.join(subdir, de.name))))
+        return tree
+
+    @staticmethod
+    def _tree_files(tree):
+        for _, item in tree:
+            if isinstance(item, str):
+                yield item
+            else:
+                yield from _RepoScanner._tree_files(item)
+
+    @staticmethod
+    def _file_hasher(root):
+        hashes = dict()
+
+        def file_hash(filename):
+            if filename not in hashes:
+                try:
+                    with open(os.path.join(root, filename), "rb") as f:
+                        hashes[filename] = hashlib.sha256(f.read()).hexdigest()
+                except OSError:
+                    hashes[filename] = None
+            return hashes[filename]
+        return file_hash
+
+    @staticmethod
+    def _repository_files(root, files):
+        # Returns the files of the repository among ``files``, relative to
+        # the root of the repository.
+        # Experiment files are imported from their resolved path.
+        root = os.path.realpath(root)
+        r = []
+        for file in files:
+            file = os.path.realpath(file)
+            try:
+                if os.path.commonpath([root, file]) != root:
+                    continue
+            except ValueError:
+                # different drives
+                continue
+            r.append(os.path.relpath(file, root))
+        return r
+
+    async def _examine_files(self, root, filenames):
+        # Returns a dictionary mapping each file to its description, or to
+        # the exception raised when examining it.
+        results = dict()
+        file_hash = self._file_hasher(root)
+        to_examine = []
+        for filename in filenames:
+            description = None
+            if self.cache is not None:
+                description = self.cache.get(filename, file_hash)
+            if description is None:
+                to_examine.append(filename)
+            else:
+                results[filename] = description
+        self.examined = len(to_examine)
+        filenames = iter(to_examine)
+
+        async def examine_worker():
+            worker = Worker(self.worker_handlers)
+            try:
+                for filename in filenames:
+                    logger.debug("processing file %s %s", root, filename)
+                    dependencies = dict()
+                    try:
+                        results[filename] = await worker.examine(
+                            "scan", os.path.join(root, filename),
+                            dependencies=dependencies)
+                    except Exception as exc:
+                        log_worker_exception()
+                        results[filename] = exc
+                        if self.cache is not None:
+                            self.cache.discard(filename)
+                        # restart worker
+                        await worker.close()
+                        worker = Worker(self.worker_handlers)
+                        continue
+                    if self.cache is None:
+                        continue
+                    if dependencies and not dependencies["databases"]:
+                        self.cache.set(
+                            filename, file_hash, results[filename],
+                            self._repository_files(
+                                root, dependencies["files"]))
+                    else:
+                        self.cache.discard(filename)
+            finally:
+                await worker.close()
+
+        jobs = min(self.jobs, len(to_examine))
+        await asyncio.gather(*[examine_worker() for _ in range(jobs)])
+        return results
+
+    @staticmethod
+    def _add_entries(entry_dict, filename, description):
         for class_name, class_desc in description.items():
             name = class_desc["name"]
             if "/" in name:
@@ -52,42 +226,50 @@ class _RepoScanner:
             }
             entry_dict[name] = entry
 
-    async def _scan(self, root, subdir=""):
+    def _assemble(self, tree, results):
         entry_dict = dict()
-        for de in os.scandir(os.path.join(root, subdir)):
-            if de.name.startswith("."):
-                continue
-            if de.is_file() and de.name.endswith(".py"):
-                filename = os.path.join(subdir, de.name)
-                try:
-                    await self.process_file(entry_dict, root, filename)
-                except Exception as exc:
-                    logger.warning("Skipping file '%s'", filename,
-                        exc_info=not isinstance(exc, WorkerInternalException))
-                    # restart worker
-                    await self.worker.close()
-                    self.worker = Worker(self.worker_handlers)
-            if de.is_dir():
-                subentries = await self._scan(
-                    root, os.path.join(subdir, de.name))
-                entries = {de.name + "/" + k: v for k, v in subentries.items()}
+        for name, item in tree:
+            if isinstance(item, str):
+                result = results[item]
+                if isinstance(result, WorkerInternalException):
+                    logger.warning("Skipping file '%s'", item)
+                elif isinstance(result, Exception):
+                    logger.warning("Skipping file '%s'", item,
+                                   exc_info=result)
+                else:
+                    self._add_entries(entry_dict, item, result)
+            else:
+                subentries = self._assemble(item, results)
+                entries = {name + "/" + k: v for k, v in subentries.items()}
                 entry_dict.update(entries)
         return entry_dict
 
     async def scan(self, root, subdir=""):
-        self.worker = Worker(self.worker_handlers)
-        try:
-            r = await self._scan(root, subdir)
-        finally:
-            await self.worker.close()
-        return r
+        tree = self._walk(root, subdir)
+        filenames = list(self._tree_files(tree))
+        results = await self._examine_files(root, filenames)
+        if self.cache is not None:
+            self.cache.prune(set(filenames))
+            try:
+                self.cache.save()
+            except:
+                logger.warning("failed to save examine cache",
+                               exc_info=True)
+        return self._assemble(tree, results)
 
 
 class ExperimentDB:
-    def __init__(self, repo_backend, worker_handlers, experiment_subdir=""):
+    def __init__(self, repo_backend, worker_handlers, experiment_subdir="",
+                 scan_jobs=None, examine_cache=None):
         self.repo_backend = repo_backend
         self.worker_handlers = worker_handlers
         self.experiment_subdir = experiment_subdir
+        if scan_jobs is None:
+            scan_jobs = min(4, os.cpu_count() or 1)
+        self.scan_jobs = scan_jobs
+        self.examine_cache = None
+        if examine_cache is not None:
+            self.examine_cache = ExamineCache(examine_cache)
 
         self.cur_rev = self.repo_backend.get_head_rev()
         self.repo_backend.request_rev(self.cur_rev)
@@ -102,6 +284,7 @@ class ExperimentDB:
     def close(self):
         # The object cannot be used anymore after calling this method.
         self.repo_backend.release_rev(self.cur_rev)
+        self.repo_backend.close()
 
     async def scan_repository(self, new_cur_rev=None):
         if self._scanning:
@@ -116,9 +299,12 @@ class ExperimentDB:
             self.cur_rev = new_cur_rev
             self.status["cur_rev"] = new_cur_rev
             t1 = time.monotonic()
-            new_explist = await _RepoScanner(self.worker_handlers).scan(
-                wd, self.experiment_subdir)
-            logger.info("repository scan took %d seconds", time.monotonic()-t1)
+            scanner = _RepoScanner(self.worker_handlers, self.scan_jobs,
+                                   self.examine_cache)
+            new_explist = await scanner.scan(wd, self.experiment_subdir)
+            logger.info("repository scan took %d seconds "
+                        "(%d files examined)",
+                        time.monotonic()-t1, scanner.examined)
             update_from_dict(self.explist, new_explist)
         finally:
             self._scanning = False
@@ -174,27 +360,93 @@ class FilesystemBackend:
     def release_rev(self, rev):
         pass
 
+    def close(self):
+        pass
+
 
 class _GitCheckout:
     def __init__(self, git, rev):
         self.path = tempfile.mkdtemp()
         commit = git.get(rev)
         git.checkout_tree(commit, directory=self.path)
+        self.rev = rev
         self.message = commit.message.strip()
         self.ref_count = 1
+        # time at which the reference count dropped to zero
+        self.released = None
         logger.info("checked out revision %s into %s", rev, self.path)
 
+    def _remove(self, path):
+        full_path = os.path.join(self.path, path)
+        if os.path.lexists(full_path):
+            os.remove(full_path)
+        # remove the directories left empty
+        directory = os.path.dirname(path)
+        while directory:
+            full_directory = os.path.join(self.path, directory)
+            if (not os.path.isdir(full_directory)
+                    or os.listdir(full_directory)):
+                break
+            os.rmdir(full_directory)
+            directory = os.path.dirname(directory)
+
+    def _write(self, git, path, mode, oid):
+        full_path = os.path.join(self.path, path)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        data = git[oid].data
+        if mode == 0o120000:
+            os.symlink(data.decode(), full_path)
+        elif mode in (0o100644, 0o100755):
+            with open(full_path, "wb") as f:
+                f.write(data)
+            if mode == 0o100755:
+                os.chmod(full_path, os.stat(full_path).st_mode | 0o111)
+        else:
+            # e.g. submodules
+            raise ValueError("unsupported file mode {:o} for {}"
+                             .format(mode, path))
+
+    def update(self, git, rev, diff):
+        """Turns the checkout into a checkout of ``rev``, by applying the
+        differences ``diff`` between the checked out revision and ``rev``.
+
+        The checkout is left in an undefined state if an exception is
+        raised."""
+        for delta in diff.deltas:
+            status = delta.status_char()
+            if status != "A":
+                self._remove(delta.old_file.path)
+            if status != "D":
+                self._write(git, delta.new_file.path, delta.new_file.mode,
+                            delta.new_file.id)
+        commit = git.get(rev)
+        logger.info("updated checkout in %s from revision %s to %s",
+                    self.path, self.rev, rev)
+        self.rev = rev
+        self.message = commit.message.strip()
+        self.ref_count = 1
+        self.released = None
+
     def dispose(self):
         logger.info("disposing of checkout in folder %s", self.path)
         shutil.rmtree(self.path)
 
 
 class GitBackend:
-    def __init__(self, root):
+    """Repository backend checking out revisions of a Git repository.
+
+    Checkouts that are no longer used are kept for ``eviction_delay``
+    seconds, as long as there are no more than ``max_checkouts``
+    checkouts. A revision that is not checked out is obtained by updating
+    the unused checkout with the fewest differences from it, if any, or
+    otherwise with a new checkout."""
+    def __init__(self, root, max_checkouts=4, eviction_delay=600.0):
         # lazy import - make dependency optional
         import pygit2
 
         self.git = pygit2.Repository(root)
+        self.max_checkouts = max_checkouts
+        self.eviction_delay = eviction_delay
         self.checkouts = dict()
 
     def get_head_rev(self):
@@ -210,19 +462,70 @@ class GitBackend:
         logger.debug('Resolved git ref "%s" into "%s"', rev, commit_id)
         return commit_id
 
+    def _checkout(self, rev):
+        # Returns a checkout of rev, and a description of how it was
+        # obtained.
+        nearest = None
+        commit = self.git.get(rev)
+        for co in self.checkouts.values():
+            if co.ref_count:
+                continue
+            diff = self.git.diff(self.git.get(co.rev), commit)
+            changes = sum(1 for _ in diff.deltas)
+            if nearest is None or changes < nearest[0]:
+                nearest = changes, co, diff
+        if nearest is not None:
+            changes, co, diff = nearest
+            del self.checkouts[co.rev]
+            try:
+                co.update(self.git, rev, diff)
+            except:
+                logger.warning("failed to update checkout in %s, "
+                               "checking out revision %s instead",
+                               co.path, rev, exc_info=True)
+                co.dispose()
+            else:
+                return co, "updated {} files".format(changes)
+        return _GitCheckout(self.git, rev), "new checkout"
+
+    def _evict(self):
+        now = time.monotonic()
+        excess = len(self.checkouts) - self.max_checkouts
+        unused = sorted((co for co in self.checkouts.values()
+                         if not co.ref_count),
+                        key=lambda co: co.released)
+        for co in unused:
+            if excess > 0 or now - co.released >= self.eviction_delay:
+                co.dispose()
+                del self.checkouts[co.rev]
+                excess -= 1
+
     def request_rev(self, rev):
+        t0 = time.monotonic()
         rev = self._get_pinned_rev(rev)
         if rev in self.checkouts:
             co = self.checkouts[rev]
             co.ref_count += 1
+            co.released = None
+            how = "cached"
         else:
-            co = _GitCheckout(self.git, rev)
+            co, how = self._checkout(rev)
             self.checkouts[rev] = co
+        self._evict()
+        logger.debug("request_rev %s: %s, %.3fs", rev, how,
+                     time.monotonic() - t0)
         return co.path, co.message, rev
 
     def release_rev(self, rev):
         co = self.checkouts[rev]
         co.ref_count -= 1
         if not co.ref_count:
-            co.dispose()
-            del self.checkouts[rev]
+            co.released = time.monotonic()
+            self._evict()
+
+    def close(self):
+        """Disposes of the unused checkouts."""
+        for rev, co in list(self.checkouts.items()):
+            if not co.ref_count:
+                co.dispose()
+                del self.checkouts[rev]
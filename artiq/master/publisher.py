@@ -0,0 +1,257 @@
+"""Publisher of notifiers with support for filtered and rate-limited
+subscriptions.
+
+:class:`Publisher` implements the server side of the protocol of
+:mod:`sipyco.sync_struct` and can be used with unmodified
+:class:`sipyco.sync_struct.Subscriber` instances.
+
+A subscriber to a notifier whose structure is a dictionary (e.g. the
+datasets) can pass options by subscribing to the name returned by
+:func:`subscription_name`:
+
+* a set of keys and key prefixes, to receive an initial structure with only
+  the matching keys, and only the modifications to those keys, so that other
+  entries do not cross the network;
+* lossless delivery, to receive every modification of a notifier for which
+  the publisher limits the rate of modifications.
+"""
+
+import asyncio
+import time
+from functools import partial
+
+from sipyco.sync_struct import ModAction, _protocol_banner
+from sipyco.asyncio_tools import AsyncioServer
+from sipyco import pyon
+
+
+__all__ = ["subscription_name", "Publisher"]
+
+
+def subscription_name(notifier_name, keys=None, prefixes=None,
+                      lossless=False):
+    """Returns the name to subscribe to in order to receive the entries of
+    ``notifier_name`` whose key is in ``keys`` or starts with one of
+    ``prefixes``. If both are ``None``, all entries are received.
+
+    With ``lossless``, every modification is received even if the
+    publisher limits the rate of modifications of the notifier."""
+    return notifier_name + "?" + pyon.encode({
+        "keys": None if keys is None else list(keys),
+        "prefixes": None if prefixes is None else list(prefixes),
+        "lossless": lossless
+    })
+
+
+class _KeyFilter:
+    def __init__(self, keys, prefixes):
+        self.keys = set(keys)
+        self.prefixes = tuple(prefixes)
+
+    def __call__(self, key):
+        return key in self.keys or key.startswith(self.prefixes)
+
+
+def _mod_key(mod):
+    if mod["path"]:
+        return mod["path"][0]
+    elif mod["action"] in (ModAction.setitem.value, ModAction.delitem.value):
+        return mod["key"]
+    else:
+        return None
+
+
+class _Recipient:
+    def __init__(self, key_filter, interval):
+        self.queue = asyncio.Queue()
+        self.key_filter = key_filter
+        # minimum time between two batches of modifications, 0 if every
+        # modification is sent immediately
+        self.interval = interval
+        self.pending = dict()  # key -> list of modifications
+        self.flush_handle = None
+        self.last_flush = 0.0
+
+
+class Publisher(AsyncioServer):
+    """Publishes notifiers to subscribers over the network.
+
+    This is a drop-in replacement for :class:`sipyco.sync_struct.Publisher`
+    that also accepts filtered subscriptions (see
+    :func:`subscription_name`).
+
+    The initial structure of a filtered subscription is obtained with the
+    ``filtered_view(key_filter)`` method of the notifier if it has one,
+    which allows it to avoid materializing entries that are not sent.
+
+    :param notifiers: A dictionary containing the notifiers to associate
+        with the :class:`.Publisher`. The keys of the dictionary are the
+        names of the notifiers to be used with
+        :class:`sipyco.sync_struct.Subscriber`.
+    :param max_rates: A dictionary giving, for some of the notifiers, the
+        maximum rate in Hz at which modifications are sent to each
+        subscriber that did not request lossless delivery. Those notifiers
+        must be dictionaries. The modifications of an entry made between
+        two batches are sent unchanged if there is only one, merged if they
+        all assign the same item, and otherwise replaced by an assignment of
+        the current value of the entry.
+    """
+    def __init__(self, notifiers, max_rates=dict()):
+        AsyncioServer.__init__(self)
+        self.notifiers = notifiers
+        self.max_rates = max_rates
+        # notifier name -> set of _Recipient
+        self._recipients = {k: set() for k in notifiers.keys()}
+        self._notifier_names = {id(v): k for k, v in notifiers.items()}
+
+        for notifier in notifiers.values():
+            notifier.publish = partial(self.publish, notifier)
+
+    @staticmethod
+    def _filter_struct(struct, key_filter):
+        return {k: v for k, v in struct.items() if key_filter(k)}
+
+    def _init_struct(self, notifier, key_filter):
+        if key_filter is None:
+            return notifier.raw_view
+        filtered_view = getattr(notifier, "filtered_view", None)
+        if filtered_view is not None:
+            return filtered_view(key_filter)
+        return self._filter_struct(notifier.raw_view, key_filter)
+
+    @staticmethod
+    def _item_view(notifier, key):
+        # The dataset database may have unloaded the value since it was
+        # modified.
+        item_view = getattr(notifier, "item_view", None)
+        if item_view is not None:
+            return item_view(key)
+        return notifier.raw_view[key]
+
+    async def _handle_connection_cr(self, reader, writer):
+        try:
+            line = await reader.readline()
+            if line != _protocol_banner:
+                return
+
+            line = await reader.readline()
+            if not line:
+                return
+            notifier_name, sep, options = line.decode()[:-1].partition("?")
+
+            try:
+                notifier = self.notifiers[notifier_name]
+            except KeyError:
+                return
+
+            key_filter = None
+            lossless = False
+            if sep:
+                try:
+                    options = pyon.decode(options)
+                    keys, prefixes = options["keys"], options["prefixes"]
+                    if keys is not None or prefixes is not None:
+                        key_filter = _KeyFilter(keys or [], prefixes or [])
+                    lossless = options["lossless"]
+                except Exception:
+                    return
+            interval = 0.0
+            max_rate = self.max_rates.get(notifier_name)
+            if max_rate and not lossless:
+                interval = 1/max_rate
+
+            obj = {"action": ModAction.init.value,
+                   "struct": self._init_struct(notifier, key_filter)}
+            line = pyon.encode(obj) + "\n"
+            writer.write(line.encode())
+
+            recipient = _Recipient(key_filter, interval)
+            self._recipients[notifier_name].add(recipient)
+            try:
+                while True:
+                    line = await recipient.queue.get()
+                    writer.write(line)
+                    # raise exception on connection error
+                    await writer.drain()
+            finally:
+                self._recipients[notifier_name].remove(recipient)
+                if recipient.flush_handle is not None:
+                    recipient.flush_handle.cancel()
+        except (ConnectionResetError, ConnectionAbortedError, BrokenPipeError):
+            # subscribers disconnecting are a normal occurrence
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    def _encode(mod):
+        return (pyon.encode(mod) + "\n").encode()
+
+    def _defer(self, notifier, recipient, key, mod):
+        if not mod["path"]:
+            # replaces any pending modification
+            recipient.pending[key] = [mod]
+        else:
+            mods = recipient.pending.setdefault(key, [])
+            if (mods and mod["action"] == ModAction.setitem.value
+                    and mods[-1]["action"] == ModAction.setitem.value
+                    and mods[-1]["path"] == mod["path"]
+                    and mods[-1]["key"] == mod["key"]):
+                mods[-1] = mod
+            else:
+                mods.append(mod)
+        if recipient.flush_handle is None:
+            delay = (recipient.last_flush + recipient.interval
+                     - time.monotonic())
+            recipient.flush_handle = asyncio.get_event_loop().call_later(
+                max(delay, 0.0), self._flush, notifier, recipient)
+
+    def _flush(self, notifier, recipient):
+        recipient.flush_handle = None
+        recipient.last_flush = time.monotonic()
+        for key, mods in recipient.pending.items():
+            if len(mods) == 1:
+                recipient.queue.put_nowait(self._encode(mods[0]))
+                continue
+            # Send a snapshot of the entry. Encoding the pending mods could
+            # be wrong, as objects they refer to may have been modified
+            # since.
+            try:
+                value = self._item_view(notifier, key)
+            except KeyError:
+                mod = {"action": ModAction.delitem.value,
+                       "path": [], "key": key}
+            else:
+                mod = {"action": ModAction.setitem.value,
+                       "path": [], "key": key, "value": value}
+            recipient.queue.put_nowait(self._encode(mod))
+        recipient.pending.clear()
+
+    def publish(self, notifier, mod):
+        """Sends a modification of ``notifier`` to the subscribers that
+        are interested in it."""
+        notifier_name = self._notifier_names[id(notifier)]
+        line = None
+        for recipient in self._recipients[notifier_name]:
+            if mod["action"] == ModAction.init.value:
+                # Replaces the whole structure, including pending mods.
+                recipient.pending.clear()
+                if recipient.key_filter is not None:
+                    filtered = {
+                        "action": ModAction.init.value,
+                        "struct": self._filter_struct(mod["struct"],
+                                                      recipient.key_filter)
+                    }
+                    recipient.queue.put_nowait(self._encode(filtered))
+                    continue
+            else:
+                key = _mod_key(mod)
+                if (recipient.key_filter is not None
+                        and (key is None or not recipient.key_filter(key))):
+                    continue
+                if recipient.interval:
+                    self._defer(notifier, recipient, key, mod)
+                    continue
+            if line is None:
+                line = self._encode(mod)
+            recipient.queue.put_nowait(line)
@@ -1,6 +1,7 @@
 import asyncio
 import logging
 import csv
+import heapq
 import os.path
 from enum import Enum
 from time import time
@@ -60,7 +61,7 @@ class Run:
         self.due_date = due_date
         self.flush = flush
 
-        self.worker = Worker(pool.worker_handlers)
+        self.worker = Worker(pool.worker_handlers, **pool.worker_options)
         self.termination_requested = False
 
         self._status = RunStatus.pending
@@ -77,6 +78,7 @@ class Run:
         self._notifier = pool.notifier
         self._notifier[self.rid] = notification
         self._state_changed = pool.state_changed
+        self._update_queues = pool.update_queues
 
     @property
     def status(self):
@@ -84,7 +86,9 @@ class Run:
 
     @status.setter
     def status(self, value):
+        old_status = self._status
         self._status = value
+        self._update_queues(self, old_status)
         if not self.worker.closed.is_set():
             self._notifier[self.rid]["status"] = self._status.name
         self._state_changed.notify()
@@ -114,16 +118,87 @@ class Run:
     analyze = _mk_worker_method("analyze")
 
 
+def _priority_order(run):
+    # heapq implements a min-heap, so negate the priority key to pop the
+    # highest priority run first.
+    return tuple(-x for x in run.priority_key())
+
+
+def _due_date_order(run):
+    return run.due_date
+
+
+class _RunQueue:
+    """Heap of runs ordered by a key function, with O(log n) insertion and
+    access to the first run.
+
+    Removal is lazy: stale heap entries are discarded when they reach the
+    top of the heap, or when they make up more than half of it.
+    """
+    def __init__(self, key):
+        self._key = key
+        self._heap = []
+        self._entries = dict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def push(self, run):
+        entry = (self._key(run), run.rid, run)
+        self._entries[run.rid] = entry
+        heapq.heappush(self._heap, entry)
+
+    def discard(self, run):
+        if self._entries.pop(run.rid, None) is None:
+            return
+        if len(self._heap) > 2*len(self._entries) + 64:
+            self._heap = list(self._entries.values())
+            heapq.heapify(self._heap)
+
+    def _prune(self):
+        heap = self._heap
+        while heap and self._entries.get(heap[0][1]) is not heap[0]:
+            heapq.heappop(heap)
+
+    def peek(self):
+        """Return the first run without removing it, or ``None`` if the
+        queue is empty."""
+        self._prune()
+        if self._heap:
+            return self._heap[0][2]
+        return None
+
+    def pop(self):
+        self._prune()
+        _, rid, run = heapq.heappop(self._heap)
+        del self._entries[rid]
+        return run
+
+
 class RunPool:
-    def __init__(self, ridc, worker_handlers, notifier, experiment_db, log_submissions):
+    def __init__(self, ridc, worker_handlers, notifier, experiment_db,
+                 log_submissions, worker_options=None):
         self.runs = dict()
         self.state_changed = Condition()
 
+        # Runs are indexed by status so that the stages can find the next
+        # run without scanning the whole pool. Pending runs with a due date
+        # in the future are kept in a separate queue ordered by due date,
+        # and moved to the pending queue once they become runnable.
+        self._queues = {
+            RunStatus.pending: _RunQueue(_priority_order),
+            RunStatus.prepare_done: _RunQueue(_priority_order),
+            RunStatus.run_done: _RunQueue(_priority_order)
+        }
+        self._due_queue = _RunQueue(_due_date_order)
+
         self.ridc = ridc
         self.worker_handlers = worker_handlers
         self.notifier = notifier
         self.experiment_db = experiment_db
         self.log_submissions = log_submissions
+        # additional keyword arguments for Worker
+        self.worker_options = worker_options or dict()
 
     def log_submission(self, rid, expid):
         start_time = time()
@@ -159,9 +234,50 @@ class RunPool:
         if self.log_submissions is not None:
             self.log_submission(rid, expid)
         self.runs[rid] = run
+        if due_date is not None and due_date >= time():
+            self._due_queue.push(run)
+        else:
+            self._queues[RunStatus.pending].push(run)
         self.state_changed.notify()
         return rid
 
+    def update_queues(self, run, old_status):
+        # called through Run.status
+        if old_status == RunStatus.pending:
+            self._due_queue.discard(run)
+        if old_status in self._queues:
+            self._queues[old_status].discard(run)
+        # Stages may still update the status of a run that has been
+        # deleted in the meantime, which must not be queued again.
+        if run.status in self._queues and self.runs.get(run.rid) is run:
+            self._queues[run.status].push(run)
+
+    def promote_due_runs(self, now):
+        """Move the pending runs whose due date has elapsed to the queue
+        of runnable pending runs."""
+        pending = self._queues[RunStatus.pending]
+        while True:
+            run = self._due_queue.peek()
+            if run is None or run.due_date >= now:
+                break
+            pending.push(self._due_queue.pop())
+
+    def next_due_date(self):
+        """Return the earliest due date of the pending runs that are not
+        runnable yet, or ``None`` if there are none."""
+        run = self._due_queue.peek()
+        if run is None:
+            return None
+        return run.due_date
+
+    def get_first(self, status):
+        """Return the highest priority run with the given status, or
+        ``None``.
+
+        Only ``pending`` (runnable runs only), ``prepare_done`` and
+        ``run_done`` are indexed."""
+        return self._queues[status].peek()
+
     async def delete(self, rid):
         # called through deleter
         if rid not in self.runs:
@@ -171,6 +287,9 @@ class RunPool:
         if "repo_rev" in run.expid:
             self.experiment_db.repo_backend.release_rev(run.expid["repo_rev"])
         del self.runs[rid]
+        self._due_queue.discard(run)
+        for queue in self._queues.values():
+            queue.discard(run)
 
 
 class PrepareStage(TaskObject):
@@ -183,33 +302,25 @@ class PrepareStage(TaskObject):
         float giving the time until the next check, or None if no time-based
         check is required.
 
-        The latter can be the case if there are no due-date runs, or none
-        of them are going to become next-in-line before further pool state
-        changes (which will also cause a re-evaluation).
+        The latter can be the case if there are no due-date runs (further
+        pool state changes will also cause a re-evaluation). The returned
+        time is that of the earliest due date, which may cause a spurious
+        re-evaluation if that run does not take precedence once runnable.
         """
-        pending_runs = list(
-            filter(lambda r: r.status == RunStatus.pending,
-                   self.pool.runs.values()))
-
         now = time()
-        def is_runnable(r):
-            return (r.due_date or 0) < now
-
-        prepared_max = max((r.priority_key() for r in self.pool.runs.values()
-                            if r.status == RunStatus.prepare_done),
-                           default=None)
-        def takes_precedence(r):
-            return prepared_max is None or r.priority_key() > prepared_max
-
-        candidate = max(filter(is_runnable, pending_runs),
-                        key=lambda r: r.priority_key(),
-                        default=None)
-        if candidate is not None and takes_precedence(candidate):
+        self.pool.promote_due_runs(now)
+
+        prepared = self.pool.get_first(RunStatus.prepare_done)
+        candidate = self.pool.get_first(RunStatus.pending)
+        if candidate is not None and (
+                prepared is None or
+                candidate.priority_key() > prepared.priority_key()):
             return candidate
 
-        return min((r.due_date - now for r in pending_runs
-                    if (not is_runnable(r) and takes_precedence(r))),
-                   default=None)
+        next_due_date = self.pool.next_due_date()
+        if next_due_date is None:
+            return None
+        return next_due_date - now
 
     async def _do(self):
         while True:
@@ -254,14 +365,7 @@ class RunStage(TaskObject):
         self.delete_cb = delete_cb
 
     def _get_run(self):
-        prepared_runs = filter(lambda r: r.status == RunStatus.prepare_done,
-                               self.pool.runs.values())
-        try:
-            r = max(prepared_runs, key=lambda r: r.priority_key())
-        except ValueError:
-            # prepared_runs is an empty sequence
-            r = None
-        return r
+        return self.pool.get_first(RunStatus.prepare_done)
 
     async def _do(self):
         stack = []
@@ -308,14 +412,7 @@ class AnalyzeStage(TaskObject):
         self.delete_cb = delete_cb
 
     def _get_run(self):
-        run_runs = filter(lambda r: r.status == RunStatus.run_done,
-                          self.pool.runs.values())
-        try:
-            r = max(run_runs, key=lambda r: r.priority_key())
-        except ValueError:
-            # run_runs is an empty sequence
-            r = None
-        return r
+        return self.pool.get_first(RunStatus.run_done)
 
     async def _do(self):
         while True:
@@ -334,8 +431,10 @@ class AnalyzeStage(TaskObject):
 
 
 class Pipeline:
-    def __init__(self, ridc, deleter, worker_handlers, notifier, experiment_db, log_submissions):
-        self.pool = RunPool(ridc, worker_handlers, notifier, experiment_db, log_submissions)
+    def __init__(self, ridc, deleter, worker_handlers, notifier, experiment_db,
+                 log_submissions, worker_options=None):
+        self.pool = RunPool(ridc, worker_handlers, notifier, experiment_db,
+                            log_submissions, worker_options)
         self._prepare = PrepareStage(self.pool, deleter.delete)
         self._run = RunStage(self.pool, deleter.delete)
         self._analyze = AnalyzeStage(self.pool, deleter.delete)
@@ -406,7 +505,8 @@ class Deleter(TaskObject):
 
 
 class Scheduler:
-    def __init__(self, ridc, worker_handlers, experiment_db, log_submissions):
+    def __init__(self, ridc, worker_handlers, experiment_db, log_submissions,
+                 worker_options=None):
         self.notifier = Notifier(dict())
 
         self._pipelines = dict()
@@ -417,6 +517,7 @@ class Scheduler:
         self._ridc = ridc
         self._deleter = Deleter(self._pipelines)
         self._log_submissions = log_submissions
+        self._worker_options = worker_options
 
     def start(self, *, loop=None):
         self._loop = loop
@@ -449,7 +550,8 @@ class Scheduler:
             logger.debug("creating pipeline '%s'", pipeline_name)
             pipeline = Pipeline(self._ridc, self._deleter,
                                 self._worker_handlers, self.notifier,
-                                self._experiment_db, self._log_submissions)
+                                self._experiment_db, self._log_submissions,
+                                self._worker_options)
             self._pipelines[pipeline_name] = pipeline
             pipeline.start(loop=self._loop)
         return pipeline.pool.submit(expid, priority, due_date, flush, pipeline_name)
@@ -496,12 +598,8 @@ class Scheduler:
                 if run.termination_requested:
                     return True
 
-                prepared_runs = filter(lambda r: r.status == RunStatus.prepare_done,
-                                       pipeline.pool.runs.values())
-                try:
-                    r = max(prepared_runs, key=lambda r: r.priority_key())
-                except ValueError:
-                    # prepared_runs is an empty sequence
+                r = pipeline.pool.get_first(RunStatus.prepare_done)
+                if r is None:
                     return False
                 return r.priority_key() > run.priority_key()
         raise KeyError("RID not found")
@@ -4,12 +4,15 @@ import asyncio
 import logging
 import subprocess
 import time
+from collections import deque
 
 from sipyco import pipe_ipc, pyon
 from sipyco.logging_tools import LogParser
 from sipyco.packed_exceptions import current_exc_packed
+from sipyco.asyncio_tools import TaskObject
 
 from artiq.tools import asyncio_wait_or_cancel
+from artiq.master import worker_framing
 
 
 logger = logging.getLogger(__name__)
@@ -41,15 +44,188 @@ def log_worker_exception():
         logger.error("worker exception details", exc_info=True)
 
 
+def _encode_message(obj, binary_framing):
+    if binary_framing:
+        return worker_framing.encode(obj)
+    else:
+        return [(pyon.encode(obj) + "\n").encode()]
+
+
+async def _spawn_process(log_level, get_log_source, binary_framing):
+    ipc = pipe_ipc.AsyncioParentComm()
+    env = os.environ.copy()
+    env["PYTHONUNBUFFERED"] = "1"
+    await ipc.create_subprocess(
+        sys.executable, "-m", "artiq.master.worker_impl",
+        ipc.get_address(), str(log_level),
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        env=env, start_new_session=True)
+    asyncio.ensure_future(
+        LogParser(get_log_source).stream_task(ipc.process.stdout))
+    asyncio.ensure_future(
+        LogParser(get_log_source).stream_task(ipc.process.stderr))
+    if binary_framing:
+        # Sent as a PYON line, as the worker starts with line framing.
+        # Both directions use binary framing from the next message on.
+        ipc.write(_encode_message({"action": "set_framing",
+                                   "framing": "binary"}, False)[0])
+    return ipc
+
+
+class _PooledProcess:
+    def __init__(self, revision, binary_framing):
+        self.ipc = None
+        self.revision = revision
+        self.binary_framing = binary_framing
+        self.runs = 0
+        # Set by the worker currently using the process.
+        self.log_source = None
+
+    def get_log_source(self):
+        if self.log_source is None:
+            return "worker(pool)"
+        return self.log_source()
+
+
+class WorkerPool(TaskObject):
+    """Keeps worker processes started ahead of time, so that runs do not
+    have to wait for the worker process to start and import its
+    dependencies. The pool is refilled in the background.
+
+    :param size: Number of idle worker processes to keep ready.
+    :param max_runs: Number of runs after which a worker process is
+        terminated instead of being returned to the pool. With the default
+        of 1, each process serves a single run.
+    :param get_revision: Optional callable returning the current repository
+        revision. Processes started under a different revision are
+        terminated instead of being used or returned to the pool.
+    :param binary_framing: Use binary framing to communicate with the
+        worker processes (see :class:`Worker`).
+    """
+    def __init__(self, size, max_runs=1, get_revision=None, term_timeout=2.0,
+                 binary_framing=True):
+        self.size = size
+        self.max_runs = max_runs
+        self.get_revision = get_revision
+        self.term_timeout = term_timeout
+        self.binary_framing = binary_framing
+
+        self._idle = deque()
+        self._refill = asyncio.Event()
+        self._stopped = False
+
+    def __len__(self):
+        return len(self._idle)
+
+    def _revision(self):
+        if self.get_revision is None:
+            return None
+        return self.get_revision()
+
+    def _is_usable(self, process):
+        return (process.ipc.process.returncode is None
+                and process.revision == self._revision())
+
+    async def _do(self):
+        while True:
+            for process in [p for p in self._idle if not self._is_usable(p)]:
+                self._idle.remove(process)
+                asyncio.ensure_future(self._terminate(process))
+            while len(self._idle) < self.size:
+                process = _PooledProcess(self._revision(),
+                                         self.binary_framing)
+                try:
+                    process.ipc = await _spawn_process(
+                        logging.WARNING, process.get_log_source,
+                        process.binary_framing)
+                except Exception:
+                    logger.warning("failed to start pooled worker",
+                                   exc_info=True)
+                    break
+                self._idle.append(process)
+            self._refill.clear()
+            await self._refill.wait()
+
+    async def stop(self):
+        self._stopped = True
+        await TaskObject.stop(self)
+        while self._idle:
+            await self._terminate(self._idle.popleft())
+
+    async def _terminate(self, process):
+        ipc = process.ipc
+        if ipc.process.returncode is not None:
+            return
+        try:
+            for chunk in _encode_message({"action": "terminate"},
+                                         process.binary_framing):
+                ipc.write(chunk)
+            await asyncio.wait_for(ipc.drain(), self.term_timeout)
+            await asyncio.wait_for(ipc.process.wait(), self.term_timeout)
+            return
+        except:
+            logger.debug("pooled worker failed to exit on request, killing",
+                         exc_info=True)
+        try:
+            ipc.process.kill()
+        except ProcessLookupError:
+            pass
+
+    def take(self):
+        """Returns an idle worker process, or ``None`` if none is
+        available."""
+        self._refill.set()
+        while self._idle:
+            process = self._idle.popleft()
+            if self._is_usable(process):
+                return process
+            asyncio.ensure_future(self._terminate(process))
+        return None
+
+    def release(self, process):
+        """Offers a process that has completed a run back to the pool.
+
+        Returns ``True`` if the pool kept the process; otherwise, the caller
+        is responsible for terminating it."""
+        process.runs += 1
+        process.log_source = None
+        if (self._stopped
+                or process.runs >= self.max_runs
+                or not self._is_usable(process)):
+            return False
+        # Hand out used processes first, so that they reach max_runs and
+        # get recycled instead of lingering in the pool.
+        self._idle.appendleft(process)
+        return True
+
+
 class Worker:
-    def __init__(self, handlers=dict(), send_timeout=10.0):
+    """Master side of a worker process.
+
+    With ``binary_framing``, messages are exchanged as binary frames in
+    which NumPy arrays are sent as raw buffers (see
+    :mod:`artiq.master.worker_framing`), instead of PYON text lines.
+
+    ``dataset_mod_window`` is a tuple ``(interval, max_mods)`` that sets
+    how broadcast dataset modifications are batched by the worker before
+    being sent (see :class:`artiq.master.worker_impl.DatasetModStream`).
+    """
+    def __init__(self, handlers=dict(), send_timeout=10.0, worker_pool=None,
+                 binary_framing=True, dataset_mod_window=(0.1, 1000)):
         self.handlers = handlers
         self.send_timeout = send_timeout
+        self.worker_pool = worker_pool
+        self.binary_framing = binary_framing
+        self.dataset_mod_window = dataset_mod_window
 
         self.rid = None
         self.filename = None
         self.ipc = None
         self.watchdogs = dict()  # wid -> expiration (using time.monotonic)
+        self._pooled = None
+        # Set when the last action (analyze) completed and the process can
+        # be returned to the worker pool.
+        self._reusable = False
 
         self.io_lock = asyncio.Lock()
         self.closed = asyncio.Event()
@@ -83,20 +259,16 @@ class Worker:
         try:
             if self.closed.is_set():
                 raise WorkerError("Attempting to create process after close")
-            self.ipc = pipe_ipc.AsyncioParentComm()
-            env = os.environ.copy()
-            env["PYTHONUNBUFFERED"] = "1"
-            await self.ipc.create_subprocess(
-                sys.executable, "-m", "artiq.master.worker_impl",
-                self.ipc.get_address(), str(log_level),
-                stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                env=env, start_new_session=True)
-            asyncio.ensure_future(
-                LogParser(self._get_log_source).stream_task(
-                    self.ipc.process.stdout))
-            asyncio.ensure_future(
-                LogParser(self._get_log_source).stream_task(
-                    self.ipc.process.stderr))
+            if self.worker_pool is not None:
+                self._pooled = self.worker_pool.take()
+            if self._pooled is not None:
+                self._pooled.log_source = self._get_log_source
+                self.ipc = self._pooled.ipc
+                self.binary_framing = self._pooled.binary_framing
+            else:
+                self.ipc = await _spawn_process(log_level,
+                                                self._get_log_source,
+                                                self.binary_framing)
         finally:
             self.io_lock.release()
 
@@ -120,6 +292,19 @@ class Worker:
                                    " (RID %s)", self.ipc.process.returncode,
                                    self.rid)
                 return
+            if self._reusable:
+                try:
+                    await self._send({"action": "reset"}, cancellable=False)
+                except:
+                    logger.debug("failed to reset worker (RID %s)", self.rid,
+                                 exc_info=True)
+                else:
+                    if self.worker_pool.release(self._pooled):
+                        logger.debug("worker returned to pool (RID %s)",
+                                     self.rid)
+                        self.ipc = None
+                        self._pooled = None
+                        return
             try:
                 await self._send({"action": "terminate"}, cancellable=False)
                 await asyncio.wait_for(self.ipc.process.wait(), term_timeout)
@@ -157,8 +342,8 @@ class Worker:
 
     async def _send(self, obj, cancellable=True):
         assert self.io_lock.locked()
-        line = pyon.encode(obj)
-        self.ipc.write((line + "\n").encode())
+        for chunk in _encode_message(obj, self.binary_framing):
+            self.ipc.write(chunk)
         ifs = [self.ipc.drain()]
         if cancellable:
             ifs.append(self.closed.wait())
@@ -176,10 +361,34 @@ class Worker:
                 "Data transmission to worker cancelled (RID {})".format(
                     self.rid))
 
+    async def _readexactly(self, n):
+        data = bytearray()
+        while len(data) < n:
+            chunk = await self.ipc.read(n - len(data))
+            if not chunk:
+                raise WorkerError(
+                    "Worker ended while attempting to receive data (RID {})".
+                    format(self.rid))
+            data += chunk
+        return data
+
+    async def _read_frame(self):
+        try:
+            return await worker_framing.read_frame_async(self._readexactly)
+        except WorkerError:
+            raise
+        except:
+            raise WorkerError("Worker sent invalid frame (RID {})".format(
+                self.rid))
+
     async def _recv(self, timeout):
         assert self.io_lock.locked()
+        if self.binary_framing:
+            read = self._read_frame()
+        else:
+            read = self.ipc.readline()
         fs = await asyncio_wait_or_cancel(
-            [self.ipc.readline(), self.closed.wait()],
+            [read, self.closed.wait()],
             timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
         if all(f.cancelled() for f in fs):
             raise WorkerTimeout(
@@ -188,6 +397,8 @@ class Worker:
             raise WorkerError(
                 "Receiving data from worker cancelled (RID {})".format(
                     self.rid))
+        if self.binary_framing:
+            return fs[0].result()
         line = fs[0].result()
         if not line:
             raise WorkerError(
@@ -217,12 +428,18 @@ class Worker:
                 return False
             elif action == "exception":
                 raise WorkerInternalException
+            elif action == "update_datasets":
+                # Sent by the worker without waiting for a reply.
+                await self._update_datasets(obj["mods"])
+                continue
             elif action == "create_watchdog":
                 func = self.create_watchdog
             elif action == "delete_watchdog":
                 func = self.delete_watchdog
             elif action == "register_experiment":
                 func = self.register_experiment
+            elif action == "register_dependencies":
+                func = self.register_dependencies
             else:
                 func = self.handlers[action]
             try:
@@ -245,7 +462,20 @@ class Worker:
             finally:
                 self.io_lock.release()
 
+    async def _update_datasets(self, mods):
+        update = self.handlers["update_dataset"]
+        for mod in mods:
+            try:
+                r = update(mod)
+                if asyncio.iscoroutine(r):
+                    await r
+            except Exception:
+                logger.warning("failed to apply dataset modification "
+                               "from worker (RID %s)", self.rid,
+                               exc_info=True)
+
     async def _worker_action(self, obj, timeout=None):
+        self._reusable = False
         if timeout is not None:
             self.watchdogs[-1] = time.monotonic() + timeout
         try:
@@ -275,7 +505,8 @@ class Worker:
              "pipeline_name": pipeline_name,
              "wd": wd,
              "expid": expid,
-             "priority": priority},
+             "priority": priority,
+             "dataset_mod_window": self.dataset_mod_window},
             timeout)
 
     async def prepare(self):
@@ -299,8 +530,15 @@ class Worker:
 
     async def analyze(self):
         await self._worker_action({"action": "analyze"})
+        self._reusable = self._pooled is not None
+
+    async def examine(self, rid, file, timeout=20.0, dependencies=None):
+        """Returns the descriptions of the experiments in ``file``.
 
-    async def examine(self, rid, file, timeout=20.0):
+        If ``dependencies`` is a dictionary, it receives the absolute paths
+        of the files of the modules imported while examining ``file``
+        (``"files"``), and whether the experiments read the device or the
+        dataset database (``"databases"``)."""
         self.rid = rid
         self.filename = os.path.basename(file)
 
@@ -316,7 +554,14 @@ class Worker:
                 "scheduler_defaults": scheduler_defaults
             }
         self.register_experiment = register
+
+        def register_dependencies(files, databases):
+            if dependencies is not None:
+                dependencies["files"] = files
+                dependencies["databases"] = databases
+        self.register_dependencies = register_dependencies
         await self._worker_action({"action": "examine", "file": file},
                                   timeout)
         del self.register_experiment
+        del self.register_dependencies
         return r
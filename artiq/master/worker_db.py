@@ -5,10 +5,14 @@ standalone command line tools).
 """
 
 from operator import setitem
+import copy
 import importlib
 import logging
+import threading
 
-from sipyco.sync_struct import Notifier
+import numpy
+
+from sipyco.sync_struct import Notifier, process_mod
 from sipyco.pc_rpc import AutoTarget, Client, BestEffortClient
 
 
@@ -101,6 +105,14 @@ class DeviceManager:
             if hasattr(dev, "notify_run_end"):
                 dev.notify_run_end()
 
+    def write_results(self, f):
+        """Lets active devices save data in the HDF5 results file ``f``."""
+        for _desc, dev in self.active_devices:
+            if isinstance(dev, (Client, BestEffortClient)):
+                continue
+            if hasattr(dev, "write_results"):
+                dev.write_results(f)
+
     def close_devices(self):
         """Closes all active devices, in the opposite order as they were
         requested."""
@@ -116,6 +128,126 @@ class DeviceManager:
         self.active_devices.clear()
 
 
+def _copy_mutable(value):
+    # Only containers can be modified in place by the experiment.
+    if isinstance(value, (numpy.ndarray, list, dict)):
+        return copy.deepcopy(value)
+    return value
+
+
+def _copy_mod(mod):
+    mod = dict(mod)
+    if "x" in mod:
+        mod["x"] = _copy_mutable(mod["x"])
+    elif "value" in mod:
+        if mod["path"]:
+            mod["value"] = _copy_mutable(mod["value"])
+        else:
+            persist, value, metadata = mod["value"]
+            mod["value"] = persist, _copy_mutable(value), metadata
+    return mod
+
+
+class DatasetModStream:
+    """Sends broadcast dataset modifications to the master without waiting
+    for a reply.
+
+    Modifications are queued and sent in batches, at the latest
+    ``interval`` seconds after the first queued modification or when
+    ``max_mods`` modifications are queued. A modification that replaces or
+    deletes a key drops the queued modifications to that key, and
+    modifications to a key that is going to be replaced are applied to the
+    value to be sent. Consecutive assignments
+    to the same item of a dataset are merged. Otherwise, the order of the
+    modifications to each key is preserved.
+
+    The lists, dictionaries and NumPy arrays of modifications that are
+    queued until a later flush are copied, so that later modifications of
+    the values by the experiment do not affect what is sent. Modifications
+    sent immediately are not copied.
+
+    ``send`` is called with a list of modifications to send them. The
+    lock is held during the call, so that they are sent before any request
+    made after a :meth:`flush`. The worker flushes the queue before any
+    request to the master, and at the end of each stage.
+    """
+    def __init__(self, send, interval=0.1, max_mods=1000):
+        self.send = send
+        self.interval = interval
+        self.max_mods = max_mods
+
+        self._lock = threading.Lock()
+        self._queued = threading.Condition(self._lock)
+        self._thread = None
+        self._pending = []
+        self._key_mods = dict()  # key -> indices in self._pending
+        self._replaced = set()  # keys with a pending setitem/delitem
+
+    def update(self, mod):
+        if mod["path"]:
+            key = mod["path"][0]
+        else:
+            key = mod["key"]
+        with self._lock:
+            indices = self._key_mods.setdefault(key, [])
+            if not mod["path"]:
+                for i in indices:
+                    self._pending[i] = None
+                indices.clear()
+                self._replaced.add(key)
+            elif key in self._replaced:
+                # Apply the modification to the copy of the value to be sent.
+                replacement = self._pending[indices[-1]]
+                process_mod({key: replacement["value"]}, _copy_mod(mod))
+                return
+            elif indices:
+                last = self._pending[indices[-1]]
+                if (mod["action"] == "setitem"
+                        and last["action"] == "setitem"
+                        and last["path"] == mod["path"]
+                        and last["key"] == mod["key"]):
+                    self._pending[indices[-1]] = _copy_mod(mod)
+                    return
+            send_now = (len(self._pending) + 1 >= self.max_mods
+                        or self.interval <= 0)
+            if not send_now:
+                # The values are sent later by another thread, while the
+                # experiment may keep modifying them: queue a copy of their
+                # current state.
+                mod = _copy_mod(mod)
+            indices.append(len(self._pending))
+            self._pending.append(mod)
+
+            if send_now:
+                self._flush()
+            elif len(self._pending) == 1:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._flush_thread,
+                                                    daemon=True)
+                    self._thread.start()
+                self._queued.notify()
+
+    def _flush(self):
+        mods = [mod for mod in self._pending if mod is not None]
+        self._pending.clear()
+        self._key_mods.clear()
+        self._replaced.clear()
+        if mods:
+            self.send(mods)
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def _flush_thread(self):
+        with self._lock:
+            while True:
+                while not self._pending:
+                    self._queued.wait()
+                self._queued.wait(self.interval)
+                self._flush()
+
+
 class DatasetManager:
     def __init__(self, ddb):
         self._broadcaster = Notifier(dict())
@@ -0,0 +1,142 @@
+"""Binary framing of the messages exchanged between the master and its
+workers.
+
+By default, messages are PYON text lines. With binary framing, each message
+is sent as a frame made of a length-prefixed PYON header followed by the
+raw contents of the NumPy arrays it contains, so that large arrays (e.g.
+in dataset modifications) are not converted to and from text.
+
+Frame layout (little endian)::
+
+    u64 header length | u64 number of buffers | header (PYON, UTF-8)
+    for each buffer: u64 buffer length | buffer contents
+
+The header is the PYON encoding of ``(obj, arrays)``, where ``obj`` is the
+message with each extracted array replaced by ``None``, and ``arrays`` is a
+list of ``(path, dtype_descr, shape)`` giving the location of each array in
+the message, in buffer order.
+"""
+
+import struct
+
+import numpy
+from numpy.lib.format import dtype_to_descr, descr_to_dtype
+
+from sipyco import pyon
+
+
+__all__ = ["encode", "read_frame", "read_frame_async",
+           "encode_bytes", "decode_bytes"]
+
+
+_frame_header = struct.Struct("<QQ")
+_buffer_header = struct.Struct("<Q")
+
+
+def _extract_arrays(obj, path, arrays):
+    if isinstance(obj, numpy.ndarray) and not obj.dtype.hasobject:
+        arrays.append((path, obj))
+        return None
+    elif isinstance(obj, dict):
+        items = [(k, _extract_arrays(v, path + [k], arrays))
+                 for k, v in obj.items()]
+        return type(obj)(items)
+    elif isinstance(obj, list):
+        return [_extract_arrays(v, path + [i], arrays)
+                for i, v in enumerate(obj)]
+    elif isinstance(obj, tuple):
+        return tuple(_extract_arrays(v, path + [i], arrays)
+                     for i, v in enumerate(obj))
+    else:
+        return obj
+
+
+def _insert(obj, path, value):
+    if not path:
+        return value
+    k, rest = path[0], path[1:]
+    if isinstance(obj, tuple):
+        return obj[:k] + (_insert(obj[k], rest, value),) + obj[k+1:]
+    obj[k] = _insert(obj[k], rest, value)
+    return obj
+
+
+def encode(obj):
+    """Encodes a message into a frame.
+
+    Returns a list of bytes-like objects to be written in order. The
+    contents of C-contiguous arrays are not copied."""
+    arrays = []
+    obj = _extract_arrays(obj, [], arrays)
+    header = pyon.encode(
+        (obj, [(path, dtype_to_descr(a.dtype), a.shape)
+               for path, a in arrays])).encode()
+    chunks = [_frame_header.pack(len(header), len(arrays)), header]
+    for _, a in arrays:
+        data = memoryview(numpy.ascontiguousarray(a)).cast("B")
+        chunks.append(_buffer_header.pack(data.nbytes))
+        chunks.append(data)
+    return chunks
+
+
+def _decode(header, buffers):
+    obj, arrays = pyon.decode(header.decode())
+    for (path, descr, shape), data in zip(arrays, buffers):
+        a = numpy.frombuffer(data, dtype=descr_to_dtype(descr)).reshape(shape)
+        obj = _insert(obj, path, a)
+    return obj
+
+
+def read_frame(readexactly):
+    """Reads and decodes a frame using the given blocking
+    ``readexactly(n)`` function.
+
+    ``readexactly`` should return a ``bytearray``, so that the decoded
+    arrays are writable."""
+    header_length, n_buffers = _frame_header.unpack(
+        readexactly(_frame_header.size))
+    header = readexactly(header_length)
+    buffers = []
+    for _ in range(n_buffers):
+        length, = _buffer_header.unpack(readexactly(_buffer_header.size))
+        buffers.append(readexactly(length))
+    return _decode(header, buffers)
+
+
+async def read_frame_async(readexactly):
+    """Same as :func:`read_frame`, with a coroutine ``readexactly(n)``."""
+    header_length, n_buffers = _frame_header.unpack(
+        await readexactly(_frame_header.size))
+    header = await readexactly(header_length)
+    buffers = []
+    for _ in range(n_buffers):
+        length, = _buffer_header.unpack(
+            await readexactly(_buffer_header.size))
+        buffers.append(await readexactly(length))
+    return _decode(header, buffers)
+
+
+def encode_bytes(obj):
+    """Encodes a message into a frame, returned as a single ``bytes``
+    object."""
+    return b"".join(encode(obj))
+
+
+def decode_bytes(data, offset=0):
+    """Decodes a frame from a bytes-like object, starting at ``offset``.
+    The decoded arrays do not share memory with ``data``.
+
+    Returns a tuple of the decoded object and the offset of the end of the
+    frame."""
+    data = memoryview(data)
+    pos = offset
+
+    def readexactly(n):
+        nonlocal pos
+        if pos + n > len(data):
+            raise ValueError("truncated frame")
+        chunk = bytearray(data[pos:pos+n])
+        pos += n
+        return chunk
+    obj = read_frame(readexactly)
+    return obj, pos
@@ -11,6 +11,7 @@ import time
 import os
 import inspect
 import logging
+import threading
 import traceback
 from collections import OrderedDict
 import importlib.util
@@ -24,7 +25,9 @@ from sipyco.logging_tools import multiline_log_config
 
 import artiq
 from artiq import tools
-from artiq.master.worker_db import DeviceManager, DatasetManager, DummyDevice
+from artiq.master.worker_db import (DeviceManager, DatasetManager,
+                                   DummyDevice, DatasetModStream)
+from artiq.master import worker_framing
 from artiq.language.environment import (
     is_public_experiment, TraceArgumentManager, ProcessArgumentManager
 )
@@ -36,21 +39,57 @@ from artiq import __version__ as artiq_version
 
 
 ipc = None
+# Selected by the master with the "set_framing" action.
+binary_framing = False
+# Serializes writes from the main thread and the dataset mod stream.
+ipc_lock = threading.Lock()
+
+
+def _readexactly(n):
+    data = bytearray()
+    while len(data) < n:
+        chunk = ipc.read(n - len(data))
+        if not chunk:
+            raise EOFError
+        data += chunk
+    return data
+
+
+def _write(data):
+    # Writes to the unbuffered pipe may be partial.
+    data = memoryview(data)
+    while data:
+        written = ipc.write(data)
+        if written is None:
+            break
+        data = data[written:]
 
 
 def get_object():
+    if binary_framing:
+        return worker_framing.read_frame(_readexactly)
     line = ipc.readline().decode()
     return pyon.decode(line)
 
 
 def put_object(obj):
-    ds = pyon.encode(obj)
-    ipc.write((ds + "\n").encode())
+    if binary_framing:
+        chunks = worker_framing.encode(obj)
+    else:
+        chunks = [(pyon.encode(obj) + "\n").encode()]
+    with ipc_lock:
+        for chunk in chunks:
+            _write(chunk)
+
+
+dataset_mods = DatasetModStream(
+    lambda mods: put_object({"action": "update_datasets", "mods": mods}))
 
 
 def make_parent_action(action):
     def parent_action(*args, **kwargs):
         request = {"action": action, "args": args, "kwargs": kwargs}
+        dataset_mods.flush()
         put_object(request)
         reply = get_object()
         if "action" in reply:
@@ -72,7 +111,7 @@ class ParentDeviceDB:
 
 class ParentDatasetDB:
     get = make_parent_action("get_dataset")
-    update = make_parent_action("update_dataset")
+    update = dataset_mods.update
     get_metadata = make_parent_action("get_dataset_metadata")
 
 
@@ -171,11 +210,44 @@ def get_experiment_from_content(content, class_name):
     return tools.get_experiment(module, class_name)
 
 
+def forget_modules(previous_keys, paths):
+    """Removes the modules imported since ``previous_keys`` was taken from
+    ``sys.modules`` if they were loaded from under one of ``paths``, so
+    that the next run imports them again from their current source.
+
+    Other modules (standard library, third-party packages and their C
+    extensions) are kept, as they cannot safely be imported twice in the
+    same process."""
+    prefixes = tuple(os.path.join(os.path.realpath(path), "")
+                     for path in paths)
+    for key in set(sys.modules.keys()) - previous_keys:
+        module = sys.modules[key]
+        files = list(getattr(module, "__path__", []))
+        module_file = getattr(module, "__file__", None)
+        if module_file is not None:
+            files.append(module_file)
+        if any(os.path.realpath(file).startswith(prefixes) for file in files):
+            del sys.modules[key]
+
+
 register_experiment = make_parent_action("register_experiment")
+register_dependencies = make_parent_action("register_dependencies")
+
+
+# Set when the experiments being examined read the device or dataset
+# database, in which case their description may not only depend on the
+# code.
+examine_used_databases = False
 
 
 class ExamineDeviceMgr:
-    get_device_db = make_parent_action("get_device_db")
+    _get_device_db = make_parent_action("get_device_db")
+
+    @staticmethod
+    def get_device_db():
+        global examine_used_databases
+        examine_used_databases = True
+        return ExamineDeviceMgr._get_device_db()
 
     @staticmethod
     def get(name):
@@ -185,14 +257,20 @@ class ExamineDeviceMgr:
 class ExamineDatasetMgr:
     @staticmethod
     def get(key, archive=False):
+        global examine_used_databases
+        examine_used_databases = True
         return ParentDatasetDB.get(key)
 
     @staticmethod
     def get_metadata(key):
+        global examine_used_databases
+        examine_used_databases = True
         return ParentDatasetDB.get_metadata(key)
 
 
 def examine(device_mgr, dataset_mgr, file):
+    global examine_used_databases
+    examine_used_databases = False
     previous_keys = set(sys.modules.keys())
     try:
         module = tools.file_import(file)
@@ -214,6 +292,14 @@ def examine(device_mgr, dataset_mgr, file):
             if hasattr(exp_class, "argument_ui"):
                 argument_ui = exp_class.argument_ui
             register_experiment(class_name, name, arginfo, argument_ui, scheduler_defaults)
+        # Report the files of the imported modules, so that the master can
+        # tell when the description of the experiments may have changed.
+        files = []
+        for key in set(sys.modules.keys()) - previous_keys:
+            module_file = getattr(sys.modules[key], "__file__", None)
+            if module_file is not None:
+                files.append(os.path.abspath(module_file))
+        register_dependencies(sorted(files), examine_used_databases)
     finally:
         new_keys = set(sys.modules.keys())
         for key in new_keys - previous_keys:
@@ -260,6 +346,7 @@ def setup_diagnostics(experiment_file, repository_path):
 
 
 def put_completed():
+    dataset_mods.flush()
     put_object({"action": "completed"})
 
 
@@ -280,11 +367,12 @@ def put_exception_report():
             lines += traceback.format_exception_only(type(exc), exc)
         logging.error("".join(lines).rstrip(),
                       exc_info=not hasattr(exc, "parent_traceback"))
+    dataset_mods.flush()
     put_object({"action": "exception"})
 
 
 def main():
-    global ipc
+    global ipc, binary_framing
 
     multiline_log_config(level=int(sys.argv[2]))
     ipc = pipe_ipc.ChildComm(sys.argv[1])
@@ -301,6 +389,7 @@ def main():
         filename = "{:09}-{}.h5".format(rid, exp.__name__)
         with h5py.File(filename, "w") as f:
             dataset_mgr.write_hdf5(f)
+            device_mgr.write_results(f)
             f["artiq_version"] = artiq_version
             f["rid"] = rid
             f["start_time"] = start_time
@@ -314,6 +403,13 @@ def main():
 
     import_cache.install_hook()
 
+    # State to restore when the process is reset to serve another run
+    # (see artiq.master.worker.WorkerPool).
+    initial_cwd = os.getcwd()
+    initial_modules = set(sys.modules.keys())
+    # Directories from which the modules of the experiment are imported
+    experiment_paths = []
+
     try:
         while True:
             obj = get_object()
@@ -322,6 +418,11 @@ def main():
                 start_time = time.time()
                 rid = obj["rid"]
                 expid = obj["expid"]
+                # The process may have been started before the run was
+                # submitted, with a different log level.
+                logging.getLogger().setLevel(expid["log_level"])
+                dataset_mods.interval, dataset_mods.max_mods = \
+                    obj["dataset_mod_window"]
                 if "devarg_override" in expid:
                     device_mgr.devarg_override = expid["devarg_override"]
                 if "file" in expid:
@@ -332,6 +433,10 @@ def main():
                     else:
                         experiment_file = expid["file"]
                         repository_path = None
+                    experiment_paths.append(
+                        os.path.dirname(os.path.abspath(experiment_file)))
+                    if repository_path is not None:
+                        experiment_paths.append(repository_path)
                     setup_diagnostics(experiment_file, repository_path)
                     exp = get_experiment_from_file(experiment_file, expid["class_name"])
                 else:
@@ -383,6 +488,21 @@ def main():
             elif action == "examine":
                 examine(ExamineDeviceMgr, ExamineDatasetMgr, obj["file"])
                 put_completed()
+            elif action == "set_framing":
+                binary_framing = obj["framing"] == "binary"
+            elif action == "reset":
+                device_mgr.close_devices()
+                device_mgr.devarg_override = {}
+                dataset_mgr = DatasetManager(ParentDatasetDB)
+                start_time = run_time = rid = expid = None
+                exp = exp_inst = repository_path = None
+                os.chdir(initial_cwd)
+                forget_modules(initial_modules, experiment_paths)
+                experiment_paths = []
+                # The sources of the previous experiment, used to report
+                # errors in kernels.
+                import_cache.cache.clear()
+                linecache.clearcache()
             elif action == "terminate":
                 break
     except:
@@ -0,0 +1,190 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy
+
+from artiq.experiment import *
+from artiq.coredevice.core import Core
+from artiq.compiler import embedding
+from artiq.compiler.embedding import Stitcher
+from artiq.compiler.targets import RV32GTarget
+from artiq.compiler.kernel_cache import (KernelDigest, CachedKernel,
+                                         KernelCache, KernelFile, kernel_key)
+
+
+class _Device:
+    kernel_invariants = {"offset"}
+
+    def __init__(self, core, offset):
+        self.core = core
+        self.offset = offset
+        self.values = numpy.array([1.0, 2.0, 3.0])
+        self.count = 0
+
+    @kernel
+    def run(self):
+        self.count += 1
+        return self.offset + self.values[self.count % 3]
+
+
+class _Experiment:
+    def __init__(self, core, offsets):
+        self.core = core
+        self.devices = [_Device(core, offset) for offset in offsets]
+
+    @kernel
+    def run(self):
+        for device in self.devices:
+            device.run()
+
+
+class KernelCacheCase(unittest.TestCase):
+    def setUp(self):
+        self.core = Core({}, host=None, ref_period=1e-9)
+        self.core.dmgr = {"core": self.core}
+
+    def stitch(self, experiment):
+        stitcher = Stitcher(core=self.core, dmgr=self.core.dmgr)
+        stitcher.stitch_call(experiment.run, (), {})
+        stitcher.finalize()
+        return stitcher
+
+    def digest(self, experiment):
+        return KernelDigest(self.stitch(experiment))
+
+    def test_digest(self):
+        digest = self.digest(_Experiment(self.core, [1.0, 2.0]))
+        self.assertEqual(digest.digest,
+                         self.digest(_Experiment(self.core, [1.0, 2.0])).digest)
+        self.assertEqual([type(obj) for obj in digest.objects],
+                         [_Experiment, type, _Device, type, _Device])
+
+        self.assertNotEqual(digest.digest,
+                            self.digest(_Experiment(self.core, [1.0, 3.0])).digest)
+        self.assertNotEqual(digest.digest,
+                            self.digest(_Experiment(self.core, [1.0])).digest)
+        experiment = _Experiment(self.core, [1.0, 2.0])
+        experiment.devices[1].values[2] = 4.0
+        self.assertNotEqual(digest.digest, self.digest(experiment).digest)
+
+    def test_key(self):
+        stitcher = self.stitch(_Experiment(self.core, [1.0]))
+        digest = KernelDigest(stitcher)
+        key = kernel_key(digest, RV32GTarget(), stitcher.embedding_map,
+                         attribute_writeback=True)
+        self.assertEqual(key, kernel_key(digest, RV32GTarget(), stitcher.embedding_map,
+                                         attribute_writeback=True))
+        self.assertNotEqual(key, kernel_key(digest, RV32GTarget(), stitcher.embedding_map,
+                                            attribute_writeback=False))
+        self.assertNotEqual(key, kernel_key(digest, RV32GTarget(subkernel_id=1),
+                                            stitcher.embedding_map,
+                                            attribute_writeback=True))
+
+    def record(self, experiment):
+        stitcher = self.stitch(experiment)
+        digest = KernelDigest(stitcher)
+        embedding_map = stitcher.embedding_map
+        snapshot = CachedKernel.snapshot(embedding_map)
+        # Code generation assigns IDs to the quoted objects.
+        for obj in digest.objects:
+            embedding_map.store_object(obj)
+        embedding_map.store_str("message")
+        return CachedKernel.record(digest, snapshot, embedding_map,
+                                   b"library", b"stripped"), embedding_map
+
+    def test_restore(self):
+        original = _Experiment(self.core, [1.0, 2.0])
+        cached, embedding_map = self.record(original)
+        self.assertEqual(len(cached.objects), 5)
+        self.assertEqual(cached.strings, ["message"])
+
+        experiment = _Experiment(self.core, [1.0, 2.0])
+        stitcher = self.stitch(experiment)
+        digest = KernelDigest(stitcher)
+        cached.restore(digest, stitcher.embedding_map)
+        restored = stitcher.embedding_map
+        self.assertEqual(restored.object_current_key, embedding_map.object_current_key)
+        self.assertEqual(restored.str_forward_map, embedding_map.str_forward_map)
+        for key, obj in embedding_map.object_forward_map.items():
+            self.assertIs(type(restored.retrieve_object(key)), type(obj))
+        for device, original_device in zip(experiment.devices, original.devices):
+            key = embedding_map.store_object(original_device)
+            self.assertIs(restored.retrieve_object(key), device)
+            self.assertEqual(restored.store_object(device), key)
+
+    def test_cache(self):
+        cached, _ = self.record(_Experiment(self.core, [1.0]))
+        with tempfile.TemporaryDirectory() as directory:
+            cache = KernelCache(max_entries=1, directory=directory)
+            self.assertIsNone(cache.get("a"))
+            cache.put("a", cached)
+            cache.put("b", cached)
+            self.assertEqual(list(cache.entries.keys()), ["b"])
+            self.assertEqual(len(os.listdir(directory)), 2)
+
+            loaded = cache.get("a")
+            self.assertEqual(loaded.library, b"library")
+            self.assertEqual(loaded.stripped_library, b"stripped")
+            self.assertEqual(loaded.objects, cached.objects)
+            self.assertEqual(loaded.strings, cached.strings)
+            self.assertEqual(loaded.object_current_key, cached.object_current_key)
+            self.assertIs(cache.get("a"), loaded)
+            self.assertEqual((cache.hits, cache.misses), (2, 1))
+            self.assertAlmostEqual(cache.hit_rate(), 2/3)
+
+    def test_file(self):
+        cached, _ = self.record(_Experiment(self.core, [1.0]))
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, "kernels", "run.kernel")
+            self.assertIsNone(KernelFile(filename).get("a"))
+            KernelFile(filename).put("a", cached)
+
+            kernel_file = KernelFile(filename)
+            self.assertIsNone(kernel_file.get("b"))
+            self.assertIsNone(kernel_file.kernel)
+            loaded = kernel_file.get("a")
+            self.assertEqual(loaded.stripped_library, b"stripped")
+            self.assertIs(kernel_file.kernel, loaded)
+
+    @unittest.skipUnless(shutil.which(RV32GTarget.tool_ld), "LLVM tools not available")
+    def test_precompile_cached(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, "run.kernel")
+            experiment = _Experiment(self.core, [1.0, 2.0])
+            self.core.precompile_cached(filename, experiment.run)()
+            with open(filename, "rb") as f:
+                stored = f.read()
+
+            # A new process would stitch new host objects.
+            experiment = _Experiment(self.core, [1.0, 2.0])
+            with mock.patch.object(RV32GTarget, "compile_and_link",
+                                   side_effect=AssertionError):
+                self.core.precompile_cached(filename, experiment.run)()
+
+            experiment.devices[0].offset = 3.0
+            self.core.precompile_cached(filename, experiment.run)()
+            with open(filename, "rb") as f:
+                self.assertNotEqual(f.read(), stored)
+
+
+class ParsetreeCacheCase(unittest.TestCase):
+    def test_reuse(self):
+        core = Core({}, host=None, ref_period=1e-9)
+        core.dmgr = {"core": core}
+
+        def stitch():
+            stitcher = Stitcher(core=core, dmgr=core.dmgr)
+            stitcher.stitch_call(_Experiment(core, [1.0]).run, (), {})
+            stitcher.finalize()
+            return stitcher
+
+        embedding._parsetree_cache.clear()
+        digest = KernelDigest(stitch()).digest
+        parsetrees = list(embedding._parsetree_cache.values())
+        self.assertEqual(len(parsetrees), 2)
+
+        self.assertEqual(KernelDigest(stitch()).digest, digest)
+        self.assertEqual(list(embedding._parsetree_cache.values()), parsetrees)
@@ -0,0 +1,43 @@
+import unittest
+
+from artiq.compiler.module import Module, Source, PassManager
+
+
+class PassManagerCase(unittest.TestCase):
+    source = ("def f(x):\n"
+              "    return x * 2\n"
+              "def g():\n"
+              "    return f(1) + 1.0\n")
+
+    def compile(self, pass_manager):
+        return Module(Source.from_string(self.source), pass_manager=pass_manager)
+
+    def test_timings(self):
+        pass_manager = PassManager(count_nodes=True)
+        module = self.compile(pass_manager)
+        self.assertIs(module.pass_manager, pass_manager)
+        names = [name for name, _, _ in pass_manager.timings]
+        self.assertEqual(names[:3], ["IntMonomorphizer", "CastMonomorphizer", "Inferencer"])
+        self.assertEqual(names[-1], "ConstantHoister")
+        self.assertEqual(len(pass_manager.node_counts), len(names))
+        self.assertTrue(all(count > 0 for count in pass_manager.node_counts))
+
+        report = pass_manager.report().splitlines()
+        self.assertEqual(report[0].split(), ["Pass", "Time", "(ms)", "Nodes"])
+        self.assertEqual([line.split()[0] for line in report[1:]], names + ["Total"])
+
+        self.assertEqual(PassManager().node_counts, [])
+        self.compile(None)
+
+    def test_passes(self):
+        passes = ["IntMonomorphizer", "Inferencer", "ARTIQIRGenerator",
+                  "LocalDemoter", "DeadCodeEliminator"]
+        pass_manager = PassManager(passes)
+        self.compile(pass_manager)
+        self.assertEqual([name for name, _, _ in pass_manager.timings], passes)
+        self.assertEqual(pass_manager.node_counts, [])
+
+        with self.assertRaisesRegex(ValueError, "Unknown pass"):
+            self.compile(PassManager(["Inferencer", "ARTIQIRGenerator", "Optimizer"]))
+        with self.assertRaisesRegex(ValueError, "cannot be skipped"):
+            self.compile(PassManager(["Inferencer"]))
@@ -0,0 +1,84 @@
+import shutil
+import unittest
+from concurrent.futures.process import BrokenProcessPool
+from unittest import mock
+
+from artiq.experiment import *
+from artiq.coredevice import core as core_driver
+from artiq.coredevice.core import Core
+from artiq.compiler.targets import RV32GTarget
+
+
+class _Experiment:
+    def __init__(self, core):
+        self.core = core
+        self.scale = 3
+
+    @subkernel(destination=1)
+    def first(self, x: TInt32) -> TInt32:
+        self.third(x)
+        return x * self.scale + subkernel_await(self.third)
+
+    @subkernel(destination=2)
+    def second(self, x: TInt32) -> TInt32:
+        return x - self.scale
+
+    @subkernel(destination=2)
+    def third(self, x: TInt32) -> TInt32:
+        return x + 1
+
+    @kernel
+    def run(self):
+        self.first(1)
+        self.second(2)
+        subkernel_await(self.first)
+        subkernel_await(self.second)
+
+
+@unittest.skipUnless(shutil.which(RV32GTarget.tool_ld), "LLVM tools not available")
+class SubkernelCase(unittest.TestCase):
+    def compile(self):
+        core = Core({}, host=None, ref_period=1e-9,
+                    satellite_cpu_targets={1: "rv32g", 2: "rv32g"})
+        core.dmgr = {"core": core}
+        experiment = _Experiment(core)
+        embedding_map, _, _, _, subkernel_arg_types = \
+            core.compile(_Experiment.run, [experiment], {})
+        _, subkernels = core.compile_subkernels(embedding_map, [experiment],
+                                                subkernel_arg_types)
+        return list(subkernels)
+
+    def test_deterministic(self):
+        subkernels = self.compile()
+        self.assertEqual([destination for _, destination, _ in subkernels], [1, 2, 2])
+        self.assertEqual(len(set(sid for sid, _, _ in subkernels)), 3)
+        self.assertEqual(self.compile(), subkernels)
+        # Dumping compiles the subkernels in-process.
+        with mock.patch.dict("os.environ", {"ARTIQ_DUMP_NONE": ""}):
+            self.assertEqual(self.compile(), subkernels)
+
+    def test_parallel(self):
+        with mock.patch("os.cpu_count", return_value=1):
+            subkernels = self.compile()
+        with mock.patch("os.cpu_count", return_value=4), \
+                mock.patch.object(core_driver, "_can_spawn", return_value=True):
+            self.assertEqual(self.compile(), subkernels)
+        self.assertIsNotNone(core_driver._subkernel_executor)
+        core_driver._shutdown_subkernel_executor()
+        self.assertIsNone(core_driver._subkernel_executor)
+
+    def test_in_process(self):
+        subkernels = self.compile()
+        # Scripts that cannot be imported again by worker processes.
+        with mock.patch("os.cpu_count", return_value=4), \
+                mock.patch.object(core_driver, "_can_spawn", return_value=False):
+            self.assertEqual(self.compile(), subkernels)
+        self.assertIsNone(core_driver._subkernel_executor)
+
+        executor = mock.Mock()
+        executor.submit.side_effect = BrokenProcessPool
+        with mock.patch("os.cpu_count", return_value=4), \
+                mock.patch.object(core_driver, "_get_subkernel_executor",
+                                  return_value=executor), \
+                self.assertLogs(core_driver.logger, "WARNING"):
+            self.assertEqual(self.compile(), subkernels)
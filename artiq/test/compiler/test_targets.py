@@ -0,0 +1,82 @@
+import io
+import os
+import shutil
+import struct
+import unittest
+from contextlib import redirect_stderr
+from unittest import mock
+
+from artiq.compiler.module import Module, Source
+from artiq.compiler import targets
+from artiq.compiler.targets import RV32GTarget, RunTool, _strip_debug
+
+
+def sections(library):
+    e_shoff, = struct.unpack_from("<I", library, 32)
+    e_shentsize, e_shnum, e_shstrndx = struct.unpack_from("<HHH", library, 46)
+    headers = [struct.unpack_from("<IIIIIIIIII", library, e_shoff + index * e_shentsize)
+               for index in range(e_shnum)]
+    shstrtab = headers[e_shstrndx][4]
+    result = {}
+    for header in headers[1:]:
+        name_start = shstrtab + header[0]
+        name = library[name_start:library.index(b"\0", name_start)].decode()
+        result[name] = library[header[4]:header[4] + header[5]] if header[1] != 8 else b""
+    return result
+
+
+@unittest.skipUnless(shutil.which(RV32GTarget.tool_ld) and shutil.which(RV32GTarget.tool_strip),
+                     "LLVM tools not available")
+class StripCase(unittest.TestCase):
+    def test_strip_debug(self):
+        target = RV32GTarget()
+        library = target.compile_and_link([Module(Source.from_string(
+            "def f(x):\n"
+            "    return x * 2\n"
+            "def g():\n"
+            "    return f(1) + 1.0\n"))])
+        with RunTool([target.tool_strip, "--strip-debug", "{library}", "-o", "{output}"],
+                     library=library, output=None) as results:
+            expected = results["output"].read()
+
+        stripped = _strip_debug(library)
+        self.assertLess(len(stripped), len(library))
+        self.assertTrue(any(name.startswith(".debug") for name in sections(library)))
+        self.assertEqual(sections(stripped).keys(), sections(expected).keys())
+        for name, contents in sections(stripped).items():
+            if name not in (".shstrtab", ".strtab", ".symtab"):
+                self.assertEqual(contents, sections(expected)[name], name)
+
+        self.assertEqual(_strip_debug(stripped), stripped)
+        with self.assertRaises(ValueError):
+            _strip_debug(b"\0" * 64)
+
+
+@unittest.skipUnless(shutil.which(RV32GTarget.tool_ld), "LLVM tools not available")
+class CompileCase(unittest.TestCase):
+    source = ("def f(x):\n"
+              "    return x * 2\n"
+              "def g():\n"
+              "    return f(1)\n")
+
+    def test_optimized_ir_cache(self):
+        def compile():
+            target = RV32GTarget()
+            return target.assemble(target.compile(Module(Source.from_string(self.source))))
+
+        targets._optimized_ir_cache.clear()
+        obj = compile()
+        self.assertEqual(len(targets._optimized_ir_cache), 1)
+        with mock.patch.object(RV32GTarget, "optimize", side_effect=AssertionError):
+            self.assertEqual(compile(), obj)
+        self.assertEqual(len(targets._optimized_ir_cache), 1)
+
+    def test_timings(self):
+        stderr = io.StringIO()
+        with mock.patch.dict(os.environ, {"ARTIQ_DUMP_TIMINGS": "1"}), redirect_stderr(stderr):
+            RV32GTarget().compile_and_link([Module(Source.from_string(self.source))])
+        output = stderr.getvalue()
+        self.assertIn("COMPILATION TIMINGS", output)
+        self.assertIn("LLVM machine code emission", output)
+        self.assertIn("Linking", output)
+        self.assertIn("Total", output)
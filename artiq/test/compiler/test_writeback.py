@@ -0,0 +1,59 @@
+import unittest
+
+import numpy
+
+from artiq.experiment import *
+from artiq.coredevice.core import Core
+from artiq.compiler.embedding import Stitcher
+from artiq.compiler.module import Module
+from artiq.compiler.targets import RV32GTarget
+
+
+class _Device:
+    kernel_invariants = {"offset"}
+
+    def __init__(self, core):
+        self.core = core
+        self.offset = 1.0
+        self.values = numpy.array([1.0, 2.0])
+        self.count = 0
+        self.step = 1
+        self.name = "device"
+
+    @kernel
+    def run(self):
+        self.count += self.step
+        return self.offset + self.values[0]
+
+
+class _Experiment:
+    def __init__(self, core):
+        self.core = core
+        self.first = _Device(core)
+        self.second = _Device(core)
+
+    @kernel
+    def run(self):
+        self.first.run()
+        self.second.run()
+
+
+class WritebackCase(unittest.TestCase):
+    def test_stored_attributes(self):
+        core = Core({}, host=None, ref_period=1e-9)
+        core.dmgr = {"core": core}
+        stitcher = Stitcher(core=core, dmgr=core.dmgr)
+        stitcher.stitch_call(_Experiment(core).run, (), {})
+        stitcher.finalize()
+        llmodule = Module(stitcher, ref_period=1e-9).build_llvm_ir(RV32GTarget())
+
+        type_name = "{}._Device".format(__name__)
+        names = {name for name in llmodule.globals if name.startswith("N.")}
+        # Stored to, and modifiable in place.
+        self.assertEqual(names, {"N.{}.count".format(type_name),
+                                 "N.{}.values".format(type_name)})
+        objects = llmodule.globals["Ox.I.{}".format(type_name)].initializer
+        self.assertEqual(len(objects.constant), 2)
+        arguments = llmodule.globals["Wx"].initializer
+        self.assertEqual(len(arguments.constant), 2 * 2 * 3)
+        self.assertIn("writeback", llmodule.globals)
@@ -20,6 +20,10 @@ array_small = numpy.array(list_small, numpy.int32)
 byte_list_large = [True] * (1 << 20)
 byte_list_small = [True] * (1 << 10)
 
+# (int32, float) tuples: 12 bytes each
+tuple_list_large = [(123, 1.5)] * ((1 << 20) // 12)
+tuple_list_small = [(123, 1.5)] * ((1 << 10) // 12)
+
 received_bytes = 0
 time_start = 0
 time_end = 0
@@ -59,6 +63,13 @@ class _Transfer(EnvExperiment):
         else:
             return array_small
 
+    @rpc
+    def get_tuple_list(self, large: TBool) -> TList(TTuple([TInt32, TFloat])):
+        if large:
+            return tuple_list_large
+        else:
+            return tuple_list_small
+
     @rpc
     def get_string_list(self) -> TList(TStr):
         return string_list
@@ -140,6 +151,21 @@ class _Transfer(EnvExperiment):
             inner()
         return (self.h2d, self.d2h)
 
+    @kernel
+    def test_tuple_list(self, large):
+        def inner():
+            t0 = self.core.get_rtio_counter_mu()
+            data = self.get_tuple_list(large)
+            t1 = self.core.get_rtio_counter_mu()
+            self.sink(data)
+            t2 = self.core.get_rtio_counter_mu()
+            self.h2d[i] = self.core.mu_to_seconds(t1 - t0)
+            self.d2h[i] = self.core.mu_to_seconds(t2 - t1)
+
+        for i in range(self.count):
+            inner()
+        return (self.h2d, self.d2h)
+
     @kernel
     def test_async(self):
         data = self.get_bytes(True)
@@ -264,6 +290,32 @@ class TransferTest(ExperimentCase):
         self.results.append(["I32 Array (1KB) D2H", device_to_host.mean(),
                              device_to_host.std()])
 
+    def test_tuple_list_large(self):
+        exp = self.create(_Transfer)
+        results = exp.test_tuple_list(True)
+        size = 12 * len(tuple_list_large)
+        host_to_device = size / numpy.array(results[0], numpy.float64)
+        device_to_host = size / numpy.array(results[1], numpy.float64)
+        host_to_device /= 1024*1024
+        device_to_host /= 1024*1024
+        self.results.append(["Tuple List (1MB) H2D", host_to_device.mean(),
+                             host_to_device.std()])
+        self.results.append(["Tuple List (1MB) D2H", device_to_host.mean(),
+                             device_to_host.std()])
+
+    def test_tuple_list_small(self):
+        exp = self.create(_Transfer)
+        results = exp.test_tuple_list(False)
+        size = 12 * len(tuple_list_small)
+        host_to_device = size / numpy.array(results[0], numpy.float64)
+        device_to_host = size / numpy.array(results[1], numpy.float64)
+        host_to_device /= 1024*1024
+        device_to_host /= 1024*1024
+        self.results.append(["Tuple List (1KB) H2D", host_to_device.mean(),
+                             host_to_device.std()])
+        self.results.append(["Tuple List (1KB) D2H", device_to_host.mean(),
+                             device_to_host.std()])
+
     def test_async_throughput(self):
         exp = self.create(_Transfer)
         results = exp.test_async()
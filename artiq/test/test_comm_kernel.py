@@ -0,0 +1,252 @@
+import os
+import socket
+import struct
+import threading
+import unittest
+from time import monotonic, sleep
+from unittest import mock
+
+import numpy
+
+from artiq.coredevice import comm_kernel
+from artiq.coredevice.comm_kernel import (CommKernel, Reply, Request,
+                                          RPCReturnValueError)
+from artiq.coredevice.profiler import KernelProfiler
+
+
+def _header(ty):
+    return struct.pack("<lB", 0x5a5a5a5a, ty.value)
+
+
+def _rpc(service_id, *args, return_tags=None):
+    # asynchronous unless return tags are given
+    is_async = return_tags is None
+    if is_async:
+        return_tags = b"n"
+    return (_header(Reply.RPCRequest) + bytes([is_async]) + struct.pack("<l", service_id) +
+            b"".join(args) + b"\x00" + struct.pack("<l", len(return_tags)) + return_tags)
+
+
+def _int32(value):
+    return b"i" + struct.pack("<l", value)
+
+
+def _bytes(value):
+    return b"B" + struct.pack("<l", len(value)) + value
+
+
+def _float_array(value):
+    return b"a\x01" + struct.pack("<l", len(value)) + b"f" + value.astype("<f8").tobytes()
+
+
+def _pair_list(length):
+    # list of (int32, float) tuples; the device repeats the tag of each
+    # non-primitive element
+    pair = b"t\x02" + _int32(7) + b"f" + struct.pack("<d", 0.5)
+    return b"l" + struct.pack("<l", length) + b"t" + pair * length
+
+
+def _object(value):
+    return b"O" + struct.pack("<l", value)
+
+
+def _str(value):
+    return b"s" + struct.pack("<l", len(value)) + value.encode()
+
+
+class _Object:
+    pass
+
+
+class _EmbeddingMap:
+    def __init__(self, results, services):
+        self.results = results
+        self.services = services
+        self.calls = []
+
+    def retrieve_object(self, key):
+        if key in self.services:
+            return self.services[key]
+        if isinstance(self.results.get(key), _Object):
+            return self.results[key]
+        def service(*args):
+            self.calls.append((key, args))
+            return self.results.get(key)
+        return service
+
+
+class CommKernelCase(unittest.TestCase):
+    def serve(self, messages, chunk_size=None, results={}, services={}, kernel=None):
+        """Replays a stream of messages from the core device, with services
+        returning ``results`` unless given in ``services``, and returns the
+        RPC calls made, the replies sent to the device and the time taken."""
+        stream = b"e" + messages + _header(Reply.KernelFinished) + b"\x00"
+        host, device = socket.socketpair()
+
+        def send():
+            if chunk_size is None:
+                device.sendall(stream)
+            else:
+                for i in range(0, len(stream), chunk_size):
+                    device.sendall(stream[i:i + chunk_size])
+        replies = bytearray()
+        def receive():
+            while True:
+                data = device.recv(1 << 16)
+                if not data:
+                    break
+                replies.extend(data)
+        threads = [threading.Thread(target=send), threading.Thread(target=receive)]
+
+        embedding_map = _EmbeddingMap(results, services)
+        try:
+            with mock.patch.object(comm_kernel, "create_connection",
+                                   return_value=host):
+                if kernel is None:
+                    kernel = CommKernel("device")
+                for thread in threads:
+                    thread.start()
+                t0 = monotonic()
+                kernel.serve(embedding_map, None, None)
+                t = monotonic() - t0
+        finally:
+            host.shutdown(socket.SHUT_RDWR)
+            for thread in threads:
+                thread.join()
+            host.close()
+            device.close()
+        # skip the greeting
+        return embedding_map.calls, bytes(replies[len(b"ARTIQ coredev\n"):]), t
+
+    def test_read(self):
+        payload = bytes(range(256)) * 1000
+        array = numpy.arange(10000.)
+        calls, _, _ = self.serve(
+            _rpc(1, _int32(-1), _bytes(payload), b"s" + struct.pack("<l", 3) + b"abc") +
+            _rpc(2, _float_array(array), _pair_list(3), _bytes(b"")),
+            chunk_size=1000)
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(calls[0][0], 1)
+        self.assertEqual(calls[0][1], (-1, payload, "abc"))
+        self.assertEqual(calls[1][0], 2)
+        numpy.testing.assert_array_equal(calls[1][1][0], array)
+        self.assertEqual(calls[1][1][1], [(7, 0.5)] * 3)
+        self.assertEqual([type(value) for value in calls[1][1][1][0]],
+                         [numpy.int32, float])
+        self.assertEqual(calls[1][1][2], b"")
+
+    def test_read_list(self):
+        calls, _, _ = self.serve(
+            _rpc(1, b"l" + struct.pack("<l", 3) + b"b" + bytes([1, 0, 1]),
+                 b"l" + struct.pack("<l", 2) + b"I" + struct.pack("<qq", -1, 2**40)))
+        self.assertEqual(calls, [(1, ([True, False, True], [-1, 2**40]))])
+        self.assertEqual([type(value[0]) for value in calls[0][1]], [bool, int])
+
+    def test_attribute_writeback(self):
+        first, second = _Object(), _Object()
+        calls, _, _ = self.serve(
+            _rpc(0, _object(1), _str("count"), _int32(3),
+                    _object(2), _str("count"), _int32(4),
+                    _object(2), _str("name"), _str("second")),
+            results={1: first, 2: second})
+        self.assertEqual(calls, [])
+        self.assertEqual(vars(first), {"count": 3})
+        self.assertEqual(vars(second), {"count": 4, "name": "second"})
+
+    def test_async_rpc_queue(self):
+        served = []
+        def slow(value):
+            sleep(0.01)
+            served.append(value)
+        def count():
+            return len(served)
+
+        kernel = CommKernel("device", async_rpc_queue=2)
+        _, replies, _ = self.serve(
+            b"".join(_rpc(1, _int32(value)) for value in range(5)) +
+            _rpc(2, return_tags=b"i") + _rpc(1, _int32(5)),
+            services={1: slow, 2: count}, kernel=kernel)
+        self.assertEqual(served, list(range(6)))
+        # The synchronous RPC is only served after the asynchronous ones before it.
+        self.assertEqual(replies[-4:], struct.pack("<l", 5))
+        self.assertEqual(kernel.async_rpcs.count, 6)
+        self.assertEqual(kernel.async_rpcs.max_depth, 2)
+        self.assertGreater(kernel.async_rpcs.full_time, 0)
+        self.assertEqual(kernel.async_rpcs.depth(), 0)
+
+    def test_async_rpc_queue_error(self):
+        served = []
+        def service(value):
+            if value == 1:
+                raise ValueError(value)
+            served.append(value)
+
+        kernel = CommKernel("device", async_rpc_queue=10)
+        with self.assertRaises(ValueError):
+            self.serve(b"".join(_rpc(1, _int32(value)) for value in range(3)),
+                       services={1: service}, kernel=kernel)
+        self.assertEqual(served, [0])
+
+    def test_profiler(self):
+        def service(value):
+            return value
+
+        for async_rpc_queue in 0, 2:
+            kernel = CommKernel("device", async_rpc_queue=async_rpc_queue)
+            kernel.profiler = KernelProfiler()
+            self.serve(_rpc(1, _int32(1)) + _rpc(1, _int32(2), return_tags=b"i"),
+                       services={1: service}, kernel=kernel)
+            self.assertEqual([(name, category, args)
+                              for name, category, _, _, _, args in kernel.profiler.events],
+                             [("RPC CommKernelCase.test_profiler.<locals>.service", "rpc",
+                               {"service": 1})] * 2)
+
+    @unittest.skipUnless(os.getenv("ARTIQ_BENCHMARKS"), "benchmarks not enabled")
+    def test_rpc_benchmark(self):
+        """Time the decoding of a 100 MB stream of RPCs with large payloads
+        and lists of many small values."""
+        messages = (_rpc(1, _pair_list(10000)) +
+                    _rpc(2, _bytes(bytes(1 << 20))) +
+                    _rpc(3, _float_array(numpy.zeros(1 << 17))) +
+                    _rpc(4, _int32(3)))
+        count = (100 << 20) // len(messages)
+        calls, _, t = self.serve(messages * count)
+        self.assertEqual(len(calls), 4 * count)
+        self.assertLess(t, 5.0)
+
+    def reply(self, return_tags, value):
+        _, replies, t = self.serve(_rpc(1, return_tags=return_tags),
+                                   results={1: value})
+        header = struct.pack("<lB", 0x5a5a5a5a, Request.RPCReply.value)
+        tags = struct.pack("<l", len(return_tags)) + return_tags
+        self.assertEqual(replies[:len(header) + len(tags)], header + tags)
+        return replies[len(header) + len(tags):], t
+
+    def test_reply(self):
+        pairs = [(1, 0.5), (numpy.int32(-2), numpy.float64(1.0))]
+        expected = struct.pack("<lld", 2, 1, 0.5) + struct.pack("<ld", -2, 1.0)
+        self.assertEqual(self.reply(b"lt\x02if", pairs)[0], expected)
+        # bool is an int subclass, serialized element by element
+        self.assertEqual(self.reply(b"lt\x02if", [(True, 0.5)])[0],
+                         struct.pack("<lld", 1, 1, 0.5))
+        self.assertEqual(self.reply(b"t\x02sI", ("abc", 2**40))[0],
+                         struct.pack("<l", 3) + b"abc" + struct.pack("<q", 2**40))
+
+        with self.assertRaisesRegex(RPCReturnValueError,
+                r"^type mismatch: cannot serialize 4 as float \(.* has returned "
+                r"\[\(1, 0\.5\), \(3, 4\)\]\)$"):
+            self.reply(b"lt\x02if", [(1, 0.5), (3, 4)])
+        with self.assertRaisesRegex(RPCReturnValueError,
+                r"^type mismatch: cannot serialize 2147483648 as 32-bit int "):
+            self.reply(b"lt\x02if", [(1, 0.5), (2**31, 4.0)])
+        with self.assertRaisesRegex(RPCReturnValueError,
+                r"^type mismatch: cannot serialize \(3,\) as tuple of 2 "):
+            self.reply(b"lt\x02if", [(1, 0.5), (3,)])
+
+    @unittest.skipUnless(os.getenv("ARTIQ_BENCHMARKS"), "benchmarks not enabled")
+    def test_reply_benchmark(self):
+        """Time the serialization of a list of 1M (int32, float) tuples."""
+        pairs = [(i, i * 0.5) for i in range(1 << 20)]
+        data, t = self.reply(b"lt\x02if", pairs)
+        self.assertEqual(len(data), 4 + 12 * len(pairs))
+        self.assertLess(t, 3.0)
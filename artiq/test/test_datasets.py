@@ -1,12 +1,21 @@
 """Tests for the (Env)Experiment-facing dataset interface."""
 
+import asyncio
 import copy
+import os
+import tempfile
+import time
 import unittest
 
-from sipyco.sync_struct import process_mod
+import lmdb
+import numpy
+
+from sipyco.sync_struct import process_mod, Subscriber
 
 from artiq.experiment import EnvExperiment
-from artiq.master.worker_db import DatasetManager
+from artiq.master.worker_db import DatasetManager, DatasetModStream
+from artiq.master.databases import DatasetDB
+from artiq.master.publisher import Publisher, subscription_name
 
 
 class MockDatasetDB:
@@ -132,3 +141,342 @@ class ExperimentDatasetCase(unittest.TestCase):
         self.assertEqual(self.dataset_db.get_metadata(KEY), {})
 
 
+class DatasetModStreamCase(unittest.TestCase):
+    def setUp(self):
+        self.dataset_db = MockDatasetDB()
+        self.batches = []
+        def send(mods):
+            self.batches.append(mods)
+            for mod in mods:
+                self.dataset_db.update(mod)
+        self.stream = DatasetModStream(send, interval=100.0)
+        self.dataset_mgr = DatasetManager(self.stream)
+        self.exp = TestExperiment((None, self.dataset_mgr, None, None))
+
+    def test_coalesce_replaced(self):
+        self.exp.set(KEY, [], broadcast=True)
+        for i in range(10):
+            self.exp.append(KEY, i)
+        self.exp.set("bar", 0, broadcast=True)
+        self.exp.set("bar", 1, broadcast=True)
+        self.stream.flush()
+        self.assertEqual(len(self.batches), 1)
+        self.assertEqual(len(self.batches[0]), 2)
+        self.assertEqual(self.dataset_db.get(KEY), list(range(10)))
+        self.assertEqual(self.dataset_db.get("bar"), 1)
+
+    def test_ordering(self):
+        self.exp.set(KEY, [0, 0], broadcast=True)
+        self.stream.flush()
+        for i in range(5):
+            self.exp.append(KEY, i)
+        self.exp.set_dataset("bar", 0, broadcast=True)
+        self.exp.mutate_dataset(KEY, 0, 1)
+        self.exp.mutate_dataset(KEY, 0, 2)
+        self.exp.mutate_dataset(KEY, 1, 3)
+        self.stream.flush()
+        self.assertEqual(len(self.batches[1]), 8)
+        self.assertEqual(self.dataset_db.get(KEY), [2, 3, 0, 1, 2, 3, 4])
+
+    def test_max_mods(self):
+        self.stream.max_mods = 4
+        self.exp.set(KEY, [], broadcast=True)
+        self.stream.flush()
+        for i in range(10):
+            self.exp.append(KEY, i)
+        self.assertEqual([len(b) for b in self.batches], [1, 4, 4])
+        self.stream.flush()
+        self.assertEqual(self.dataset_db.get(KEY), list(range(10)))
+
+    def test_mutate_while_pending(self):
+        # The notifier modifies the value before queuing the modification,
+        # so a pending value can be modified before the flush.
+        value = [0]
+        self.stream.update({"action": "setitem", "path": [], "key": KEY,
+                            "value": (False, value, {})})
+        value.append(1)
+        self.stream.flush()
+        self.stream.update({"action": "append", "path": [KEY, 1], "x": 1})
+        self.stream.flush()
+        self.assertEqual(self.dataset_db.get(KEY), [0, 1])
+
+        array = numpy.zeros(3)
+        self.stream.update({"action": "setitem", "path": [], "key": "bar",
+                            "value": (False, array, {})})
+        array[0] = 1.0
+        self.stream.flush()
+        numpy.testing.assert_array_equal(self.dataset_db.get("bar"), numpy.zeros(3))
+
+    def test_copy_queued_only(self):
+        array = numpy.zeros(3)
+        self.stream.interval = 0
+        self.exp.set_dataset(KEY, array, broadcast=True)
+        self.assertIs(self.batches[-1][0]["value"][1], array)
+
+        self.stream.interval = 100.0
+        self.exp.set_dataset(KEY, array, broadcast=True)
+        self.stream.flush()
+        self.assertIsNot(self.batches[-1][0]["value"][1], array)
+
+    def test_interval(self):
+        self.stream.interval = 0.1
+        self.exp.set(KEY, 0, broadcast=True)
+        time.sleep(1.0)
+        self.assertEqual(self.dataset_db.get(KEY), 0)
+
+
+class IncrementalDatasetDBCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.persist_file = os.path.join(self.tmpdir.name, "dataset_db.mdb")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _open(self, **kwargs):
+        return DatasetDB(self.persist_file, storage="incremental", **kwargs)
+
+    def _records(self):
+        env = lmdb.open(self.persist_file, subdir=False)
+        try:
+            with env.begin() as txn:
+                return dict(txn.cursor())
+        finally:
+            env.close()
+
+    def test_mod_log(self):
+        ddb = self._open()
+        ddb.set("array", numpy.zeros(1000), persist=True)
+        ddb.set("list", [], persist=True)
+        ddb.save()
+        ddb.update({"action": "setitem", "path": ["array", 1],
+                    "key": 3, "value": 1.0})
+        for i in range(3):
+            ddb.update({"action": "append", "path": ["list", 1], "x": i})
+        ddb.save()
+        ddb.close_db()
+
+        records = self._records()
+        # two records and four log entries
+        self.assertEqual(len(records), 6)
+        self.assertTrue(all(len(v) < 100 for k, v in records.items()
+                            if k.startswith(b"\x00")))
+
+        ddb = self._open()
+        expected = numpy.zeros(1000)
+        expected[3] = 1.0
+        numpy.testing.assert_array_equal(ddb.get("array"), expected)
+        self.assertEqual(ddb.get("list"), [0, 1, 2])
+        ddb.close_db()
+
+    def test_compaction(self):
+        ddb = self._open(max_log_entries=10)
+        ddb.set("list", list(range(1000)), persist=True)
+        ddb.save()
+        for i in range(20):
+            ddb.update({"action": "append", "path": ["list", 1], "x": i})
+        ddb.save()
+        ddb.compact()
+        ddb.close_db()
+
+        self.assertEqual(list(self._records().keys()), [b"list"])
+        ddb = self._open()
+        self.assertEqual(ddb.get("list"), list(range(1000)) + list(range(20)))
+        ddb.close_db()
+
+    def test_storage_modes(self):
+        ddb = self._open()
+        ddb.set("list", [], persist=True)
+        ddb.save()
+        ddb.update({"action": "append", "path": ["list", 1], "x": 1})
+        ddb.save()
+        ddb.close_db()
+
+        ddb = DatasetDB(self.persist_file)
+        self.assertEqual(ddb.get("list"), [1])
+        ddb.save()
+        ddb.close_db()
+        self.assertEqual(self._records(), {b"list": b"([1], {})"})
+
+    def test_lazy(self):
+        ddb = self._open()
+        for i in range(4):
+            ddb.set("array{}".format(i), numpy.full(1000, i), persist=True,
+                    metadata={"unit": "V"})
+        ddb.set("list", [], persist=True)
+        ddb.save()
+        ddb.update({"action": "append", "path": ["list", 1], "x": 1})
+        ddb.save()
+        ddb.close_db()
+
+        ddb = self._open(lazy=True, cache_size=10000)
+        self.assertEqual(len(ddb._unloaded), 5)
+        self.assertEqual(ddb.get_metadata("array1"), {"unit": "V"})
+        self.assertEqual(len(ddb._unloaded), 5)
+        self.assertEqual(ddb.get("list"), [1])
+        ddb.update({"action": "append", "path": ["list", 1], "x": 2})
+        for i in range(4):
+            numpy.testing.assert_array_equal(ddb.get("array{}".format(i)),
+                                             numpy.full(1000, i))
+        # The least recently used arrays have been dropped from memory, but
+        # not the list, which has unsaved modifications.
+        self.assertIn("array0", ddb._unloaded)
+        self.assertNotIn("array3", ddb._unloaded)
+        self.assertNotIn("list", ddb._unloaded)
+        numpy.testing.assert_array_equal(ddb.get("array0"), numpy.zeros(1000))
+        # Subscribers get all values, which are then dropped from memory.
+        view = ddb.data.raw_view
+        self.assertEqual(view["list"], (True, [1, 2], {}))
+        for i in range(4):
+            numpy.testing.assert_array_equal(view["array{}".format(i)][1],
+                                             numpy.full(1000, i))
+        self.assertLessEqual(len(ddb._cache), 2)
+        self.assertIn("array0", ddb._unloaded)
+        ddb.save()
+        ddb.close_db()
+
+        ddb = self._open(lazy=True)
+        self.assertEqual(ddb.get("list"), [1, 2])
+        ddb.close_db()
+
+    def test_lazy_pyon(self):
+        metadata = {"unit": "V", "desc": "a, {b}", "nested": [1, {"c": {}}]}
+        ddb = DatasetDB(self.persist_file)
+        ddb.set("array", numpy.zeros(1000), persist=True, metadata=metadata)
+        ddb.set("dicts", [{"d": 1}, {}], persist=True)
+        ddb.save()
+        ddb.close_db()
+
+        ddb = DatasetDB(self.persist_file, lazy=True)
+        self.assertEqual(ddb._unloaded, {"array", "dicts"})
+        self.assertEqual(ddb.get_metadata("array"), metadata)
+        self.assertEqual(ddb.get_metadata("dicts"), {})
+        self.assertEqual(len(ddb._unloaded), 2)
+        numpy.testing.assert_array_equal(ddb.get("array"), numpy.zeros(1000))
+        self.assertEqual(ddb.get("dicts"), [{"d": 1}, {}])
+        ddb.close_db()
+
+
+class DatasetSubscriptionCase(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.tmpdir = tempfile.TemporaryDirectory()
+        persist_file = os.path.join(self.tmpdir.name, "dataset_db.mdb")
+        ddb = DatasetDB(persist_file, storage="incremental")
+        ddb.set("scan.x", [0], persist=True)
+        ddb.set("scan.y", [1], persist=True)
+        ddb.set("large", numpy.zeros(1000), persist=True)
+        ddb.save()
+        ddb.close_db()
+        self.ddb = DatasetDB(persist_file, storage="incremental", lazy=True)
+
+    def tearDown(self):
+        self.ddb.close_db()
+        self.tmpdir.cleanup()
+        self.loop.close()
+
+    def test_filtered_subscription(self):
+        publisher = Publisher({"datasets": self.ddb.data})
+        received = []
+
+        async def test():
+            await publisher.start("127.0.0.1", 0)
+            port = publisher.server.sockets[0].getsockname()[1]
+            subscriber = Subscriber(
+                subscription_name("datasets", keys=["x"],
+                                  prefixes=["scan."]),
+                dict, received.append)
+            await subscriber.connect("127.0.0.1", port)
+            try:
+                while not received:
+                    await asyncio.sleep(0.01)
+                # The values of the other datasets are not loaded.
+                self.assertEqual(self.ddb._unloaded, {"large"})
+                self.ddb.update({"action": "setitem", "path": ["large", 1],
+                                 "key": 0, "value": 1.0})
+                self.ddb.update({"action": "append", "path": ["scan.x", 1],
+                                 "x": 1})
+                self.ddb.set("x", 2)
+                self.ddb.set("y", 3)
+                while len(received) < 3:
+                    await asyncio.sleep(0.01)
+                await asyncio.sleep(0.1)
+            finally:
+                await subscriber.close()
+                await publisher.stop()
+        self.loop.run_until_complete(test())
+
+        init = received[0]
+        self.assertEqual(init["action"], "init")
+        self.assertEqual(set(init["struct"].keys()), {"scan.x", "scan.y"})
+        self.assertEqual([mod["action"] for mod in received[1:]],
+                         ["append", "setitem"])
+        self.assertEqual(received[2]["key"], "x")
+
+    def _subscribe(self, names, max_rate, cb):
+        publisher = Publisher({"datasets": self.ddb.data},
+                              max_rates={"datasets": max_rate})
+        received = {name: [] for name in names}
+
+        async def test():
+            await publisher.start("127.0.0.1", 0)
+            port = publisher.server.sockets[0].getsockname()[1]
+            subscribers = []
+            for name in names:
+                subscriber = Subscriber(name, dict, received[name].append)
+                await subscriber.connect("127.0.0.1", port)
+                subscribers.append(subscriber)
+            try:
+                while not all(received.values()):
+                    await asyncio.sleep(0.01)
+                await cb()
+            finally:
+                for subscriber in subscribers:
+                    await subscriber.close()
+                await publisher.stop()
+        self.loop.run_until_complete(test())
+        return received
+
+    def test_rate_limit(self):
+        async def mutate():
+            for i in range(100):
+                self.ddb.update({"action": "append",
+                                 "path": ["scan.x", 1], "x": i})
+                self.ddb.update({"action": "setitem",
+                                 "path": ["large", 1], "key": 0, "value": i})
+                await asyncio.sleep(0.002)
+            await asyncio.sleep(0.5)
+
+        lossless = subscription_name("datasets", lossless=True)
+        received = self._subscribe(["datasets", lossless], 10, mutate)
+
+        mods = received[lossless][1:]
+        self.assertEqual(len(mods), 200)
+        mods = received["datasets"][1:]
+        self.assertLess(len(mods), 20)
+        # The assignments to the same item are merged, the appends are
+        # coalesced into snapshots.
+        self.assertIn({"action": "setitem", "path": [], "key": "scan.x",
+                       "value": (True, [0] + list(range(100)), {})}, mods)
+        struct = received["datasets"][0]["struct"]
+        for mod in mods:
+            process_mod(struct, mod)
+        self.assertEqual(struct["scan.x"][1], [0] + list(range(100)))
+        self.assertEqual(struct["large"][1][0], 99)
+
+    def test_rate_limit_evicted(self):
+        async def mutate():
+            self.ddb.update({"action": "append", "path": ["scan.x", 1], "x": 1})
+            self.ddb.update({"action": "append", "path": ["scan.x", 1], "x": 2})
+            # The value is unloaded before the snapshot is sent.
+            self.ddb.save()
+            self.ddb.cache_size = 0
+            self.ddb.get("scan.y")
+            self.ddb._evict()
+            self.assertIn("scan.x", self.ddb._unloaded)
+            await asyncio.sleep(0.5)
+
+        received = self._subscribe(["datasets"], 10, mutate)["datasets"]
+        self.assertEqual(received[1:], [{"action": "setitem", "path": [], "key": "scan.x",
+                                         "value": (True, [0, 1, 2], {})}])
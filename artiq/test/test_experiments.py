@@ -0,0 +1,187 @@
+import asyncio
+import os
+import tempfile
+import unittest
+
+try:
+    import pygit2
+except ImportError:
+    pygit2 = None
+
+from artiq.master.experiments import _RepoScanner, ExamineCache, GitBackend
+
+
+EXPERIMENT = """
+from artiq.experiment import *
+
+
+class {class_name}(EnvExperiment):
+    \"\"\"{name}\"\"\"
+    def build(self):
+        pass
+
+    def run(self):
+        pass
+"""
+
+
+class RepoScannerCase(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.tmpdir = tempfile.TemporaryDirectory()
+        root = self.tmpdir.name
+        os.mkdir(os.path.join(root, "sub"))
+        for i in range(8):
+            for subdir in "", "sub":
+                with open(os.path.join(root, subdir, "exp{}.py".format(i)),
+                          "w") as f:
+                    # All files define an experiment with the same name.
+                    f.write(EXPERIMENT.format(class_name="Exp", name="Test"))
+        with open(os.path.join(root, "broken.py"), "w") as f:
+            f.write("raise ValueError\n")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+        self.loop.close()
+
+    def _scan(self, jobs):
+        scanner = _RepoScanner({}, jobs)
+        with self.assertLogs("artiq.master.experiments", "WARNING"):
+            return self.loop.run_until_complete(
+                scanner.scan(self.tmpdir.name))
+
+    def test_parallel_scan(self):
+        sequential = self._scan(1)
+        self.assertEqual(len(sequential), 16)
+        self.assertEqual(list(self._scan(4).items()),
+                         list(sequential.items()))
+
+
+HELPER_EXPERIMENT = """
+from artiq.experiment import *
+import helper
+
+
+class Exp(EnvExperiment):
+    __doc__ = helper.NAME
+
+    def build(self):
+        pass
+
+    def run(self):
+        pass
+"""
+
+
+class ExamineCacheCase(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.root = os.path.join(self.tmpdir.name, "repository")
+        os.mkdir(self.root)
+        self._write("helper.py", "NAME = 'Name 1'\n")
+        self._write("uses_helper.py", HELPER_EXPERIMENT)
+        self._write("simple.py",
+                    EXPERIMENT.format(class_name="Simple", name="Simple"))
+        self.cache_file = os.path.join(self.tmpdir.name, "cache.pyon")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+        self.loop.close()
+
+    def _write(self, filename, contents):
+        with open(os.path.join(self.root, filename), "w") as f:
+            f.write(contents)
+
+    def _scan(self):
+        scanner = _RepoScanner({}, 2, ExamineCache(self.cache_file))
+        r = self.loop.run_until_complete(scanner.scan(self.root))
+        return r, scanner.examined
+
+    def test_examine_cache(self):
+        r, examined = self._scan()
+        self.assertEqual(examined, 3)
+        self.assertEqual(set(r.keys()), {"Name 1", "Simple"})
+
+        r2, examined = self._scan()
+        self.assertEqual(examined, 0)
+        self.assertEqual(r2, r)
+
+        # The helper and the experiment importing it are examined again.
+        # (with a different size, so that the bytecode cache is invalidated)
+        self._write("helper.py", "NAME = 'Second name'\n")
+        r, examined = self._scan()
+        self.assertEqual(examined, 2)
+        self.assertEqual(set(r.keys()), {"Second name", "Simple"})
+
+
+@unittest.skipIf(pygit2 is None, "pygit2 is not installed")
+class GitBackendCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.root = self.tmpdir.name
+        self.git = pygit2.init_repository(self.root)
+        self.revs = []
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _commit(self, files):
+        for filename, contents in files.items():
+            path = os.path.join(self.root, filename)
+            if contents is None:
+                os.remove(path)
+                continue
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "w") as f:
+                f.write(contents)
+        self.git.index.add_all()
+        self.git.index.write()
+        tree = self.git.index.write_tree()
+        signature = pygit2.Signature("test", "test@example.com")
+        parents = [self.revs[-1]] if self.revs else []
+        rev = self.git.create_commit("HEAD", signature, signature,
+                                     "commit {}".format(len(self.revs)),
+                                     tree, parents)
+        self.revs.append(rev)
+        return str(rev)
+
+    def _contents(self, path):
+        r = dict()
+        for directory, _, filenames in os.walk(path):
+            for filename in filenames:
+                with open(os.path.join(directory, filename)) as f:
+                    r[os.path.relpath(os.path.join(directory, filename),
+                                      path)] = f.read()
+        return r
+
+    def test_checkout_cache(self):
+        rev1 = self._commit({"a.py": "a", "lib/b.py": "b", "c/d.py": "d"})
+        rev2 = self._commit({"a.py": "a2", "c/d.py": None, "e.py": "e"})
+        backend = GitBackend(self.root, max_checkouts=1, eviction_delay=60)
+
+        path1, message, _ = backend.request_rev(rev1)
+        self.assertEqual(message, "commit 0")
+        backend.release_rev(rev1)
+        # The unused checkout is kept and updated to the new revision.
+        path2, message, _ = backend.request_rev(rev2)
+        self.assertEqual(message, "commit 1")
+        self.assertEqual(path2, path1)
+        self.assertEqual(self._contents(path2),
+                         {"a.py": "a2", "lib/b.py": "b", "e.py": "e"})
+        self.assertFalse(os.path.exists(os.path.join(path2, "c")))
+
+        # A revision in use is not updated.
+        path1, _, _ = backend.request_rev(rev1)
+        self.assertNotEqual(path1, path2)
+        self.assertEqual(self._contents(path1),
+                         {"a.py": "a", "lib/b.py": "b", "c/d.py": "d"})
+        backend.release_rev(rev1)
+        backend.release_rev(rev2)
+        # Only one checkout is kept.
+        self.assertEqual(len(backend.checkouts), 1)
+        backend.close()
+        self.assertFalse(os.path.exists(path1))
+        self.assertFalse(os.path.exists(path2))
@@ -0,0 +1,64 @@
+import io
+import shutil
+import unittest
+
+import h5py
+
+from artiq.experiment import *
+from artiq.coredevice.core import Core
+from artiq.coredevice.profiler import KernelProfiler
+from artiq.compiler.targets import RV32GTarget
+
+
+class _Experiment:
+    def __init__(self, core):
+        self.core = core
+        self.count = 0
+
+    @kernel
+    def run(self):
+        self.count += 1
+
+
+class KernelProfilerCase(unittest.TestCase):
+    def test_spans(self):
+        profiler = KernelProfiler()
+        with profiler.span("outer", "kernel"):
+            with profiler.span("inner", "comm", {"value": 1}):
+                pass
+        self.assertEqual(profiler.wrap_rpc(3, lambda x: x + 1)(1), 2)
+
+        self.assertEqual([(name, category) for name, category, *_ in profiler.events],
+                         [("inner", "comm"), ("outer", "kernel"),
+                          ("RPC KernelProfilerCase.test_spans.<locals>.<lambda>", "rpc")])
+        inner, outer, rpc = profiler.chrome_trace()["traceEvents"]
+        self.assertEqual(inner["ph"], "X")
+        self.assertEqual(inner["args"], {"value": 1})
+        self.assertEqual(rpc["args"], {"service": 3})
+        self.assertNotIn("args", outer)
+        self.assertLessEqual(outer["ts"], inner["ts"])
+        self.assertGreaterEqual(outer["ts"] + outer["dur"], inner["ts"] + inner["dur"])
+
+        with h5py.File(io.BytesIO(), "w") as f:
+            profiler.write_hdf5(f.create_group("profile"))
+            self.assertEqual(list(f["profile/name"]),
+                             [b"inner", b"outer",
+                              b"RPC KernelProfilerCase.test_spans.<locals>.<lambda>"])
+            self.assertEqual(list(f["profile/duration"]),
+                             [duration for _, _, _, duration, _, _ in profiler.events])
+
+    @unittest.skipUnless(shutil.which(RV32GTarget.tool_ld), "LLVM tools not available")
+    def test_core(self):
+        core = Core({}, host=None, ref_period=1e-9, kernel_cache=False, profile=True)
+        core.dmgr = {"core": core}
+        _Experiment(core).run()
+
+        names = [name for name, *_ in core.profiler.events]
+        for name in ["Stitching", "Inference", "Inferencer", "ARTIQIRGenerator",
+                     "LLVM optimizations", "Linking", "Stripping",
+                     "Upload", "Execution", "Kernel _Experiment.run"]:
+            self.assertIn(name, names)
+
+        with h5py.File(io.BytesIO(), "w") as f:
+            core.write_results(f)
+            self.assertEqual(len(f["kernel_profile/start"]), len(names))
@@ -1,11 +1,15 @@
+import os
 import unittest
 import logging
 import asyncio
 import sys
 from time import time, sleep
 
+from sipyco.sync_struct import Notifier
+
 from artiq.experiment import *
-from artiq.master.scheduler import Scheduler
+from artiq.master.scheduler import (Scheduler, RunPool, RunStatus,
+                                    PrepareStage, RunStage, AnalyzeStage)
 
 
 class EmptyExperiment(EnvExperiment):
@@ -315,5 +319,56 @@ class SchedulerCase(unittest.TestCase):
         loop.run_until_complete(done.wait())
         loop.run_until_complete(scheduler.stop())
 
+    def _submit(self, count):
+        pool = RunPool(_RIDCounter(0), dict(), Notifier(dict()), None, None)
+        expid = _get_expid("EmptyExperiment")
+        for i in range(count):
+            pool.submit(expid, i % 7, None, False, "main")
+        return pool
+
+    def _dispatch(self, pool):
+        """Dispatches all runs of the pool through the stages, without
+        starting any worker, and returns their priority keys in order."""
+        prepare = PrepareStage(pool, None)
+        run_stage = RunStage(pool, None)
+        analyze = AnalyzeStage(pool, None)
+        keys = []
+        while True:
+            run = prepare._get_run()
+            if run is None:
+                break
+            run.status = RunStatus.preparing
+            run.status = RunStatus.prepare_done
+            self.assertIs(run_stage._get_run(), run)
+            run.status = RunStatus.running
+            run.status = RunStatus.run_done
+            self.assertIs(analyze._get_run(), run)
+            run.status = RunStatus.analyzing
+            run.status = RunStatus.deleting
+            del pool.runs[run.rid]
+            keys.append(run.priority_key())
+        return keys
+
+    def test_dispatch_order(self):
+        pool = self._submit(1000)
+        keys = self._dispatch(pool)
+        self.assertEqual(len(keys), 1000)
+        self.assertEqual(keys, sorted(keys, reverse=True))
+        self.assertEqual(pool.runs, {})
+
+    @unittest.skipUnless(os.getenv("ARTIQ_BENCHMARKS"), "benchmarks not enabled")
+    def test_dispatch_benchmark(self):
+        """Time submitting 10k runs and dispatching them through the
+        stages."""
+        count = 10000
+        t0 = time()
+        pool = self._submit(count)
+        t1 = time()
+        keys = self._dispatch(pool)
+        t2 = time()
+        self.assertEqual(len(keys), count)
+        print("{} runs: submit {:.3f}s, dispatch {:.3f}s".format(
+            count, t1 - t0, t2 - t1))
+
     def tearDown(self):
         self.loop.close()
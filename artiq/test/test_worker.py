@@ -1,11 +1,19 @@
 import unittest
 import logging
 import asyncio
+import io
+import os
 import sys
-from time import sleep
+import tempfile
+import importlib
+from time import sleep, monotonic
+
+import numpy
 
 from artiq.experiment import *
 from artiq.master.worker import *
+from artiq.master import worker_framing
+from artiq.master.worker_impl import forget_modules
 
 
 class SimpleExperiment(EnvExperiment):
@@ -52,6 +60,15 @@ class WatchdogTimeoutInBuild(EnvExperiment):
         pass
 
 
+class LargeDataset(EnvExperiment):
+    def build(self):
+        self.setattr_argument("size", NumberValue(1, precision=0, step=1))
+
+    def run(self):
+        self.set_dataset("large", numpy.ones(int(self.size) // 8),
+                         broadcast=True, archive=False)
+
+
 async def _call_worker(worker, expid):
     try:
         await worker.build(0, "main", None, expid, 0)
@@ -99,5 +116,97 @@ class WorkerCase(unittest.TestCase):
         with self.assertRaises(WorkerWatchdogTimeout):
             self._run_experiment("WatchdogTimeoutInBuild")
 
+    def test_worker_pool(self):
+        expid = {
+            "log_level": logging.WARNING,
+            "file": sys.modules[__name__].__file__,
+            "class_name": "SimpleExperiment",
+            "arguments": dict()
+        }
+        pool = WorkerPool(1, max_runs=2)
+
+        async def run_pooled():
+            worker = Worker({}, worker_pool=pool)
+            await worker.build(0, "main", None, expid, 0)
+            pid = worker.ipc.process.pid
+            await worker.prepare()
+            await worker.run()
+            await worker.analyze()
+            await worker.close()
+            return pid
+
+        async def test():
+            pool.start()
+            while not len(pool):
+                await asyncio.sleep(0.1)
+            try:
+                pids = [await run_pooled() for _ in range(3)]
+            finally:
+                await pool.stop()
+            return pids
+
+        pids = self.loop.run_until_complete(test())
+        # The first process serves two runs and is then recycled.
+        self.assertEqual(pids[0], pids[1])
+        self.assertNotEqual(pids[1], pids[2])
+
+    def test_framing_roundtrip(self):
+        obj = {
+            "action": "update_dataset",
+            "args": ({"action": "setitem", "path": [], "key": "x",
+                      "value": (False, numpy.arange(12.).reshape(3, 4), {})},),
+            "kwargs": {"other": [numpy.zeros(2, dtype=[("a", "<i4")]),
+                                 numpy.array([1, "x"], dtype=object), 3]}
+        }
+        f = io.BytesIO(b"".join(bytes(c) for c in worker_framing.encode(obj)))
+        decoded = worker_framing.read_frame(lambda n: bytearray(f.read(n)))
+        value = decoded["args"][0]["value"][1]
+        numpy.testing.assert_array_equal(value, obj["args"][0]["value"][1])
+        self.assertTrue(value.flags.writeable)
+        other = decoded["kwargs"]["other"]
+        self.assertEqual(other[0].dtype, obj["kwargs"]["other"][0].dtype)
+        self.assertEqual(list(other[1]), [1, "x"])
+        self.assertEqual(other[2], 3)
+
+    @unittest.skipUnless(os.getenv("ARTIQ_BENCHMARKS"), "benchmarks not enabled")
+    def test_framing_benchmark(self):
+        """Time broadcast set_dataset of 1 MB and 100 MB arrays with PYON
+        lines and binary framing."""
+        received = []
+        handlers = {"update_dataset": lambda mod: received.append(mod)}
+        for size in 1 << 20, 100 << 20:
+            times = []
+            for binary_framing in False, True:
+                expid = {
+                    "log_level": logging.WARNING,
+                    "file": sys.modules[__name__].__file__,
+                    "class_name": "LargeDataset",
+                    "arguments": {"size": size}
+                }
+                worker = Worker(handlers, binary_framing=binary_framing)
+                t0 = monotonic()
+                self.loop.run_until_complete(_call_worker(worker, expid))
+                times.append(monotonic() - t0)
+                self.assertEqual(len(received[-1]["value"][1]), size // 8)
+            print("{} MB: PYON {:.3f}s, binary {:.3f}s".format(
+                size >> 20, *times))
+
     def tearDown(self):
         self.loop.close()
+
+
+class ForgetModulesCase(unittest.TestCase):
+    def test_forget_modules(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with open(os.path.join(tmpdir, "artiq_test_repo_module.py"), "w") as f:
+                f.write("import colorsys\n")
+            previous_keys = set(sys.modules.keys())
+            sys.path.insert(0, tmpdir)
+            try:
+                importlib.import_module("artiq_test_repo_module")
+            finally:
+                sys.path.remove(tmpdir)
+            forget_modules(previous_keys, [tmpdir])
+        self.assertNotIn("artiq_test_repo_module", sys.modules)
+        # Modules from outside the repository are kept.
+        self.assertIn("colorsys", sys.modules)